@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Convert Scanning HIS data into the fov.nc and fg.nc inputs Mirto needs.
+
+The conversion can be run from the command line (see shis2mirto.conversion) or used
+as a library, working on numpy arrays in memory:
+
+    from shis2mirto import load_shis_data, select_fov, build_first_guess, make_narrator
+
+The library names are only imported from their modules the first time they're used,
+so starting the command line doesn't load the modules a command doesn't need.
+
+"""
+__docformat__ = "restructuredtext en"
+
+import importlib
+
+# the library names and the modules they come from
+_LIBRARY_MODULES = {
+                    'ShisData':                'shis2mirto.fov',
+                    'FovProduct':              'shis2mirto.fov',
+                    'load_shis_data':          'shis2mirto.fov',
+                    'select_fov':              'shis2mirto.fov',
+                    'select_fov_windows':      'shis2mirto.fov',
+                    'iter_fov_blocks':         'shis2mirto.fov',
+                    'iter_window_blocks':      'shis2mirto.fov',
+                    'write_fov_file':          'shis2mirto.fov',
+                    'read_fov_file':           'shis2mirto.fov',
+                    'FirstGuessProduct':       'shis2mirto.firstguess',
+                    'make_narrator':           'shis2mirto.firstguess',
+                    'CachedForecastNarrator':  'shis2mirto.firstguess',
+                    'make_run_narrator':       'shis2mirto.firstguess',
+                    'build_first_guess':       'shis2mirto.firstguess',
+                    'write_first_guess_file':  'shis2mirto.firstguess',
+                    'append_first_guess_file': 'shis2mirto.firstguess',
+                   }
+
+__all__ = sorted(_LIBRARY_MODULES)
+
+def __getattr__ (name) :
+    if name not in _LIBRARY_MODULES :
+        raise AttributeError("module 'shis2mirto' has no attribute '" + name + "'")
+
+    value = getattr(importlib.import_module(_LIBRARY_MODULES[name]), name)
+    globals()[name] = value # later lookups don't need to come back here
+
+    return value
+
+def __dir__ () :
+    return sorted(set(globals()) | set(_LIBRARY_MODULES))
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Run the SHIS to Mirto conversion over many granules at once.
+
+This file is part of the shis2mirto software package. The batch module expands a list of
+globs and manifest files into SHIS granules and converts each granule in a pool of worker
+processes, so the heavy imports are only paid once per worker instead of once per file.
+
+"""
+__docformat__ = "restructuredtext en"
+
+import os
+import glob
+import time
+import logging
+import multiprocessing
+
+log = logging.getLogger(__name__)
+
+# manifest files are named on the command line with this prefix, ie. @granules.txt
+MANIFEST_PREFIX = "@"
+
+def expand_granule_list (patterns) :
+    """expand glob patterns and manifest files into a sorted list of unique SHIS file paths
+
+    Each pattern is either a glob (ie. "/data/SHIS_*.nc") or the path to a manifest file
+    prefixed with an @ (ie. "@granules.txt"). Manifest files list one path or glob per line;
+    blank lines and lines starting with # are ignored.
+
+    :param patterns: a list of glob patterns and manifest files
+    :return: a list of absolute file paths
+    """
+
+    found_paths = [ ]
+    for pattern in patterns :
+        if pattern.startswith(MANIFEST_PREFIX) :
+            with open(os.path.expanduser(pattern[len(MANIFEST_PREFIX):]), 'r') as manifest_file :
+                manifest_lines = [line.strip() for line in manifest_file]
+            found_paths.extend(expand_granule_list([line for line in manifest_lines
+                                                    if line and not line.startswith("#")]))
+        else :
+            temp_paths = glob.glob(os.path.expanduser(pattern))
+            if not temp_paths :
+                log.warn("No SHIS files found matching: " + pattern)
+            found_paths.extend(temp_paths)
+
+    return sorted(set(os.path.abspath(path) for path in found_paths))
+
+def granule_output_names (granule_paths) :
+    """figure out the names of the fov and fg files we'll produce for each granule
+
+    The names come from the granule's file name without its extension. Granules that would
+    get the same names (ie. the same file name in different dated directories) have as many
+    of their parent directory names added in front as it takes to tell them apart, since they
+    all write to the same output directory.
+
+    >>> granule_output_names(["/data/SHIS_20140906.nc"])
+    [('SHIS_20140906_fov.nc', 'SHIS_20140906_fg.nc')]
+    >>> [fov_name for fov_name, fg_name in granule_output_names(["/data/0906/SHIS.nc", "/data/0907/SHIS.nc",
+    ...                                                          "/data/SHIS_0908.nc"])]
+    ['0906_SHIS_fov.nc', '0907_SHIS_fov.nc', 'SHIS_0908_fov.nc']
+
+    :param granule_paths: a list of paths to SHIS files
+    :return: a list of (fov file name, fg file name) tuples, one for each granule
+    :raises ValueError: if two granules can't be told apart by their paths (ie. SHIS.nc and SHIS.hdf in one directory)
+    """
+
+    # each granule's name parts, nearest first: the file name stem, then its parent directories
+    all_parts = [ ]
+    for granule_path in granule_paths :
+        dir_path, file_name = os.path.split(os.path.abspath(granule_path))
+        name_parts = [os.path.splitext(file_name)[0]]
+        while os.path.basename(dir_path) :
+            name_parts.append(os.path.basename(dir_path))
+            dir_path = os.path.dirname(dir_path)
+        all_parts.append(name_parts)
+
+    # add directories to the granules that share a name until every name is different
+    depths = [1] * len(all_parts)
+    while True :
+        stems      = ["_".join(reversed(name_parts[:depth])) for name_parts, depth in zip(all_parts, depths)]
+        stem_count = { }
+        for stem in stems :
+            stem_count[stem] = stem_count.get(stem, 0) + 1
+        shared = [index for index, stem in enumerate(stems) if stem_count[stem] > 1]
+        if not shared :
+            break
+        if not any(depths[index] < len(all_parts[index]) for index in shared) :
+            raise ValueError("Unable to give each granule its own output files, these would share names: " +
+                             ", ".join(granule_paths[index] for index in shared))
+        for index in shared :
+            depths[index] = min(depths[index] + 1, len(all_parts[index]))
+
+    return [(stem + "_fov.nc", stem + "_fg.nc") for stem in stems]
+
+def convert_granule (task) :
+    """convert a single granule, this is the work done in each pool process
+
+    :param task: a tuple of (granule path, base command line arguments, output directory, also build first guess,
+                 fov file name, fg file name), with the names from granule_output_names
+    :return: a tuple of (granule path, succeeded, dictionary of step timings in seconds, error message or None)
+    """
+
+    # this is imported here to avoid a circular import between the command line and this module
+    from shis2mirto.conversion import main as conversion_main
+
+    granule_path, base_argv, output_dir, make_first_guess, fov_name, fg_name = task
+    timings = { }
+
+    try :
+        start_time = time.time()
+        rc = conversion_main(base_argv + ['-s', granule_path, '-o', output_dir, '--fov_out', fov_name, 'create_fov_file'])
+        timings['fov'] = time.time() - start_time
+        if rc != 0 :
+            return granule_path, False, timings, "create_fov_file failed with return code " + str(rc)
+
+        if make_first_guess :
+            start_time = time.time()
+            rc = conversion_main(base_argv + ['-f', os.path.join(output_dir, fov_name), '-o', output_dir,
+                                              '--fg_out', fg_name, 'create_first_guess_file'])
+            timings['fg'] = time.time() - start_time
+            if rc != 0 :
+                return granule_path, False, timings, "create_first_guess_file failed with return code " + str(rc)
+
+    except Exception as err :
+        log.exception("Unable to convert " + granule_path)
+        return granule_path, False, timings, str(err)
+
+    return granule_path, True, timings, None
+
+def run_batch (tasks, num_processes=None) :
+    """convert a list of granules, spread across a pool of processes
+
+    :param tasks:         a list of tasks as expected by convert_granule
+    :param num_processes: how many worker processes to use; 1 runs everything in this process
+                          and None uses one process per cpu
+    :return: a list of results from convert_granule, in the same order as the tasks
+    """
+
+    if num_processes is None or num_processes <= 0 :
+        num_processes = multiprocessing.cpu_count()
+    num_processes = min(num_processes, max(len(tasks), 1))
+
+    log.info("Converting " + str(len(tasks)) + " granules using " + str(num_processes) + " processes")
+
+    results = [ ]
+    if num_processes == 1 :
+        for task in tasks :
+            results.append(convert_granule(task))
+            log.info("Finished " + results[-1][0])
+    else :
+        pool = multiprocessing.Pool(processes=num_processes)
+        try :
+            for result in pool.imap(convert_granule, tasks) :
+                results.append(result)
+                log.info("Finished " + result[0])
+        finally :
+            pool.close()
+            pool.join()
+
+    return results
+
+def format_batch_summary (results, total_seconds) :
+    """build a printable summary of the per granule timings and failures
+
+    :param results:       a list of results from convert_granule
+    :param total_seconds: the wall time of the whole batch
+    :return: a string
+    """
+
+    # granules are shown by their file names, unless some of them share one
+    file_names = [os.path.basename(result[0]) for result in results]
+    show_paths = len(set(file_names)) < len(file_names)
+
+    lines = ["%-40s %-8s %10s %10s" % ("granule", "status", "fov (s)", "fg (s)")]
+    for granule_path, succeeded, timings, error in results :
+        fov_time = ("%10.2f" % timings['fov']) if 'fov' in timings else "%10s" % "-"
+        fg_time  = ("%10.2f" % timings['fg'])  if 'fg'  in timings else "%10s" % "-"
+        granule_name = granule_path if show_paths else os.path.basename(granule_path)
+        lines.append("%-40s %-8s %s %s" % (granule_name, "ok" if succeeded else "FAILED", fov_time, fg_time))
+        if error is not None :
+            lines.append("    " + error)
+
+    num_failed = len([result for result in results if not result[1]])
+    lines.append(str(len(results)) + " granules, " + str(num_failed) + " failed, " +
+                 ("%.2f" % total_seconds) + " seconds total")
+
+    return "\n".join(lines)
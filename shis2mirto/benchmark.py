@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Time the conversion commands on synthetic SHIS data.
+
+This file is part of the shis2mirto software package. The benchmark builds synthetic SHIS
+radiance files of whatever size is asked for, along with matching wave number and
+pressure level input files, and times create_fov_file and create_first_guess_file on
+them. The first guess runs use the CannedNarrator, a local stand-in for the Virtual
+Radiosonde that returns made up profiles without needing any GFS data, so the timings
+only reflect the work done in this package. The results are returned as plain
+dictionaries that can be saved as JSON and compared between versions.
+
+"""
+__docformat__ = "restructuredtext en"
+
+import sys, os
+import time
+import shutil
+import logging
+import platform
+import tempfile
+import subprocess
+
+import numpy
+
+from shis2mirto.guidebook import *
+
+log = logging.getLogger(__name__)
+
+# the synthetic data is made to look like a SHIS flight segment
+SYNTHETIC_BASE_TIME          = 1410000000 # 2014-09-06 10:40:00 UTC
+SYNTHETIC_SECONDS_PER_RECORD = 0.5
+SYNTHETIC_FIRST_WAVE_NUMBER  = 580.0
+SYNTHETIC_WAVE_NUMBER_STEP   = 0.625
+SYNTHETIC_SCAN_ANGLES        = numpy.linspace(-40.0, 40.0, 13) # one scan across the track
+SYNTHETIC_SELECTED_STRIDE    = 4  # every 4th channel is put in the desired wave numbers
+SYNTHETIC_NUM_PRESSURE_LVLS  = 101
+
+# modules that are slow to import and shouldn't be loaded just to start the command line
+STARTUP_HEAVY_MODULES = ['netCDF4', 'pkg_resources', 'virtual_radiosonde_source.vrsNarrator']
+
+class CannedNarrator (object) :
+    """a stand-in for the VirtualRadiosondeNarrator that makes up smooth profiles
+
+    It takes the same constructor arguments and is called the same way, but it never
+    reads any GFS data.
+    """
+
+    def __init__ (self, on_dread=True, levels=None, cache=None, channels=None, **kwargs) :
+        self.levels = numpy.asarray(levels, dtype=numpy.float64)
+
+        # the profiles only depend on the levels, so build them once
+        level_ratio          = self.levels / numpy.max(self.levels)
+        self._temperature    = -60.0 + 75.0 * level_ratio          # C
+        self._rh             = 10.0 + 70.0 * level_ratio           # %
+        self._ozone_mr       = 1.0e-5 * (1.0 - level_ratio) + 1.0e-8
+
+    def __call__ (self, points) :
+        for point in points :
+            offset = 0.01 * float(point[VR_INPUT_LAT_KEY]) + 0.01 * float(point[VR_INPUT_LON_KEY])
+            yield {
+                   VR_TEMPERATURE_KEY:          self._temperature + offset,
+                   VR_PRESSURE_KEY:             self.levels.copy(),
+                   VR_RELATIVE_HUMIDITY_KEY:    self._rh.copy(),
+                   VR_OZONE_MR_KEY:             self._ozone_mr.copy(),
+                   VR_SURFACE_TEMPERATURE_KEY:  290.0 + offset,
+                   VR_SEA_SURFACE_PRESSURE_KEY: 101325.0,
+                  }
+
+def build_synthetic_shis_file (file_path, num_records, num_channels, seed=0) :
+    """create a SHIS radiance file with random radiances and a regular scan pattern
+
+    :param file_path:    where to write the file
+    :param num_records:  how many observation records to make
+    :param num_channels: how many channels each record has
+    :param seed:         the seed for the random radiances
+    """
+
+    import netCDF4 as nc
+
+    rng          = numpy.random.RandomState(seed)
+    record_index = numpy.arange(num_records)
+
+    shis_file = nc.Dataset(file_path, 'w', format="NETCDF3_CLASSIC")
+    shis_file.createDimension('record', None)
+    shis_file.createDimension('wnum',   num_channels)
+    shis_file.createDimension('one',    1)
+
+    temp_var = shis_file.createVariable(SHIS_WAVE_NUMBER_VAR_NAME, 'f8', ('wnum',))
+    temp_var[:] = SYNTHETIC_FIRST_WAVE_NUMBER + numpy.arange(num_channels) * SYNTHETIC_WAVE_NUMBER_STEP
+    temp_var = shis_file.createVariable(SHIS_FOV_ANGLE_VAR_NAME, 'f4', ('record',))
+    temp_var[:] = SYNTHETIC_SCAN_ANGLES[record_index % SYNTHETIC_SCAN_ANGLES.size]
+    temp_var = shis_file.createVariable(SHIS_LON_VAR_NAME, 'f4', ('record',))
+    temp_var[:] = -90.0 + record_index * 0.0005
+    temp_var = shis_file.createVariable(SHIS_LAT_VAR_NAME, 'f4', ('record',))
+    temp_var[:] =  30.0 + record_index * 0.0003
+    temp_var = shis_file.createVariable(SHIS_BASE_TIME_VAR_NAME, 'i4', ('one',))
+    temp_var[:] = SYNTHETIC_BASE_TIME
+    temp_var = shis_file.createVariable(SHIS_TIME_OFFSET_VAR_NAME, 'f8', ('record',))
+    temp_var[:] = record_index * SYNTHETIC_SECONDS_PER_RECORD
+
+    # write the radiances a block at a time so large files don't need to fit in memory
+    temp_var = shis_file.createVariable(SHIS_RADIANCE_VAR_NAME, 'f4', ('record', 'wnum'))
+    block_size = max(1, (16 * 1024 * 1024) // (4 * max(num_channels, 1)))
+    for start in range(0, num_records, block_size) :
+        stop = min(start + block_size, num_records)
+        temp_var[start:stop, :] = rng.uniform(0.0, 150.0, (stop - start, num_channels)).astype(numpy.float32)
+
+    shis_file.close()
+
+def build_synthetic_wave_number_file (file_path, num_channels) :
+    """create an input wave numbers file that selects part of the synthetic SHIS channels
+
+    :param file_path:    where to write the file
+    :param num_channels: how many channels the synthetic SHIS file has
+    """
+
+    import netCDF4 as nc
+
+    wavenumbers_list = (SYNTHETIC_FIRST_WAVE_NUMBER +
+                        numpy.arange(0, num_channels, SYNTHETIC_SELECTED_STRIDE) * SYNTHETIC_WAVE_NUMBER_STEP)
+
+    temp_wave_ref = nc.Dataset(file_path, 'w', format="NETCDF3_CLASSIC")
+    temp_wave_ref.createDimension('wnum', None)
+    temp_var = temp_wave_ref.createVariable(INPUT_WAVE_NUMBER_VAR_NAME, 'f8', ('wnum'))
+    temp_var[0:wavenumbers_list.size] = wavenumbers_list
+    temp_wave_ref.close()
+
+def build_synthetic_pressure_file (file_path, num_levels=SYNTHETIC_NUM_PRESSURE_LVLS) :
+    """create an input pressure levels file with log spaced levels from 0.005 to 1100 hPa
+
+    :param file_path:  where to write the file
+    :param num_levels: how many pressure levels to make
+    """
+
+    import netCDF4 as nc
+
+    plevels = numpy.logspace(numpy.log10(0.005), numpy.log10(1100.0), num_levels).astype(numpy.float32)
+
+    temp_plvls_ref = nc.Dataset(file_path, 'w', format="NETCDF3_CLASSIC")
+    temp_plvls_ref.createDimension('plvls', None)
+    temp_var = temp_plvls_ref.createVariable(INPUT_PRESSURE_LEVELS_VAR_NAME, 'f8', ('plvls'))
+    temp_var[0:plevels.size] = plevels
+    temp_plvls_ref.close()
+
+def _time_command (argv, repeat) :
+    """run a conversion command several times and return the wall time of each run"""
+
+    # this is imported here to avoid a circular import between the command line and this module
+    from shis2mirto.conversion import main as conversion_main
+
+    all_seconds = [ ]
+    for run_number in range(repeat) :
+        start_time = time.time()
+        rc         = conversion_main(argv)
+        all_seconds.append(time.time() - start_time)
+        if rc != 0 :
+            raise RuntimeError("benchmark command failed with return code " + str(rc) + ": " + " ".join(argv))
+
+    return all_seconds
+
+def _time_subprocess (argv, repeat) :
+    """run a python command line in a fresh interpreter several times and return the wall time of each run"""
+
+    all_seconds = [ ]
+    with open(os.devnull, 'w') as null_file :
+        for run_number in range(repeat) :
+            start_time = time.time()
+            rc         = subprocess.call([sys.executable] + list(argv), stdout=null_file, stderr=subprocess.STDOUT)
+            all_seconds.append(time.time() - start_time)
+            if rc != 0 :
+                raise RuntimeError("startup benchmark command failed with return code " + str(rc) + ": " + " ".join(argv))
+
+    return all_seconds
+
+def loaded_heavy_modules (module_name="shis2mirto.conversion") :
+    """find which of the STARTUP_HEAVY_MODULES a fresh interpreter loads when importing a module
+
+    :param module_name: the module to import
+    :return: a list of the heavy module names that were loaded
+    """
+
+    check_code = ("import sys, " + module_name + "; " +
+                  "print(','.join(name for name in " + repr(STARTUP_HEAVY_MODULES) + " if name in sys.modules))")
+    output     = subprocess.check_output([sys.executable, '-c', check_code])
+
+    return [name for name in output.decode('ascii').strip().split(',') if name]
+
+def run_startup_benchmarks (repeat=3, work_dir=None) :
+    """time how long the command line takes to start up, each run in a fresh interpreter
+
+    This covers importing the conversion module on its own, asking for the help text,
+    and running create_fov_file on a tiny synthetic file, where the time is almost all
+    start up cost rather than conversion work.
+
+    :param repeat:   how many times to run each command; the best time is reported
+    :param work_dir: where to put the synthetic files, a temporary directory is used if this is None
+    :return: a dictionary with the heavy modules loaded on import and a list of results
+    """
+
+    temp_dir = work_dir if work_dir is not None else tempfile.mkdtemp(prefix="shis2mirto_startup_")
+    if not os.path.isdir(temp_dir) :
+        os.makedirs(temp_dir)
+    shis_path = os.path.join(temp_dir, "shis_startup.nc")
+    wnum_path = os.path.join(temp_dir, "in_wn_startup.nc")
+    build_synthetic_shis_file(shis_path, SYNTHETIC_SCAN_ANGLES.size, 16)
+    build_synthetic_wave_number_file(wnum_path, 16)
+
+    commands = [
+                ('import',          ['-c', 'import shis2mirto.conversion']),
+                ('help',            ['-m', 'shis2mirto.conversion', 'help']),
+                ('create_fov_file', ['-m', 'shis2mirto.conversion', '-r', '90.0', '--force', '-s', shis_path,
+                                     '-a', wnum_path, '-o', temp_dir, '--fov_out', "fov_startup.nc",
+                                     'create_fov_file']),
+               ]
+
+    results = [ ]
+    try :
+        for command_name, argv in commands :
+            all_seconds = _time_subprocess(argv, repeat)
+            results.append({
+                            'command':     'startup_' + command_name,
+                            'seconds':     min(all_seconds),
+                            'all_seconds': all_seconds,
+                           })
+    finally :
+        if work_dir is None :
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    return {
+            'heavy_modules_on_import': loaded_heavy_modules(),
+            'results':                 results,
+           }
+
+def run_benchmarks (record_counts, channel_counts, repeat=3, base_argv=(), work_dir=None) :
+    """time create_fov_file and create_first_guess_file over a range of data sizes
+
+    create_fov_file is timed for every combination of record and channel counts and
+    create_first_guess_file is timed for every record count. Every record in the
+    synthetic data is accepted, so the number of observations is the number of records.
+
+    :param record_counts:  a list of record counts to build synthetic files for
+    :param channel_counts: a list of channel counts to build synthetic files for
+    :param repeat:         how many times to run each command; the best time is reported
+    :param base_argv:      any extra command line options to pass to the commands
+    :param work_dir:       where to put the synthetic files, a temporary directory is used if this is None
+    :return: a dictionary with information about the run and a list of results, including the start up timings
+    """
+
+    import netCDF4 as nc
+
+    temp_dir = work_dir if work_dir is not None else tempfile.mkdtemp(prefix="shis2mirto_bench_")
+    if not os.path.isdir(temp_dir) :
+        os.makedirs(temp_dir)
+    # every repeat has to do the work again rather than finding its output is up to date
+    base_argv   = list(base_argv) + ['-r', '90.0', '--force', '--vr_narrator', 'shis2mirto.benchmark:CannedNarrator',
+                                     '--vr_cache_dir', os.path.join(temp_dir, 'vr')]
+    plvls_path  = os.path.join(temp_dir, "in_plvls.nc")
+    build_synthetic_pressure_file(plvls_path)
+
+    results = [ ]
+    try :
+        startup = run_startup_benchmarks(repeat=repeat, work_dir=temp_dir)
+        results.extend(startup['results'])
+
+        for num_channels in channel_counts :
+            wnum_path = os.path.join(temp_dir, "in_wn_" + str(num_channels) + ".nc")
+            build_synthetic_wave_number_file(wnum_path, num_channels)
+
+            for num_records in record_counts :
+                size_name = str(num_records) + "x" + str(num_channels)
+                shis_path = os.path.join(temp_dir, "shis_" + size_name + ".nc")
+                log.info("Building synthetic SHIS file with " + str(num_records) + " records and " +
+                         str(num_channels) + " channels")
+                build_synthetic_shis_file(shis_path, num_records, num_channels)
+
+                fov_name    = "fov_" + size_name + ".nc"
+                all_seconds = _time_command(base_argv + ['-s', shis_path, '-a', wnum_path, '-o', temp_dir,
+                                                         '--fov_out', fov_name, 'create_fov_file'], repeat)
+                fov_file    = nc.Dataset(os.path.join(temp_dir, fov_name), 'r')
+                num_obs     = len(fov_file.dimensions[OUT_FOV_OBS_NUM_DIM_NAME])
+                num_sel     = len(fov_file.dimensions[OUT_FOV_NUM_SELECTED_CHANNELS_DIM_NAME])
+                fov_file.close()
+                results.append({
+                                'command':               'create_fov_file',
+                                'num_records':           num_records,
+                                'num_channels':          num_channels,
+                                'num_obs':               num_obs,
+                                'num_selected_channels': num_sel,
+                                'seconds':               min(all_seconds),
+                                'all_seconds':           all_seconds,
+                               })
+
+                # the first guess doesn't depend on the channels, so only time it once per record count
+                if num_channels == channel_counts[0] :
+                    all_seconds = _time_command(base_argv + ['-f', os.path.join(temp_dir, fov_name), '-p', plvls_path,
+                                                             '-o', temp_dir, '--fg_out', "fg_" + size_name + ".nc",
+                                                             'create_first_guess_file'], repeat)
+                    results.append({
+                                    'command':      'create_first_guess_file',
+                                    'num_records':  num_records,
+                                    'num_obs':      num_obs,
+                                    'num_plvls':    SYNTHETIC_NUM_PRESSURE_LVLS,
+                                    'seconds':      min(all_seconds),
+                                    'all_seconds':  all_seconds,
+                                   })
+
+                os.remove(shis_path)
+    finally :
+        if work_dir is None :
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    return {
+            'timestamp':               time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            'python':                  platform.python_version(),
+            'numpy':                   numpy.__version__,
+            'netCDF4':                 nc.__version__,
+            'platform':                platform.platform(),
+            'repeat':                  repeat,
+            'heavy_modules_on_import': startup['heavy_modules_on_import'],
+            'results':                 results,
+           }
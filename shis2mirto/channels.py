@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Match desired wave numbers to the channels available in SHIS data.
+
+This file is part of the shis2mirto software package. The channel matching is done with
+a single sorted search over the SHIS wave numbers. Because the same desired wave number
+list is usually matched against many SHIS files with identical spectral grids, the
+resulting index maps can be cached (in memory and optionally on disk) keyed on a hash of
+both wave number grids.
+
+"""
+__docformat__ = "restructuredtext en"
+
+import os
+import hashlib
+import logging
+import tempfile
+import numpy
+
+log = logging.getLogger(__name__)
+
+# index maps we've already calculated during this run, keyed on the hash of the grids
+_index_map_memory_cache = { }
+
+def match_wavenumbers (desired_wnums, available_wnums, tolerance=None) :
+    """find the index of the closest available channel for each desired wave number
+
+    When a desired wave number falls exactly half way between two channels the higher
+    channel is used. Desired wave numbers outside the range of the available wave numbers
+    are considered unmatched, unless a tolerance is given, in which case any desired wave
+    number further than the tolerance from its closest channel is unmatched.
+
+    >>> match_wavenumbers([1.0, 2.4, 2.5, 7.0], [1.0, 2.0, 3.0]).tolist()
+    [0, 1, 2, -1]
+    >>> match_wavenumbers([1.0, 2.4, 3.2], [1.0, 2.0, 3.0], tolerance=0.25).tolist()
+    [0, -1, 2]
+
+    :param desired_wnums:   the wave numbers we want
+    :param available_wnums: the wave numbers of the channels in the SHIS data
+    :param tolerance:       the largest acceptable distance between a desired wave number and its channel
+    :return: an integer array of channel indexes, -1 for any desired wave number that could not be matched
+    """
+
+    desired_wnums   = numpy.asarray(numpy.ma.getdata(desired_wnums),   dtype=numpy.float64).ravel()
+    available_wnums = numpy.asarray(numpy.ma.getdata(available_wnums), dtype=numpy.float64).ravel()
+
+    found_indexes = numpy.ones(desired_wnums.shape, dtype='int') * -1
+    if available_wnums.size <= 0 :
+        return found_indexes
+
+    # search a sorted copy of the available wave numbers, but remember where they came from
+    sort_order   = numpy.argsort(available_wnums, kind='mergesort')
+    sorted_wnums = available_wnums[sort_order]
+    last_index   = sorted_wnums.size - 1
+
+    # find the channels on either side of each desired wave number and pick the closer one
+    upper_index  = numpy.clip(numpy.searchsorted(sorted_wnums, desired_wnums, side='left'), 0, last_index)
+    lower_index  = numpy.clip(upper_index - 1, 0, last_index)
+    lower_dist   = desired_wnums - sorted_wnums[lower_index]
+    upper_dist   = sorted_wnums[upper_index] - desired_wnums
+    best_index   = numpy.where(lower_dist < upper_dist, lower_index, upper_index)
+
+    # check how good the fit is
+    if tolerance is None :
+        matched = (desired_wnums >= sorted_wnums[0]) & (desired_wnums <= sorted_wnums[last_index])
+    else :
+        matched = numpy.abs(sorted_wnums[best_index] - desired_wnums) <= tolerance
+
+    found_indexes[matched] = sort_order[best_index[matched]]
+
+    return found_indexes
+
+def wavenumber_grids_key (desired_wnums, available_wnums, tolerance=None) :
+    """build a key that identifies the matching of one wave number grid to another
+
+    :param desired_wnums:   the wave numbers we want
+    :param available_wnums: the wave numbers of the channels in the SHIS data
+    :param tolerance:       the tolerance used in the matching
+    :return: a hex digest string
+    """
+
+    temp_hash = hashlib.sha1()
+    temp_hash.update(numpy.ascontiguousarray(numpy.ma.getdata(desired_wnums),   dtype=numpy.float64).tobytes())
+    temp_hash.update(b"|")
+    temp_hash.update(numpy.ascontiguousarray(numpy.ma.getdata(available_wnums), dtype=numpy.float64).tobytes())
+    temp_hash.update(("|" + repr(tolerance)).encode('ascii'))
+
+    return temp_hash.hexdigest()
+
+def match_wavenumbers_cached (desired_wnums, available_wnums, tolerance=None, cache_dir=None) :
+    """match wave numbers, reusing a previously calculated index map if we have one
+
+    Index maps are always remembered for the rest of the run; if a cache directory is
+    given they are also saved there so later runs against the same grids can reuse them.
+
+    :param desired_wnums:   the wave numbers we want
+    :param available_wnums: the wave numbers of the channels in the SHIS data
+    :param tolerance:       the largest acceptable distance between a desired wave number and its channel
+    :param cache_dir:       an optional directory to save and load index maps
+    :return: an integer array of channel indexes, -1 for any desired wave number that could not be matched
+    """
+
+    key = wavenumber_grids_key(desired_wnums, available_wnums, tolerance)
+
+    if key in _index_map_memory_cache :
+        log.debug("using wave number index map from memory: " + key)
+        return _index_map_memory_cache[key].copy()
+
+    cache_path = os.path.join(cache_dir, key + ".npy") if cache_dir is not None else None
+    if cache_path is not None and os.path.exists(cache_path) :
+        log.debug("loading wave number index map from " + cache_path)
+        found_indexes = numpy.load(cache_path)
+    else :
+        found_indexes = match_wavenumbers(desired_wnums, available_wnums, tolerance=tolerance)
+
+        # save the index map so other runs can use it; write to a temporary file first so
+        # concurrent runs never see a partially written map
+        if cache_path is not None :
+            if not os.path.isdir(cache_dir) :
+                try :
+                    os.makedirs(cache_dir)
+                except OSError :
+                    if not os.path.isdir(cache_dir) :
+                        raise # it wasn't just another process making the same directory
+            temp_fd, temp_path = tempfile.mkstemp(suffix=".npy", dir=cache_dir)
+            with os.fdopen(temp_fd, 'wb') as temp_file :
+                numpy.save(temp_file, found_indexes)
+            os.rename(temp_path, cache_path)
+            log.debug("saved wave number index map to " + cache_path)
+
+    _index_map_memory_cache[key] = found_indexes
+
+    return found_indexes.copy()
@@ -23,51 +23,57 @@ This file is part of the shis2mirto software package.
 """
 __docformat__ = "restructuredtext en"
 
-import sys, os, logging, pkg_resources
-import netCDF4 as nc
+import sys, os, logging, time
 import numpy as numpy
-from datetime import datetime, timedelta
 
-import virtual_radiosonde_source.vrsNarrator as radiosonde
-from virtual_radiosonde_source.vrsNarrator import DEFAULT_CHANNELS
+# netCDF4, the virtual radiosonde and the modules that do the work for each command are only
+# imported by the commands that use them; this keeps things like --version and help fast
 
 from shis2mirto.guidebook import *
-
-CHANNELS_TEMP = DEFAULT_CHANNELS.union(set([VR_INPUT_SURFACE_TEMPERATURE_KEY,
-                                            VR_INPUT_SEA_SURFACE_PRESSURE_KEY,
-                                            VR_INPUT_OZONE_MR_KEY]))
+from shis2mirto.metrics   import RunMetrics
 
 log = logging.getLogger(__name__)
 
-def datetime_to_matlab_datenum (time):
-
-    base_date_num      = (time + timedelta(days = 366)).toordinal()
-    additional_seconds = (time - datetime(time.year, time.month, time.day, 0, 0, 0)).seconds / (24.0 * 60.0 * 60.0)
-    final_datenum      = base_date_num + additional_seconds
-
-    return final_datenum
+def get_version_string() :
+    # importlib.metadata is much faster to load than pkg_resources, which is only used on older pythons
+    try :
+        from importlib.metadata import version as package_version
+    except ImportError :
+        import pkg_resources
+        version_num = pkg_resources.require('shis2mirto')[0].version
+    else :
+        version_num = package_version('shis2mirto')
 
-def relative_humidity_to_specific_humidity (relative_humidity_ratio_profile, temperature_profile) :
-    """convert the relative humidity to a specific humidity
+    return "shis2mirto, version " + str(version_num)
 
-    :param relative_humidity_ratio_profile:
-    :param temperature_profile:
-    :return:
+# the options that change what each command writes, which are recorded in the provenance of its outputs
+FOV_PROVENANCE_OPTIONS = ("center_fov_angle", "fov_angle_range", "fov_windows", "bbox", "time_window", "wnum_tolerance",
+                          "time_zone", "output_format", "chunk_obs", "zlib", "complevel", "shuffle", "selected_only",
+                          "append", "thin_mode", "thin_km", "thin_seconds", "thin_every")
+FG_PROVENANCE_OPTIONS  = ("time_zone", "output_format", "chunk_obs", "zlib", "complevel", "shuffle", "append",
+                          "vr_narrator", "vr_planner", "vr_split_times", "gfs_grid_spacing", "gfs_time_step", "vr_native_levels",
+                          "state_select", "fg_compact")
+
+def provenance_from_options (command, options, option_dests) :
+    """start the Provenance of a command's outputs with the version and the options that matter
+
+    :param command:      the name of the command
+    :param options:      the parsed options
+    :param option_dests: the dest names of the options that change the command's output
+    :return: a Provenance, to which the inputs and grids still need to be added
     """
 
-    # qair <- rh * 2.541e6 * exp(-5415.0 / T) * 18/29
-
-    temp_rh = relative_humidity_ratio_profile * 2.541e6
-    temp_t  = numpy.exp(numpy.ones(temperature_profile.shape) * -5415.0 / temperature_profile)
+    try :
+        version = get_version_string()
+    except Exception :
+        version = "shis2mirto, version unknown" # ie. running from a source tree that was never installed
 
-    specific_humidity = temp_rh * temp_t * (18.0 / 29.0)
+    from shis2mirto.provenance import Provenance
 
-    return specific_humidity
+    provenance = Provenance(command, version)
+    provenance.add_options(dict((dest, getattr(options, dest)) for dest in option_dests))
 
-def get_version_string() :
-    version_num = pkg_resources.require('shis2mirto')[0].version
-
-    return "shis2mirto, version " + str(version_num)
+    return provenance
 
 def clean_path(string_path) :
     """
@@ -79,7 +85,69 @@ def clean_path(string_path) :
 
     return clean_path
 
-def main(argv = sys.argv[1:]):
+def load_object (object_spec) :
+    """import an object named like "package.module:ObjectName"
+
+    >>> load_object("os.path:join") is os.path.join
+    True
+
+    :param object_spec: the module path and object name, separated by a colon
+    :return: the named object
+    """
+
+    import importlib
+
+    module_name, object_name = object_spec.split(":", 1)
+
+    return getattr(importlib.import_module(module_name), object_name)
+
+def _int_list (list_string) :
+    """parse a comma separated list of integers
+
+    >>> _int_list("10, 200,3000")
+    [10, 200, 3000]
+    """
+
+    return [int(item) for item in list_string.split(",") if item.strip()]
+
+def _megabytes_to_bytes (megabytes) :
+    """convert a size in megabytes to bytes, passing None through"""
+
+    return None if megabytes is None else int(megabytes * 1024 * 1024)
+
+def output_format_from_options (options) :
+    """build the OutputFormat described by the command line options"""
+
+    from shis2mirto.ncoutput import OutputFormat
+
+    return OutputFormat(options.output_format, chunk_obs=options.chunk_obs,
+                        zlib=options.zlib, complevel=options.complevel, shuffle=options.shuffle)
+
+def options_to_argv (parser, options, skip_dests=()) :
+    """rebuild a list of command line arguments that reproduces the non-default options
+
+    :param parser:     the optparse parser the options came from
+    :param options:    the parsed options
+    :param skip_dests: the dest names of any options that should be left out
+    :return: a list of command line argument strings
+    """
+
+    argv = [ ]
+    for option in parser.option_list :
+        if option.dest is None or option.dest in skip_dests :
+            continue
+        value = getattr(options, option.dest)
+        if value == parser.defaults.get(option.dest) :
+            continue
+        if option.action == "store_true" :
+            if value :
+                argv.append(option.get_opt_string())
+        elif option.action == "store" :
+            argv.extend([option.get_opt_string(), str(value)])
+
+    return argv
+
+def main(argv = None):
     import optparse
     usage = """
 %prog [options]
@@ -120,6 +188,33 @@ examples:
     # output generation related options
     parser.add_option('-o', '--outputpath', dest='output', type='string', default='./',
                     help="set path to output directory")
+    parser.add_option('--fov_out', dest='fov_out', type='string', default=OUT_FOV_FILE_NAME,
+                    help="the name of the fov file to create in the output directory; defaults to " + OUT_FOV_FILE_NAME)
+    parser.add_option('--fg_out', dest='fg_out', type='string', default=OUT_FG_FILE_NAME,
+                    help="the name of the first guess file to create in the output directory; defaults to " + OUT_FG_FILE_NAME)
+
+    # output format related options
+    parser.add_option('--selected_only', dest='selected_only', action="store_true", default=False,
+                      help="leave the full Radiance variable out of the fov file and only read the selected " +
+                           "channels from the SHIS file; selradiances is still written")
+    parser.add_option('--format', dest='output_format', type='choice', choices=sorted(OUTPUT_FORMATS.keys()),
+                      default=DEFAULT_OUTPUT_FORMAT,
+                      help="the format of the fov and fg files: '" + OUTPUT_FORMAT_CLASSIC + "' is what the Mirto reader " +
+                           "expects, '" + OUTPUT_FORMAT_NETCDF4 + "' keeps native data types and allows chunking and " +
+                           "compression; defaults to " + DEFAULT_OUTPUT_FORMAT)
+    parser.add_option('--chunk_obs', dest='chunk_obs', type='int', default=DEFAULT_OUTPUT_CHUNK_OBS,
+                      help="the number of observations per chunk along obsnum in " + OUTPUT_FORMAT_NETCDF4 +
+                           " output; defaults to " + str(DEFAULT_OUTPUT_CHUNK_OBS))
+    parser.add_option('--zlib', dest='zlib', action="store_true", default=False,
+                      help="compress the variables in " + OUTPUT_FORMAT_NETCDF4 + " output")
+    parser.add_option('--complevel', dest='complevel', type='int', default=DEFAULT_OUTPUT_COMPRESSION_LEVEL,
+                      help="the zlib compression level, 1 to 9; defaults to " + str(DEFAULT_OUTPUT_COMPRESSION_LEVEL))
+    parser.add_option('--shuffle', dest='shuffle', action="store_true", default=False,
+                      help="use the shuffle filter along with --zlib compression")
+    parser.add_option('--fg_compact', dest='fg_compact', action="store_true", default=False,
+                      help="only write x0, p, xdim and varindx to the fg file; xa is the same as x0 and the sel* " +
+                           "variables are the varindx columns of x0 and p, as recorded in the file's '" +
+                           OUT_FG_COMPACT_ATTR_NAME + "' attribute (see expand_first_guess_file)")
 
     # data selection related options
     parser.add_option('-c', '--center_angle', dest="center_fov_angle", type='float', default=0.0,
@@ -129,11 +224,131 @@ examples:
                       help="how far to either side of the central fov angle we will look when " +
                            "selecting acceptable observations in the SHIS data; defaults to 1.5 degrees")
 
+    parser.add_option('--windows', dest="fov_windows", type='string', default=None,
+                      help="a comma separated list of name:center:range fov angle windows; create_fov_file " +
+                           "reads the SHIS data once and writes a " + (OUT_FOV_WINDOW_FILE_NAME_PATTERN % "<name>") +
+                           " file for each window, in place of --center_angle and --angle_range")
+
+    parser.add_option('--bbox', dest="bbox", type='string', default=None,
+                      help="only use the fovs inside this lon0,lat0,lon1,lat1 box (edges included); if lon0 is east " +
+                           "of lon1 the box crosses the date line")
+    parser.add_option('--time_window', dest="time_window", type='string', default=None,
+                      help="only use the fovs from this start,end time window (inclusive); each time is either " +
+                           "seconds since the epoch or a UTC date like 2014-09-06T10:40:00")
+    parser.add_option('--index_cache_dir', dest="index_cache_dir", type='string', default=None,
+                      help="a directory used to save and reuse the lat/lon and time index of each SHIS file for " +
+                           "--bbox and --time_window")
+    parser.add_option('--thin', dest="thin_mode", type='choice', choices=THIN_MODES, default=None,
+                      help="thin the selected fovs in buckets --thin_km across and --thin_seconds long: '" +
+                           THIN_MODE_PICK + "' keeps the first fov in each bucket (or every --thin_every'th one), '" +
+                           THIN_MODE_AVERAGE + "' averages each bucket into one super-observation and records how " +
+                           "many fovs went into it in " + OUT_FOV_FOV_COUNT_VAR_NAME + "; by default every fov is kept")
+    parser.add_option('--thin_km', dest="thin_km", type='float', default=DEFAULT_THIN_DISTANCE_KM,
+                      help="the width of the --thin buckets on the ground in km, 0 to only bucket by time; defaults to " +
+                           str(DEFAULT_THIN_DISTANCE_KM))
+    parser.add_option('--thin_seconds', dest="thin_seconds", type='float', default=DEFAULT_THIN_SECONDS,
+                      help="the length of the --thin buckets in seconds, 0 to only bucket by position; defaults to " +
+                           str(DEFAULT_THIN_SECONDS))
+    parser.add_option('--thin_every', dest="thin_every", type='int', default=None,
+                      help="with --thin " + THIN_MODE_PICK + " keep every this many fovs of each bucket, in record order")
+    parser.add_option('--state_select', dest="state_select", type='string', default=None,
+                      help="the state variables for varindx and the sel* variables of the fg file, as comma " +
+                           "separated segment or segment:first-last items (ie. temperature,water_vapor:20-101); " +
+                           "the segments are " + ", ".join(STATE_VECTOR_SEGMENTS) + " and levels count from 1; " +
+                           "defaults to the whole state vector")
+    parser.add_option('-l', '--wnum_tolerance', dest="wnum_tolerance", type='float', default=None,
+                      help="the largest acceptable difference between a desired wave number and the closest " +
+                           "SHIS channel; by default any desired wave number inside the SHIS spectral range is accepted")
+
+    # time related options
+    parser.add_option('-z', '--time_zone', dest="time_zone", type='choice', choices=TIME_ZONE_POLICIES,
+                      default=DEFAULT_TIME_ZONE_POLICY,
+                      help="how epoch times are converted to dates: '" + TIME_ZONE_UTC + "' treats them as UTC, '" +
+                           TIME_ZONE_LOCAL + "' shifts them to the local time zone of this machine; defaults to " +
+                           DEFAULT_TIME_ZONE_POLICY)
+
+    # performance related options
+    parser.add_option('-k', '--chunk_records', dest="chunk_records", type='int', default=None,
+                      help="stream the SHIS records through create_fov_file in blocks of this many records " +
+                           "so memory use depends on the block size rather than the file size; " +
+                           "by default all records are processed at once")
+    parser.add_option('--reader', dest="shis_reader", type='choice', choices=SHIS_READERS, default=DEFAULT_SHIS_READER,
+                      help="how to read the SHIS file: '" + SHIS_READER_MMAP + "' reads NETCDF3 classic files " +
+                           "through memory maps (other files fall back to netCDF4) and '" + SHIS_READER_NETCDF4 +
+                           "' always uses netCDF4; defaults to " + DEFAULT_SHIS_READER)
+    parser.add_option('--queue_depth', dest="queue_depth", type='int', default=None,
+                      help="read and select the SHIS records in background threads in create_fov_file, keeping up " +
+                           "to this many blocks of records queued up ahead of the writing; the blocks are -k records " +
+                           "long, or " + str(DEFAULT_PIPELINE_CHUNK_RECORDS) + " if -k isn't given")
+    parser.add_option('--force', dest="force", action="store_true", default=False,
+                      help="remake the fov and fg files even if they were already made from the same inputs, grids, " +
+                           "options and version (as recorded in their provenance attributes)")
+    parser.add_option('--append', dest="append", action="store_true", default=False,
+                      help="only add the SHIS records that aren't in the fov file yet, and only build the first guess " +
+                           "for the observations that aren't in the fg file yet; new files are made with an unlimited " +
+                           "obsnum dimension so they can be appended to")
+    parser.add_option('--workers', dest="workers", type='int', default=1,
+                      help="build the first guess in this many processes, each running the virtual radiosonde for " +
+                           "one stretch of the flight's time; the result is the same as with one; defaults to 1")
+    parser.add_option('-j', '--processes', dest="processes", type='int', default=None,
+                      help="the number of worker processes batch_convert uses; defaults to one per cpu")
+    parser.add_option('--vr_cache_dir', dest="vr_cache_dir", type='string', default=DEFAULT_VR_CACHE_DIR,
+                      help="the root of the persistent cache for virtual radiosonde GFS data; defaults to " +
+                           DEFAULT_VR_CACHE_DIR)
+    parser.add_option('--vr_cache_max_mb', dest="vr_cache_max_mb", type='float', default=None,
+                      help="the largest size in MB the virtual radiosonde cache is allowed to grow to " +
+                           "before least recently used entries are removed")
+    parser.add_option('--vr_cache_max_age', dest="vr_cache_max_age", type='float', default=None,
+                      help="remove virtual radiosonde cache entries that haven't been used in this many days")
+    parser.add_option('--vr_narrator', dest="vr_narrator", type='string', default=None,
+                      help="use a different narrator class in place of the virtual radiosonde, " +
+                           "given as package.module:ClassName (ie. shis2mirto.benchmark:CannedNarrator)")
+    parser.add_option('--vr_planner', dest="vr_planner", action="store_true", default=False,
+                      help="only ask the virtual radiosonde for each distinct GFS grid corner and time once, " +
+                           "and interpolate to the observations from those profiles")
+    parser.add_option('--vr_split_times', dest="vr_split_times", action="store_true", default=False,
+                      help="keep the virtual radiosonde GFS data for each forecast file in its own cache entry, by " +
+                           "asking for each GFS output time separately and interpolating between them here")
+    parser.add_option('--vr_native_levels', dest="vr_native_levels", action="store_true", default=False,
+                      help="ask the virtual radiosonde for profiles on the GFS pressure levels and remap them to the " +
+                           "requested levels here, with log-pressure weights worked out once for all the profiles; " +
+                           "requested levels above or below all the GFS levels are still asked for directly")
+    parser.add_option('--gfs_grid_spacing', dest="gfs_grid_spacing", type='float', default=GFS_GRID_SPACING_DEGREES,
+                      help="the spacing in degrees of the GFS grid used by the virtual radiosonde, needed by " +
+                           "--vr_planner; defaults to " + str(GFS_GRID_SPACING_DEGREES))
+    parser.add_option('--gfs_time_step', dest="gfs_time_step", type='float', default=GFS_FORECAST_STEP_HOURS,
+                      help="the number of hours between the GFS times used by the virtual radiosonde, needed by " +
+                           "--vr_planner; defaults to " + str(GFS_FORECAST_STEP_HOURS))
+    parser.add_option('--wnum_cache_dir', dest="wnum_cache_dir", type='string', default=None,
+                      help="a directory used to save and reuse the wave number to channel index maps")
+
+    # instrumentation related options
+    parser.add_option('--metrics_json', dest="metrics_json", type='string', default=None,
+                      help="save the wall time, bytes read and written and peak memory growth of each stage of the " +
+                           "command, and the peak memory of the whole run, as JSON to this file")
+    parser.add_option('--profile', dest="profile", type='string', default=None,
+                      help="run the command under cProfile and save the stats to this file (see the pstats module)")
+
+    # benchmark related options
+    parser.add_option('--bench_records', dest="bench_records", type='string', default="1000,5000",
+                      help="a comma separated list of the record counts the benchmark uses; defaults to 1000,5000")
+    parser.add_option('--bench_channels', dest="bench_channels", type='string', default="1000,4000",
+                      help="a comma separated list of the channel counts the benchmark uses; defaults to 1000,4000")
+    parser.add_option('--bench_repeat', dest="bench_repeat", type='int', default=3,
+                      help="how many times the benchmark runs each command, the best time is reported; defaults to 3")
+    parser.add_option('--bench_output', dest="bench_output", type='string', default=None,
+                      help="save the benchmark results as JSON to this file instead of printing them")
+
     # parse the user options from the command line
-    options, args = parser.parse_args()
+    options, args = parser.parse_args(argv)
     if options.self_test:
-        import doctest
+        import doctest, importlib
         doctest.testmod()
+        for module_name in ("batch",      "benchmark", "channels",  "extraction", "firstguess", "fov",
+                            "metrics",    "ncclassic", "ncoutput",  "obsindex",   "physics",    "pipeline",
+                            "provenance", "statevector", "thinning", "timeconv",  "vrcache",    "vremap",
+                            "vrplanner") :
+            doctest.testmod(importlib.import_module("shis2mirto." + module_name))
         sys.exit(2)
 
     # set up the logging level based on the options the user selected on the command line
@@ -147,6 +362,9 @@ examples:
     if options.version :
         print (get_version_string() + '\n')
 
+    # the stages of the command are measured as it runs
+    metrics = RunMetrics(args[0] if args else None)
+
     commands = {}
     prior = None
     prior = dict(locals())
@@ -162,6 +380,8 @@ examples:
         :return:
         """
 
+        import netCDF4 as nc
+
         log.info("Generating input wavenumber file for testing")
 
         wavenumbers_list = numpy.array(
@@ -326,6 +546,8 @@ examples:
         :return:
         """
 
+        import netCDF4 as nc
+
         log.info("Writing example pressure levels to file")
 
         plevels = numpy.array([  4.99999989e-03,   1.61000006e-02,   3.84000018e-02,
@@ -376,161 +598,225 @@ examples:
         """generate an fov file from an input SHIS data file
 
         This option generates a properly formatted fov.nc file from a Scanning HIS data file.
+        If --windows is given, the SHIS data is read once and a separate fov_<name>.nc file
+        is written for each fov angle window.
 
         Examples:
          python -m shis2mirto.shis2mirto create_fov_file
+         python -m shis2mirto.conversion -s SHIS.nc -a in_wn.nc --windows nadir:0:1.5,left30:-30:1.5,right30:30:1.5 create_fov_file
         """
 
+        import netCDF4 as nc
+        from shis2mirto.fov        import (select_channels, parse_fov_windows, count_window_obs, iter_window_blocks,
+                                           new_record_mask, FovFileWriter)
+        from shis2mirto.ncclassic  import open_shis_file
+        from shis2mirto.obsindex   import parse_bbox, parse_time_window, observation_index_for_file
+        from shis2mirto.thinning   import Thinning, plan_thinning, SuperObservationBuilder
+        from shis2mirto.provenance import is_up_to_date
+
         log.info("Generating FOV file from SHIS data")
 
         # we need SHIS input and a base FOV file to generate input
         if (options.shis_input is None) or (options.wnum_input is None) :
             log.warn("Incomplete input, unable to generate FOV file")
-            return
-
-        # pull some things from the options
-        center_angle  = options.center_fov_angle
-        angle_range   = options.fov_angle_range
-        shis_file     = nc.Dataset(clean_path(options.shis_input), 'r')
-        wn_base_file  = nc.Dataset(clean_path(options.wnum_input), 'r')
-
-        desired_wnums = numpy.sort(wn_base_file.variables[INPUT_WAVE_NUMBER_VAR_NAME][:])
+            return 1
+
+        # figure out which fov angle windows we're making files for
+        if options.fov_windows is not None :
+            try :
+                windows = parse_fov_windows(options.fov_windows)
+            except ValueError as err :
+                log.warn(str(err))
+                return 1
+            out_names = [OUT_FOV_WINDOW_FILE_NAME_PATTERN % name for name, center_angle, angle_range in windows]
+        else :
+            windows   = [(None, options.center_fov_angle, options.fov_angle_range)]
+            out_names = [options.fov_out]
+
+        # and whether the records are limited to a box or a time window
+        try :
+            bbox        = parse_bbox(options.bbox)               if options.bbox        is not None else None
+            time_window = parse_time_window(options.time_window) if options.time_window is not None else None
+        except ValueError as err :
+            log.warn(str(err))
+            return 1
+
+        # and whether the fovs are being thinned
+        thinning = None
+        if options.thin_mode is not None :
+            try :
+                thinning = Thinning(options.thin_mode, distance_km=options.thin_km, seconds=options.thin_seconds,
+                                    every=options.thin_every)
+            except ValueError as err :
+                log.warn(str(err))
+                return 1
+        fov_count = thinning is not None and thinning.mode == THIN_MODE_AVERAGE
+        if fov_count and options.append :
+            # the super-observations' times are averages, so we couldn't tell which records are already in a file
+            log.warn("Unable to --append to files of " + THIN_MODE_AVERAGE + " thinned super-observations")
+            return 1
+
+        # pull some things from the options; the read ahead threads need more than one block to overlap
+        chunk_records = options.chunk_records
+        if options.queue_depth and not chunk_records :
+            chunk_records = DEFAULT_PIPELINE_CHUNK_RECORDS
+        with metrics.stage("open_inputs") :
+            shis_file    = open_shis_file(clean_path(options.shis_input), reader=options.shis_reader)
+            wn_base_file = nc.Dataset(clean_path(options.wnum_input), 'r')
+
+        with metrics.stage("read_wavenumbers") :
+            desired_wnums = numpy.sort(wn_base_file.variables[INPUT_WAVE_NUMBER_VAR_NAME][:])
         log.debug("desired wave numbers: " + str(desired_wnums))
 
-        # look through the wave numbers in the shis file and figure out the appropriately matching
-        # indexes to the wave numbers we want
-        found_indexes  = numpy.ones(desired_wnums.shape, dtype='int') * -1
-        temp_wnums     = shis_file.variables[SHIS_WAVE_NUMBER_VAR_NAME][:]
-        current_target = 0
-        for index in range(0, temp_wnums.size - 1) :
-            if current_target < found_indexes.size :
-                desired = desired_wnums[current_target]
-                if   desired == temp_wnums[index] :
-                    found_indexes[current_target] = index
-                    current_target += 1
-                elif desired == temp_wnums[index + 1] :
-                    found_indexes[current_target] = index + 1
-                    current_target += 1
-                elif (desired > temp_wnums[index]) and (desired < temp_wnums[index + 1]) :
-
-                    if (desired - temp_wnums[index]) < (temp_wnums[index + 1] - desired) :
-                        found_indexes[current_target] = index
-                        current_target += 1
-                    else :
-                        found_indexes[current_target] = index + 1
-                        current_target += 1
-
-                    # TODO need to check the tolerance of this fit
-
-        # if we were unable to find a matching wave number for any of the desired
-        # wave numbers, stop now
-        if numpy.min(found_indexes) < 0 :
-            log.warn("Unable to find desired wave numbers in SHIS file")
-            return
-
-        # figure out where the acceptable fov angles fall
-        temp_angles = shis_file.variables[SHIS_FOV_ANGLE_VAR_NAME][:]
-        angle_mask  = (temp_angles >= (center_angle - angle_range)) & (temp_angles <= (center_angle + angle_range))
-        num_obs     = numpy.sum(angle_mask)
+        # if the files were already made from the same inputs and options there's nothing to do
+        out_paths  = [os.path.join(options.output, out_name) for out_name in out_names]
+        provenance = provenance_from_options("create_fov_file", options, FOV_PROVENANCE_OPTIONS)
+        provenance.add_input("shis", clean_path(options.shis_input))
+        provenance.add_grid("wavenumbers", desired_wnums)
+        with metrics.stage("check_up_to_date") :
+            up_to_date = not options.force and is_up_to_date(out_paths, provenance)
+        if up_to_date :
+            log.info(", ".join(out_names) + " already up to date, skipping (use --force to remake)")
+            return 0
+
+        # figure out the indexes of the channels in the shis file that best match the wave numbers we want;
+        # if we were unable to find a matching wave number for any of the desired wave numbers, stop now
+        try :
+            with metrics.stage("match_wavenumbers") :
+                found_indexes = select_channels(shis_file, desired_wnums, tolerance=options.wnum_tolerance,
+                                                cache_dir=clean_path(options.wnum_cache_dir))
+        except ValueError as err :
+            log.warn(str(err))
+            return 1
 
         # find the global variables for our output fov file
-        num_channels          = temp_wnums.size
+        with metrics.stage("read_wavenumbers") :
+            temp_all_wavenums = shis_file.variables[SHIS_WAVE_NUMBER_VAR_NAME][:]
+            temp_base_time    = shis_file.variables[SHIS_BASE_TIME_VAR_NAME][0]
+        num_channels          = temp_all_wavenums.size
         num_selected_channels = found_indexes.size
+        log.debug("base time: " + str(temp_base_time))
+
+        # find the records inside the box and time window; the index for the granule is reused if
+        # we've built it before, and only these records are counted, read and written
+        subset_mask = None
+        if bbox is not None or time_window is not None :
+            with metrics.stage("select_region") :
+                obs_index   = observation_index_for_file(shis_file, clean_path(options.shis_input),
+                                                         cache_dir=clean_path(options.index_cache_dir))
+                subset_mask = obs_index.select(bbox=bbox, time_window=time_window)
+            log.debug("records in the box and time window: " + str(numpy.count_nonzero(subset_mask)))
+
+        def _count_obs (record_filters) :
+            """count each window's observations after any thinning
+
+            :return: the record filters to read with (picking thins by filtering the records), the
+                     number of observations in each window and the super-observation builders if averaging
+            """
+
+            if thinning is None :
+                with metrics.stage("count_obs") :
+                    return record_filters, count_window_obs(shis_file, windows, block_size=chunk_records,
+                                                            record_filters=record_filters), None
+
+            with metrics.stage("plan_thinning") :
+                plans = plan_thinning(shis_file, windows, thinning, record_filters=record_filters)
+            window_num_obs = [plan.num_obs for plan in plans]
+            if thinning.mode == THIN_MODE_PICK :
+                return [plan.record_mask for plan in plans], window_num_obs, None
+
+            # the plans leave out the fovs that can't go in a bucket, so they aren't read at all
+            return ([plan.record_mask for plan in plans], window_num_obs,
+                    [SuperObservationBuilder(thinning, plan.bucket_sizes) for plan in plans])
+
+        # build the output files
+        # TODO, check existence for dir and file
+        out_format     = output_format_from_options(options)
+        radiance_dtype = shis_file.variables[SHIS_RADIANCE_VAR_NAME].dtype
+        if options.append :
+            # add to any existing files, skipping the records they already have
+            out_fov_files  = [ ]
+            record_filters = [ ]
+            for out_path in out_paths :
+                if os.path.exists(out_path) :
+                    try :
+                        with metrics.stage("create_output") :
+                            out_fov_file = FovFileWriter.append_to(out_path, found_indexes, provenance=provenance)
+                    except ValueError as err :
+                        log.warn(str(err))
+                        for out_fov_file in out_fov_files :
+                            out_fov_file.close()
+                        return 1
+                    with metrics.stage("find_new_records") :
+                        new_mask = new_record_mask(shis_file, out_fov_file.epoch_seconds())
+                    record_filters.append(new_mask if subset_mask is None else new_mask & subset_mask)
+                else :
+                    with metrics.stage("create_output") :
+                        out_fov_file = FovFileWriter(out_path, None, temp_all_wavenums, found_indexes, temp_base_time,
+                                                     radiance_dtype=radiance_dtype, output_format=out_format,
+                                                     selected_only=options.selected_only, fov_count=fov_count,
+                                                     provenance=provenance)
+                    record_filters.append(subset_mask)
+                out_fov_files.append(out_fov_file)
+            record_filters, window_num_obs, builders = _count_obs(record_filters)
+        else :
+            # figure out how many of the fov angles are acceptable in each window; this is done one block
+            # of records at a time so that in streaming mode we never hold every record in memory
+            record_filters = None if subset_mask is None else [subset_mask] * len(windows)
+            record_filters, window_num_obs, builders = _count_obs(record_filters)
+            with metrics.stage("create_output") :
+                out_fov_files  = [FovFileWriter(out_path, num_obs, temp_all_wavenums, found_indexes, temp_base_time,
+                                                radiance_dtype=radiance_dtype, output_format=out_format,
+                                                selected_only=options.selected_only, fov_count=fov_count,
+                                                provenance=provenance)
+                                  for out_path, num_obs in zip(out_paths, window_num_obs)]
+
+        # existing files keep whatever radiances they were made with, so the full spectrum
+        # is only skipped when none of the files need it
+        selected_only = all(out_fov_file.selected_only for out_fov_file in out_fov_files)
 
         log.debug("radiances shape:  " + str(shis_file.variables[SHIS_RADIANCE_VAR_NAME].shape))
-        log.debug("num obs:          " + str(num_obs))
+        log.debug("num obs:          " + str(window_num_obs if options.fov_windows is not None else window_num_obs[0]))
         log.debug("num channels:     " + str(num_channels))
         log.debug("num sel channels: " + str(num_selected_channels))
-
-        # build the output file
-        # TODO, check existence for dir and file
-        out_fov_file = nc.Dataset(os.path.join(options.output, OUT_FOV_FILE_NAME), 'w', format="NETCDF3_CLASSIC")
-
-        # create the global dimensions we're going to need
-        out_fov_file.createDimension(OUT_FOV_OBS_NUM_DIM_NAME,               size=num_obs)
-        out_fov_file.createDimension(OUT_FOV_NUM_CHANNELS_DIM_NAME,          size=num_channels)
-        out_fov_file.createDimension(OUT_FOV_NUM_SELECTED_CHANNELS_DIM_NAME, size=num_selected_channels)
-
-        # put in the longitude and latitude variables
-        temp_lon = shis_file.variables[SHIS_LON_VAR_NAME][angle_mask]
-        temp_var = out_fov_file.createVariable(OUT_FOV_LON_VAR_NAME, 'f8', (OUT_FOV_OBS_NUM_DIM_NAME))
-        temp_var[0:num_obs] = temp_lon
-        temp_lat = shis_file.variables[SHIS_LAT_VAR_NAME] [angle_mask]
-        temp_var = out_fov_file.createVariable(OUT_FOV_LAT_VAR_NAME,  'f8', (OUT_FOV_OBS_NUM_DIM_NAME))
-        temp_var[0:num_obs] = temp_lat
-
-        # copy the various time variables
-        temp_base_time = shis_file.variables[SHIS_BASE_TIME_VAR_NAME][0]
-        print("base time: " + str(temp_base_time))
-        temp_var = out_fov_file.createVariable(OUT_FOV_BASE_TIME_VAR_NAME, 'f8')
-        temp_var.assignValue(temp_base_time)
-        temp_time_offset = shis_file.variables[SHIS_TIME_OFFSET_VAR_NAME][angle_mask]
-        temp_var = out_fov_file.createVariable(OUT_FOV_TIME_OFFSET_VAR_NAME, 'f8', (OUT_FOV_OBS_NUM_DIM_NAME))
-        temp_var[0:num_obs] = temp_time_offset
-
-        # also need the time in the matlab datenum format
-        # "TimeFracDay == is the equivalent of the matlab datenum function, 1 corresponds to Jan-1-0000 "
-        total_epoc_secs = temp_time_offset + temp_base_time
-        matlab_times = numpy.zeros(total_epoc_secs.size, dtype=numpy.float32)
-        for index in range(0, total_epoc_secs.size) :
-            matlab_times[index] = datetime_to_matlab_datenum(datetime.fromtimestamp(total_epoc_secs[index]))
-        temp_var = out_fov_file.createVariable(OUT_FOV_MATLAB_DATENUM_TIME_VAR_NAME, 'f8', OUT_FOV_OBS_NUM_DIM_NAME)
-        temp_var[0:num_obs] = matlab_times
-
-        # put in the fov angles
-        temp_fov_angles = temp_angles[angle_mask]
-        temp_var = out_fov_file.createVariable(OUT_FOV_FOV_ANGLE_VAR_NAME, 'f8', (OUT_FOV_OBS_NUM_DIM_NAME))
-        temp_var[0:num_obs] = temp_fov_angles
-
-        # get the full list of radiances
-        rad_shape          = shis_file.variables[SHIS_RADIANCE_VAR_NAME].shape
-        # go through and pull out the appropriate observations
-        all_obs_radiances = None
-        for record_index in range(0, rad_shape[0]) :
-            if angle_mask[record_index] :
-                if all_obs_radiances is None:
-                    all_obs_radiances = shis_file.variables[SHIS_RADIANCE_VAR_NAME][record_index]
-                else :
-                    all_obs_radiances = numpy.append(all_obs_radiances, shis_file.variables['radiance'][record_index])
-        all_obs_radiances = numpy.reshape(all_obs_radiances, (num_obs, num_channels))
-        """ TODO, why doesn't this strategy work?
-        temp_angle_mask_3d = numpy.reshape(numpy.tile(numpy.reshape(angle_mask, (1,angle_mask.size)), rad_shape[0]), rad_shape) # make a mask for the radiances corresponding to the good fov angles
-        print("3d angle mask shape:  " + str(temp_angle_mask_3d.shape))
-        all_obs_radiances = numpy.reshape(shis_file.variables[SHIS_RADIANCE_VAR_NAME][temp_angle_mask_3d], (num_obs, num_channels))
-        """
-        temp_var = out_fov_file.createVariable(OUT_FOV_RADIANCE_VAR_NAME, 'f8', (OUT_FOV_OBS_NUM_DIM_NAME, 'channels'))
-        temp_var[0:num_obs, 0:num_channels] = all_obs_radiances
-
-        # get the full list of wave numbers
-        temp_all_wavenums = shis_file.variables[SHIS_WAVE_NUMBER_VAR_NAME][:]
-        temp_var = out_fov_file.createVariable(OUT_FOV_WAVE_NUMBER_VAR_NAME, 'f8', (OUT_FOV_NUM_CHANNELS_DIM_NAME))
-        temp_var[0:num_channels] = temp_all_wavenums
-
-        # get the selected wave numbers
-        selected_wavenums = temp_all_wavenums[found_indexes]
-        temp_var = out_fov_file.createVariable(OUT_FOV_SELECTED_WAVE_NUMBER_VAR_NAME, 'f8', (OUT_FOV_NUM_SELECTED_CHANNELS_DIM_NAME))
-        temp_var[0:num_selected_channels] = selected_wavenums
-
-        # get the indexes of the selected channels
-        temp_var = out_fov_file.createVariable(OUT_FOV_SELECTED_CHANNEL_IDX_VAR_NAME, 'f8', (OUT_FOV_NUM_SELECTED_CHANNELS_DIM_NAME))
-        temp_var[0:num_selected_channels] = found_indexes + 1 # we will use matlab indexing here
-
-        # get just the selected radiances
-        selected_radiances = None
-        for obs_number in range(0, num_obs) :
-            if selected_radiances is None:
-                selected_radiances = all_obs_radiances[obs_number][found_indexes]
-            else :
-                selected_radiances = numpy.append(selected_radiances, all_obs_radiances[obs_number][found_indexes])
-        selected_radiances = numpy.reshape(selected_radiances, (num_obs, num_selected_channels))
-        temp_var = out_fov_file.createVariable(OUT_FOV_SELECTED_RADIANCE_VAR_NAME, 'f8',
-                                               (OUT_FOV_OBS_NUM_DIM_NAME, OUT_FOV_NUM_SELECTED_CHANNELS_DIM_NAME))
-        temp_var[0:num_obs, 0:num_selected_channels] = selected_radiances
-
-        # close the file
-        out_fov_file.close()
-
-        log.info("Finished saving fov.nc to file")
+        if chunk_records :
+            log.debug("streaming records in blocks of " + str(chunk_records))
+        if selected_only :
+            log.debug("only reading the selected channels")
+        if options.queue_depth :
+            log.debug("reading up to " + str(options.queue_depth) + " blocks ahead in background threads")
+        if thinning is not None :
+            log.debug("thinning (" + thinning.mode + ") in buckets of " + str(thinning.distance_km) + " km and " +
+                      str(thinning.seconds) + " seconds")
+
+        # go through the records, one block at a time, and write out the acceptable observations
+        # to each window's file (without streaming all the records are handled as a single block);
+        # reading and selecting each block is measured separately from writing it (with --queue_depth
+        # the extract_radiances time is only the time spent waiting for the background threads)
+        all_window_blocks = iter_window_blocks(shis_file, found_indexes, windows, block_size=chunk_records,
+                                               time_zone=options.time_zone, record_filters=record_filters,
+                                               queue_depth=options.queue_depth, selected_only=selected_only)
+        for window_blocks in metrics.timed_iter("extract_radiances", all_window_blocks) :
+            if builders is not None :
+                # only the super-observations whose buckets are complete come out of each block
+                with metrics.stage("thin_fovs") :
+                    window_blocks = [builder.add(fov_block) for builder, fov_block in zip(builders, window_blocks)]
+            with metrics.stage("write_fov") :
+                for out_fov_file, fov_block in zip(out_fov_files, window_blocks) :
+                    if fov_block.num_obs > 0 :
+                        out_fov_file.write_block(fov_block)
+
+        if builders is not None and any(builder.num_pending for builder in builders) :
+            log.warn("Some thinning buckets never got all of their fovs and weren't written")
+
+        # close the files
+        with metrics.stage("write_fov") :
+            for out_fov_file in out_fov_files :
+                out_fov_file.close()
+        for out_path in out_paths :
+            metrics.add_output(out_path)
+
+        log.info("Finished saving " + ", ".join(out_names) + " to file")
 
     def create_first_guess_file (*args) :
         """build a first guess file based on a list of pressure levels and an fov.nc file
@@ -542,170 +828,307 @@ examples:
         :return:
         """
 
+        import netCDF4 as nc
+        from shis2mirto.fov         import read_fov_file
+        from shis2mirto.firstguess  import (make_run_narrator, FirstGuessProduct, build_first_guess,
+                                            build_first_guess_parallel, write_first_guess_file,
+                                            first_guess_num_obs, append_first_guess_file)
+        from shis2mirto.statevector import StateVectorLayout
+        from shis2mirto.provenance  import is_up_to_date
+        from shis2mirto.vrcache     import gfs_forecast_keys, vr_cache_run_dir, vr_cache_entry_dirs, prune_vr_cache
+        from shis2mirto.vremap      import native_source_levels
+
         log.info("Generating first guess file from GFS data and fov file positioning information")
 
         # we need access to the fov file and an input pressure list in order to run the
         # virtual radiosonde, so if we don't have those, just stop
         if options.fov_base is None or options.plevels_input is None :
             log.warn("Unable to create first guess file without input fov file and input pressure levels.")
-            return
+            return 1
 
         log.info("Loading lon/lat and times from FOV file")
 
         # open the fov file and pull the lon / lat and time information
-        fov_file   = nc.Dataset(clean_path(options.fov_base),      'r')
-        lon_data   = fov_file.variables[OUT_FOV_LON_VAR_NAME][:]
-        lat_data   = fov_file.variables[OUT_FOV_LAT_VAR_NAME][:]
-        time_data  = fov_file.variables[OUT_FOV_TIME_OFFSET_VAR_NAME][:] + fov_file.variables[OUT_FOV_BASE_TIME_VAR_NAME][0]
-        fov_file.close()
-
-        # build the list of time / lon / lat dictionaries
-        dt_times   = [ ]
-        # convert the epoch seconds format to datetimes
-        for epoch_seconds in time_data :
-            dt_times.append(datetime.fromtimestamp(epoch_seconds))
-        # make the list of dictionaries representing each point
-        desired_points = [ ]
-        for index in range(0, lon_data.size) :
-            desired_points.append({
-                                    VR_INPUT_DATETIME_KEY: dt_times[index],
-                                    VR_INPUT_LAT_KEY:      lat_data[index],
-                                    VR_INPUT_LON_KEY:      lon_data[index]
-                                  })
-        num_obs = len(desired_points)
+        with metrics.stage("read_fov") :
+            fov_product = read_fov_file(clean_path(options.fov_base), include_radiances=False)
+
+        # when appending, only build the first guess for the fov observations past the ones already in the fg file
+        fg_path   = os.path.join(options.output, options.fg_out)
+        append_fg = options.append and os.path.exists(fg_path)
+        if append_fg :
+            num_done = first_guess_num_obs(fg_path)
+            if num_done > fov_product.num_obs :
+                log.warn("Unable to append to " + fg_path + " because it has more observations than the fov file.")
+                return 1
+            fov_product = fov_product.subset(numpy.arange(fov_product.num_obs) >= num_done)
+            log.info("Found " + str(fov_product.num_obs) + " new observations after the " + str(num_done) + " in the fg file")
+            if fov_product.num_obs <= 0 :
+                return 0
+
+        dt_times = fov_product.datetimes(time_zone=options.time_zone)
 
         log.info("Loading pressure levels from file")
 
-        #print("Number of selected points: " + str(num_obs))
-
         # open the pressure levels file and get the list of pressure levels
-        plvls_file = nc.Dataset(clean_path(options.plevels_input), 'r')
-        plvls_data = numpy.sort(plvls_file.variables[INPUT_PRESSURE_LEVELS_VAR_NAME][:])[::-1]
-        num_plvls  = plvls_data.size
-        plvls_file.close()
+        with metrics.stage("read_pressure_levels") :
+            plvls_file = nc.Dataset(clean_path(options.plevels_input), 'r')
+            plvls_data = numpy.sort(plvls_file.variables[INPUT_PRESSURE_LEVELS_VAR_NAME][:])[::-1]
+            plvls_file.close()
+
+        # figure out which state variables are selected before doing the expensive part
+        try :
+            selected_state = StateVectorLayout(numpy.size(plvls_data)).selection_indexes(options.state_select)
+        except ValueError as err :
+            log.warn(str(err))
+            return 1
+        if append_fg and options.state_select is not None :
+            log.info("Appending to " + fg_path + " with the state variables it was made with, not --state_select")
+
+        # if the file was already made from the same fov file, levels, options and GFS data there's nothing
+        # to do; an fov file that was remade from the same inputs doesn't count as a change, but GFS forecast
+        # files that have turned up in (or changed in) the cache entries since the file was made do
+        cache_root = clean_path(options.vr_cache_dir)
+        gfs_keys   = [ ]
+        if fov_product.num_obs > 0 :
+            gfs_keys = gfs_forecast_keys(min(dt_times), max(dt_times), time_step_hours=options.gfs_time_step)
+        provenance = provenance_from_options("create_first_guess_file", options, FG_PROVENANCE_OPTIONS)
+        provenance.add_input("fov", clean_path(options.fov_base), prefer_fingerprint=True)
+        provenance.add_grid("pressure_levels", plvls_data)
+        for gfs_key in gfs_keys :
+            provenance.add_directory("gfs " + gfs_key, os.path.join(cache_root, gfs_key))
+        with metrics.stage("check_up_to_date") :
+            up_to_date = not options.force and is_up_to_date([fg_path], provenance)
+        if up_to_date :
+            log.info(options.fg_out + " already up to date, skipping (use --force to remake)")
+            return 0
+
+        # call the virtual radiosonde to get data to start with, reusing any GFS data we already
+        # have in the persistent cache (one entry for the run, or one for each GFS forecast file the
+        # observations need with --vr_split_times); when no fovs made it
+        # into the fov file (ie. no fov angles in the window, or nothing in the box) there's
+        # nothing to ask for and the first guess file is left empty to match it
+        cache_dirs = [ ]
+        narrator_class = None if options.vr_narrator is None else load_object(options.vr_narrator)
+        native_levels  = native_source_levels(GFS_PRESSURE_LEVELS_HPA, plvls_data) if options.vr_native_levels else None
+        if fov_product.num_obs <= 0 :
+            log.warn(options.fov_base + " has no observations, the first guess file will be empty")
+            layout     = StateVectorLayout(numpy.size(plvls_data))
+            fg_product = FirstGuessProduct(layout, layout.allocate(0), layout.allocate(0))
+        else :
+            if options.vr_split_times :
+                cache_dirs = vr_cache_entry_dirs(cache_root, min(dt_times), max(dt_times),
+                                                 time_step_hours=options.gfs_time_step)
+            else :
+                cache_dirs = [vr_cache_run_dir(cache_root, min(dt_times), time_step_hours=options.gfs_time_step)]
+            with metrics.stage("virtual_radiosonde") :
+                if options.workers > 1 :
+                    fg_product = build_first_guess_parallel(fov_product, plvls_data, cache_root, options.workers,
+                                                            narrator_class=narrator_class, time_zone=options.time_zone,
+                                                            use_planner=options.vr_planner,
+                                                            grid_spacing=options.gfs_grid_spacing,
+                                                            time_step_hours=options.gfs_time_step,
+                                                            native_levels=native_levels,
+                                                            split_times=options.vr_split_times)
+                else :
+                    narrator   = make_run_narrator(plvls_data if native_levels is None else native_levels,
+                                                   cache_root, min(dt_times), narrator_class=narrator_class,
+                                                   split_times=options.vr_split_times,
+                                                   time_step_hours=options.gfs_time_step)
+                    fg_product = build_first_guess(fov_product, plvls_data, narrator, time_zone=options.time_zone,
+                                                   use_planner=options.vr_planner, grid_spacing=options.gfs_grid_spacing,
+                                                   time_step_hours=options.gfs_time_step, native_levels=native_levels)
+
+        # record the GFS data as the narrator left it, including anything it just fetched
+        for gfs_key in gfs_keys :
+            provenance.add_directory("gfs " + gfs_key, os.path.join(cache_root, gfs_key))
+
+        log.info("Creating fg.nc file")
 
-        log.info("Running Virtual Radiosonde code")
+        # create the first guess file
+        # TODO, check existence for dir and file
+        if append_fg :
+            try :
+                with metrics.stage("write_fg") :
+                    append_first_guess_file(fg_product, fg_path, provenance=provenance)
+            except ValueError as err :
+                log.warn(str(err))
+                return 1
+        else :
+            with metrics.stage("write_fg") :
+                write_first_guess_file(fg_product, fg_path, output_format=output_format_from_options(options),
+                                       unlimited_obs=options.append, selected_indexes=selected_state,
+                                       compact=options.fg_compact, provenance=provenance)
+        metrics.add_output(fg_path)
 
-        # call the virtual radiosonde to get data to start with
-        stamp = datetime.now().strftime('%s')
-        cache_dir = os.path.join('/tmp/vr/', stamp)
-        if not os.path.exists(cache_dir) :
-            os.mkdir(cache_dir)
-        # confirmed that the interpolation kwarg is only for temporal interpolation (spatial interpolation is always bilinear)
-        # TODO, may want to have a user knob to control temporal interpolation type
-        src = radiosonde.VirtualRadiosondeNarrator(on_dread=True, levels=plvls_data, cache=cache_dir, channels=CHANNELS_TEMP)
-        results = list(src(desired_points))
+        log.info("Finished saving fg.nc to file")
 
-        #print("original pressures: " + str(plvls_data))
+        # keep the cache within its limits, but don't throw away what we just used
+        if options.vr_cache_max_mb is not None or options.vr_cache_max_age is not None :
+            with metrics.stage("prune_vr_cache") :
+                prune_vr_cache(cache_root, max_bytes=_megabytes_to_bytes(options.vr_cache_max_mb),
+                               max_age_days=options.vr_cache_max_age, keep_paths=cache_dirs)
 
-        #print("results:    " + str(results[0].keys()))
-        #print("tdry shape: " + str(results[0][VR_TEMPERATURE_KEY].shape))
-        #print("pres shape: " + str(results[0]['pres'].shape))
+    def expand_first_guess_file (*args) :
+        """rebuild a full first guess file from one made with --fg_compact
 
-        log.info("Creating fg.nc file")
+        The xa and sel* variables are filled back in from x0, p and varindx, and the
+        result is saved as --fg_out in the output directory.
 
-        # create the first guess file
-        # TODO, check existence for dir and file
-        out_fg_file = nc.Dataset(os.path.join(options.output, OUT_FG_FILE_NAME), 'w', format="NETCDF3_CLASSIC")
+        Examples:
+         python -m shis2mirto.conversion -o full/ expand_first_guess_file compact/fg.nc
+        """
+
+        # this command has the same name as the library function that does the work
+        from shis2mirto.firstguess import expand_first_guess_file as expand_compact_file
+
+        if len(args) != 1 :
+            log.warn("Unable to expand a first guess file without the path of one compact fg file.")
+            return 1
+
+        in_path  = clean_path(args[0])
+        out_path = os.path.join(options.output, options.fg_out)
+        if os.path.abspath(in_path) == os.path.abspath(out_path) :
+            log.warn("Unable to expand " + in_path + " in place, please pick a different output path.")
+            return 1
+
+        try :
+            with metrics.stage("expand_fg") :
+                expand_compact_file(in_path, out_path, output_format=output_format_from_options(options))
+        except ValueError as err :
+            log.warn(str(err))
+            return 1
+        metrics.add_output(out_path)
+
+        log.info("Finished saving " + out_path + " to file")
+
+    def cache_stats (*args) :
+        """show what's in the persistent virtual radiosonde cache
+
+        Examples:
+         python -m shis2mirto.conversion --vr_cache_dir /scratch/vr cache_stats
+        """
+
+        from shis2mirto.vrcache import list_vr_cache_entries, vr_cache_stats
+
+        cache_root = clean_path(options.vr_cache_dir)
+        stats      = vr_cache_stats(cache_root)
 
-        # build the dimensions for the first guess file
-        num_emiss_consts = SURFACE_EMISSIVITY_COEFFICIENTS.size
-        state_vector_size = num_plvls * 4 + 1 + num_emiss_consts
-        out_fg_file.createDimension(OUT_FG_NUM_STATEVAR_DIM_NAME,          size=state_vector_size)
-        out_fg_file.createDimension(OUT_FG_OBS_NUM_DIM_NAME,               size=num_obs)
-        out_fg_file.createDimension(OUT_FG_STATEVAR_DIMS_DIM_NAME,         size=6)
-        out_fg_file.createDimension(OUT_FG_NUM_SELECTED_STATEVAR_DIM_NAME, size=state_vector_size) # TODO, don't know how these are selected yet
+        print("cache root:  " + stats['root'])
+        print("entries:     " + str(stats['num_entries']))
+        print("total size:  " + ("%.1f" % (stats['total_bytes'] / (1024.0 * 1024.0))) + " MB")
+        if stats['num_entries'] > 0 :
+            print("oldest use:  " + time.ctime(stats['oldest_use']))
+            print("newest use:  " + time.ctime(stats['newest_use']))
+        if options.verbose :
+            for key, entry_path, entry_bytes, last_used in list_vr_cache_entries(cache_root) :
+                print("  %-24s %10.1f MB  %s" % (key, entry_bytes / (1024.0 * 1024.0), time.ctime(last_used)))
 
-        # build the various first guess file variables using the virtual radiosonde data
+    def cache_prune (*args) :
+        """remove least recently used entries from the persistent virtual radiosonde cache
 
-        # create the first guess state vector
-        # this is built up of several different things:
+        Entries are removed until the cache is smaller than --vr_cache_max_mb and none
+        of them are older than --vr_cache_max_age days.
+
+        Examples:
+         python -m shis2mirto.conversion --vr_cache_dir /scratch/vr --vr_cache_max_mb 20000 cache_prune
         """
-        Temperature in [K] <- num_plvls values
-		Water vapor in [log(q)] where q is psecific humidity in [kg/kg] <- num_plvls values
-		Carbon dioxide [ ppmv ] <- num_plvls values (may be constant repeated or from GFS data)
-		Ozone  in [log(q)] where q is psecific humidity in [kg/kg] <- num_plvls values (may be constant repeated or from GFS data)
-		Surface temperature in [K] <- one value (probably from GFS data?)
-		Surface emissivity principal component coefficients in logit space <- 5 values, constants from Paolo
+
+        from shis2mirto.vrcache import prune_vr_cache
+
+        if options.vr_cache_max_mb is None and options.vr_cache_max_age is None :
+            log.warn("Unable to prune the cache without a size or age limit.")
+            return 1
+
+        removed = prune_vr_cache(clean_path(options.vr_cache_dir),
+                                 max_bytes=_megabytes_to_bytes(options.vr_cache_max_mb),
+                                 max_age_days=options.vr_cache_max_age)
+
+        print("removed " + str(len(removed)) + " entries, freeing " +
+              ("%.1f" % (sum(entry[2] for entry in removed) / (1024.0 * 1024.0))) + " MB")
+
+    def batch_convert (*args) :
+        """convert many SHIS files, spread across a pool of processes
+
+        Each argument is either a glob of SHIS files or the path to a manifest file prefixed
+        with @ that lists one SHIS file (or glob) per line. Every granule gets its own
+        <granule>_fov.nc file in the output directory, and its own <granule>_fg.nc file if
+        a pressure levels file was given (granules with the same file name have their parent
+        directory names added in front). The other options are passed on to each granule.
+
+        Examples:
+         python -m shis2mirto.conversion -a in_wn.nc -p in_plvls.nc -o out/ -j 8 batch_convert "/data/SHIS_*.nc"
+         python -m shis2mirto.conversion -a in_wn.nc -o out/ batch_convert @granules.txt
         """
 
-        # allocate some space to hold the values for the parts of the state vector
-        temperature  = numpy.ones((num_obs, num_plvls), dtype=numpy.float32) * numpy.nan # this is the temp profile
-        pressure     = numpy.ones((num_obs, num_plvls), dtype=numpy.float32) * numpy.nan # this is the pressure profile
-        water_vapor  = numpy.ones((num_obs, num_plvls), dtype=numpy.float32) * numpy.nan
-        c02_value    = numpy.ones((num_obs, num_plvls), dtype=numpy.float32) * C02_CONST_STARTING_PT_IN_PPMV
-        ozone        = numpy.ones((num_obs, num_plvls), dtype=numpy.float32) * numpy.nan
-        surface_temp = numpy.ones((num_obs, 1),         dtype=numpy.float32) * numpy.nan
-        surface_pres = numpy.ones((num_obs, 1),         dtype=numpy.float32) * numpy.nan
-
-        # pull the appropriate values out of the virtual radiosonde data
-        for index in range(0, len(results)) :
-            current_pt = results[index]
-            temperature[index]  = current_pt[VR_TEMPERATURE_KEY] + CELSIUS_TO_KELVIN_ADD_CONST # vr is in C, we need K
-            pressure   [index]  = current_pt[VR_PRESSURE_KEY]
-            # water vapor is the log of specific water vapor
-            water_vapor_temp    = relative_humidity_to_specific_humidity(current_pt['rh'] / 100.0, temperature[index])
-            water_vapor_temp[water_vapor_temp < WATER_VAPOR_MINIMUM] = WATER_VAPOR_MINIMUM # make sure we have a minimum so we get valid results from the log
-            water_vapor[index]  = numpy.log(water_vapor_temp)
-            # ozone is the log of the specific humidity
-            temp_ozone_mr       = current_pt[VR_OZONE_MR_KEY]
-            ozone[index]        = numpy.log(temp_ozone_mr / (temp_ozone_mr + 1)) # convert from mixing ratio to specific humidity and take the log
-            # Note: for very small mixing ratios of ozone this conversion may not make a lot of different
-            surface_temp[index] = current_pt[VR_SURFACE_TEMPERATURE_KEY] # surface temperature is already in K
-            surface_pres[index] = current_pt[VR_SEA_SURFACE_PRESSURE_KEY]
-
-        # create the base state vector
-        state_vector_data = numpy.append(temperature,       water_vapor,  axis=1)
-        state_vector_data = numpy.append(state_vector_data, c02_value,    axis=1)
-        state_vector_data = numpy.append(state_vector_data, ozone,        axis=1)
-        state_vector_data = numpy.append(state_vector_data, surface_temp, axis=1)
-        temp_coeffs       = numpy.reshape(numpy.tile(SURFACE_EMISSIVITY_COEFFICIENTS, num_obs), (num_obs, num_emiss_consts))
-        state_vector_data = numpy.append(state_vector_data, temp_coeffs,  axis=1)
-
-        # create the pressure version of the state vector
-        press_vector_data = numpy.append(pressure,          pressure,     axis=1)
-        press_vector_data = numpy.append(press_vector_data, pressure,     axis=1)
-        press_vector_data = numpy.append(press_vector_data, pressure,     axis=1)
-        press_vector_data = numpy.append(press_vector_data, surface_pres, axis=1)
-        press_vector_data = numpy.append(press_vector_data, surface_pres, axis=1)
-        press_vector_data = numpy.append(press_vector_data, surface_pres, axis=1)
-        press_vector_data = numpy.append(press_vector_data, surface_pres, axis=1)
-        press_vector_data = numpy.append(press_vector_data, surface_pres, axis=1)
-        press_vector_data = numpy.append(press_vector_data, surface_pres, axis=1)
-
-        # create xa and x0
-        temp_var = out_fg_file.createVariable(OUT_FG_LIN_POINT_VAR_NAME, 'f8', (OUT_FG_OBS_NUM_DIM_NAME, OUT_FG_NUM_STATEVAR_DIM_NAME))
-        temp_var[0:num_obs, 0:state_vector_size] = state_vector_data
-        temp_var = out_fg_file.createVariable(OUT_FG_FIRST_GUESS_STATE_VEC_VAR_NAME, 'f8', (OUT_FG_OBS_NUM_DIM_NAME, OUT_FG_NUM_STATEVAR_DIM_NAME))
-        temp_var[0:num_obs, 0:state_vector_size] = state_vector_data
-
-        # create p
-        temp_var = out_fg_file.createVariable(OUT_FG_PRESSURE_GRID_VAR_NAME, 'f8', (OUT_FG_OBS_NUM_DIM_NAME, OUT_FG_NUM_STATEVAR_DIM_NAME))
-        temp_var[0:num_obs, 0:state_vector_size] = press_vector_data
-
-        # create xdim
-        temp_var = out_fg_file.createVariable(OUT_FG_STATE_VECTOR_DIMS_VAR_NAME, 'f8', (OUT_FG_STATEVAR_DIMS_DIM_NAME))
-        temp_var[0:6] = numpy.array([num_plvls, num_plvls, num_plvls, num_plvls, 1, num_emiss_consts])
-
-        # create varindx
-        temp_selected_indx = numpy.array(range(0, state_vector_size)) # TODO, don't know how these are selected
-        temp_var = out_fg_file.createVariable(OUT_FG_SEL_STATE_VECTOR_IDX_VAR_NAME, 'f8', (OUT_FG_NUM_SELECTED_STATEVAR_DIM_NAME))
-        temp_var[0:state_vector_size] = temp_selected_indx + 1 # use matlab indexing
-
-        # create selxa and selx0
-        temp_var = out_fg_file.createVariable(OUT_FG_SEL_LIN_POINT_VAR_NAME, 'f8', (OUT_FG_OBS_NUM_DIM_NAME, OUT_FG_NUM_SELECTED_STATEVAR_DIM_NAME))
-        temp_var[0:num_obs, 0:state_vector_size] = state_vector_data
-        temp_var = out_fg_file.createVariable(OUT_FG_SEL_FG_STATE_VEC_VAR_NAME, 'f8', (OUT_FG_OBS_NUM_DIM_NAME, OUT_FG_NUM_SELECTED_STATEVAR_DIM_NAME))
-        temp_var[0:num_obs, 0:state_vector_size] = state_vector_data
-
-        # create selp
-        temp_var = out_fg_file.createVariable(OUT_FG_SEL_PRESSURE_GRID_VAR_NAME, 'f8', (OUT_FG_OBS_NUM_DIM_NAME, OUT_FG_NUM_SELECTED_STATEVAR_DIM_NAME))
-        temp_var[0:num_obs, 0:state_vector_size] = press_vector_data
-
-        # close the finished file
-        out_fg_file.close()
+        from shis2mirto.batch import expand_granule_list, granule_output_names, run_batch, format_batch_summary
 
-        log.info("Finished saving fg.nc to file")
+        # every granule would write the same fov_<name>.nc files
+        if options.fov_windows is not None :
+            log.warn("Unable to use --windows with batch_convert, run each window separately.")
+            return 1
+
+        granule_paths = expand_granule_list(args)
+        if not granule_paths :
+            log.warn("No SHIS files found to convert")
+            return 1
+
+        # every granule's files go in the same output directory, so they each need their own names
+        try :
+            output_names = granule_output_names(granule_paths)
+        except ValueError as err :
+            log.warn(str(err))
+            return 1
+
+        output_dir = clean_path(options.output)
+        if not os.path.isdir(output_dir) :
+            os.makedirs(output_dir)
+
+        # the per granule options are filled in for each task, everything else is passed along
+        # (except --workers, the granules are already spread across processes that can't start their own)
+        base_argv = options_to_argv(parser, options, skip_dests=("shis_input", "fov_base", "output", "fov_out",
+                                                                 "fg_out", "processes", "version", "self_test",
+                                                                 "metrics_json", "profile", "workers"))
+        make_fg   = options.plevels_input is not None
+        tasks     = [(granule_path, base_argv, output_dir, make_fg, fov_name, fg_name)
+                     for granule_path, (fov_name, fg_name) in zip(granule_paths, output_names)]
+
+        start_time = time.time()
+        results    = run_batch(tasks, num_processes=options.processes)
+        print(format_batch_summary(results, time.time() - start_time))
+
+        return 0 if all(result[1] for result in results) else 1
+
+    def benchmark (*args) :
+        """time the conversion commands on synthetic SHIS data of several sizes
+
+        Synthetic SHIS, wave number and pressure level files are generated for each of the
+        --bench_records and --bench_channels sizes, and the first guess is built with a
+        canned stand-in for the virtual radiosonde. The timings are written as JSON.
+
+        Examples:
+         python -m shis2mirto.conversion --bench_records 1000,10000 --bench_channels 4000 benchmark
+         python -m shis2mirto.conversion --bench_output bench.json benchmark
+        """
+
+        import json
+        from shis2mirto.benchmark import run_benchmarks
+
+        # only pass along the options that change how the commands do their work
+        base_argv = options_to_argv(parser, options, skip_dests=("shis_input", "wnum_input", "plevels_input", "fov_base",
+                                                                 "output", "fov_out", "fg_out", "vr_narrator",
+                                                                 "vr_cache_dir", "version", "self_test",
+                                                                 "bench_records", "bench_channels", "bench_repeat",
+                                                                 "bench_output", "metrics_json", "profile"))
+        bench_results = run_benchmarks(_int_list(options.bench_records), _int_list(options.bench_channels),
+                                       repeat=options.bench_repeat, base_argv=base_argv)
+
+        bench_text = json.dumps(bench_results, indent=2, sort_keys=True)
+        if options.bench_output is None :
+            print(bench_text)
+        else :
+            with open(clean_path(options.bench_output), 'w') as out_file :
+                out_file.write(bench_text + "\n")
+            log.info("Saved benchmark results to " + options.bench_output)
 
     def help(command=None):
         """print help for a specific command or list of commands
@@ -715,9 +1138,9 @@ examples:
             # print first line of docstring
             for cmd in commands:
                 ds = commands[cmd].__doc__.split('\n')[0]
-                print "%-16s %s" % (cmd,ds)
+                print ("%-16s %s" % (cmd,ds))
         else:
-            print commands[command].__doc__
+            print (commands[command].__doc__)
 
     # all the local public functions are considered part of this script, collect them up
     commands.update(dict(x for x in locals().items() if x[0] not in prior))
@@ -729,8 +1152,29 @@ examples:
         return 9
     else:
         # call the function the user named, given the arguments from the command line
-        rc = locals()[args[0]](*args[1:])
-        return 0 if rc is None else rc
+        command_function = locals()[args[0]]
+        if options.profile is not None :
+            import cProfile
+            profiler = cProfile.Profile()
+            rc       = profiler.runcall(command_function, *args[1:])
+            profiler.dump_stats(clean_path(options.profile))
+            log.info("Saved profile to " + options.profile)
+        else :
+            rc = command_function(*args[1:])
+        rc = 0 if rc is None else rc
+
+        # report where the time went
+        metrics.finish()
+        metrics.log_summary(level=logging.DEBUG)
+        if options.metrics_json is not None :
+            import json
+            metrics_info                = metrics.as_dict()
+            metrics_info['return_code'] = rc
+            with open(clean_path(options.metrics_json), 'w') as out_file :
+                out_file.write(json.dumps(metrics_info, indent=2, sort_keys=True) + "\n")
+            log.info("Saved metrics to " + options.metrics_json)
+
+        return rc
 
 if __name__ == "__main__":
     sys.exit(main())
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Pull selected observation records out of SHIS data variables.
+
+This file is part of the shis2mirto software package. The extraction module turns
+record masks into contiguous runs so that large variables (like the radiances) can be
+read with one hyperslab per run instead of one read per record.
+
+"""
+__docformat__ = "restructuredtext en"
+
+import logging
+import numpy
+
+log = logging.getLogger(__name__)
+
+def mask_to_runs (record_mask) :
+    """convert a boolean record mask into contiguous runs of selected records
+
+    >>> starts, stops = mask_to_runs([False, True, True, False, True])
+    >>> starts.tolist(), stops.tolist()
+    ([1, 4], [3, 5])
+
+    :param record_mask: a 1D boolean array, True for each record that should be used
+    :return: a tuple of (starts, stops) index arrays; each run covers records [start, stop)
+    """
+
+    record_mask = numpy.asarray(record_mask, dtype=bool).ravel()
+
+    # pad the mask with False on both ends so every run has a rising and a falling edge
+    padded         = numpy.zeros(record_mask.size + 2, dtype=numpy.int8)
+    padded[1:-1]   = record_mask
+    edges          = numpy.flatnonzero(numpy.diff(padded))
+
+    return edges[0::2], edges[1::2]
+
+def record_blocks (num_records, block_size=None) :
+    """generate (start, stop) pairs that cover all the records in blocks of a fixed size
+
+    >>> list(record_blocks(5, 2))
+    [(0, 2), (2, 4), (4, 5)]
+    >>> list(record_blocks(5))
+    [(0, 5)]
+
+    :param num_records: the total number of records
+    :param block_size:  the maximum number of records per block; None or 0 means one block for everything
+    """
+
+    if (block_size is None) or (block_size <= 0) :
+        block_size = max(num_records, 1)
+
+    for start in range(0, num_records, block_size) :
+        yield start, min(start + block_size, num_records)
+
+def read_masked_records (variable, record_mask, first_record=0, columns=None) :
+    """read the records of a variable selected by a mask along its first dimension
+
+    Each contiguous run of selected records is read with a single slice and copied into a
+    preallocated buffer. If any of the data read is masked, a masked array is returned,
+    otherwise a plain array in the variable's own data type is returned.
+
+    If columns are given, only those indexes along the second dimension are kept. Each run
+    then only reads the span from the first to the last of the columns, and the columns
+    are taken out of that span as it's copied into the buffer.
+
+    >>> data = numpy.arange(20).reshape(5, 4)
+    >>> read_masked_records(data, [True, False, True, True, False]).tolist()
+    [[0, 1, 2, 3], [8, 9, 10, 11], [12, 13, 14, 15]]
+    >>> read_masked_records(data, [True, False, True, True, False], columns=[1, 3]).tolist()
+    [[1, 3], [9, 11], [13, 15]]
+
+    :param variable:     a netCDF4 variable (or anything sliceable along the first dimension)
+    :param record_mask:  a 1D boolean array with one entry per record being considered
+    :param first_record: the record in the variable that corresponds to the start of the mask
+    :param columns:      the indexes to keep along the second dimension, or None to keep all of them
+    :return: an array shaped (number of selected records,) + the shape of one record
+    """
+
+    starts, stops = mask_to_runs(record_mask)
+    starts        = starts + first_record
+    stops         = stops  + first_record
+    num_records   = int(numpy.sum(stops - starts))
+    record_shape  = tuple(variable.shape[1:])
+    if columns is not None :
+        columns      = numpy.asarray(columns, dtype=numpy.int64)
+        column_start = int(columns.min())     if columns.size > 0 else 0
+        column_stop  = int(columns.max()) + 1 if columns.size > 0 else 0
+        span_columns = columns - column_start
+        record_shape = (columns.size,) + record_shape[1:]
+
+    log.debug("reading " + str(num_records) + " records in " + str(starts.size) + " runs")
+
+    data_buffer = numpy.empty((num_records,) + record_shape, dtype=variable.dtype)
+    mask_buffer = None
+
+    position = 0
+    for start, stop in zip(starts, stops) :
+        end   = position + (stop - start)
+        if columns is None :
+            block = variable[start:stop]
+            data_buffer[position:end] = numpy.ma.getdata(block)
+        else :
+            block = variable[start:stop, column_start:column_stop]
+            numpy.take(numpy.ma.getdata(block), span_columns, axis=1, out=data_buffer[position:end])
+
+        # only keep track of a mask if the data actually has masked values in it
+        block_mask = numpy.ma.getmask(block)
+        if block_mask is not numpy.ma.nomask and numpy.any(block_mask) :
+            if mask_buffer is None :
+                mask_buffer = numpy.zeros(data_buffer.shape, dtype=bool)
+            mask_buffer[position:end] = block_mask if columns is None else numpy.take(block_mask, span_columns, axis=1)
+
+        position = end
+
+    if mask_buffer is not None :
+        return numpy.ma.array(data_buffer, mask=mask_buffer)
+
+    return data_buffer
@@ -0,0 +1,477 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Build the Mirto first guess from Virtual Radiosonde profiles at the SHIS observations.
+
+This file is part of the shis2mirto software package. The first guess is built from the
+positions and times in a FovProduct, so an fov product that is already in memory can be
+used directly instead of being written out and read back in:
+
+    narrator = make_run_narrator(plevels, cache_root, min(fov_product.datetimes()))
+    fg       = build_first_guess(fov_product, plevels, narrator)
+    write_first_guess_file(fg, "fg.nc")
+
+A narrator made with make_narrator keeps its GFS data in the one directory it's given, and
+make_run_narrator puts that directory in the persistent cache (see vrcache). The narrator is
+asked for each observation at its own time and does its own time interpolation. A
+CachedForecastNarrator instead splits the queries by GFS output time so every forecast file
+gets its own cache entry; that's only done when asked for, since it does the time
+interpolation here and asks for most points twice. For long flights,
+build_first_guess_parallel splits the observations into time ordered shards and builds each
+shard with its own narrator in a pool of processes.
+
+The first guess is also the linearization point, so xa and x0 hold the same matrix. A
+compact fg.nc file only writes x0, p, xdim and varindx, and a global attribute gives the
+rule for rebuilding the rest on the Mirto side; expand_first_guess_file rebuilds them into
+a full file for readers that expect every variable.
+
+"""
+__docformat__ = "restructuredtext en"
+
+import logging
+import multiprocessing
+
+import numpy
+
+from shis2mirto.guidebook   import *
+from shis2mirto.ncoutput    import OutputFormat
+from shis2mirto.physics     import fill_state_from_vr_results
+from shis2mirto.statevector import StateVectorLayout
+from shis2mirto.vrcache     import vr_cache_entry_dir, vr_cache_run_dir
+from shis2mirto.vrplanner   import query_narrator_by_corners, query_narrators_by_time
+from shis2mirto.vremap      import vertical_remap, remap_vr_results
+
+log = logging.getLogger(__name__)
+
+def get_vr_channels () :
+    """get the set of channels we ask the virtual radiosonde for
+
+    This imports the virtual radiosonde code, so it should only be called when we're
+    actually going to run a narrator. If the virtual radiosonde isn't installed (ie. when
+    a stand-in narrator is used) only our extra channels are asked for.
+    """
+
+    try :
+        from virtual_radiosonde_source.vrsNarrator import DEFAULT_CHANNELS as vr_channels
+    except ImportError :
+        vr_channels = set()
+
+    return set(vr_channels).union(set([VR_INPUT_SURFACE_TEMPERATURE_KEY,
+                                       VR_INPUT_SEA_SURFACE_PRESSURE_KEY,
+                                       VR_INPUT_SURFACE_PRESSURE_KEY,
+                                       VR_INPUT_OZONE_MR_KEY]))
+
+def make_narrator (plevels, cache_dir, narrator_class=None) :
+    """create a narrator to get profiles at the given pressure levels
+
+    :param plevels:        the pressure levels, highest pressure first
+    :param cache_dir:      the directory the narrator keeps its GFS data in
+    :param narrator_class: the class to use, the VirtualRadiosondeNarrator if this is None
+    :return: the narrator
+    """
+
+    if narrator_class is None :
+        import virtual_radiosonde_source.vrsNarrator as radiosonde
+        narrator_class = radiosonde.VirtualRadiosondeNarrator
+
+    # confirmed that the interpolation kwarg is only for temporal interpolation (spatial interpolation is always bilinear)
+    # TODO, may want to have a user knob to control temporal interpolation type
+    return narrator_class(on_dread=True, levels=plevels, cache=cache_dir, channels=get_vr_channels())
+
+class CachedForecastNarrator (object) :
+    """a narrator that keeps the GFS data for each forecast file in its own persistent cache entry
+
+    Every query is split between the GFS output times around it (see query_narrators_by_time),
+    and each output time is asked for with a narrator of its own whose cache is the entry for
+    that forecast file (see vr_cache_entry_dir), so runs covering different spans of time
+    share the entries they have in common. The narrators are made as they're needed.
+
+    The time interpolation is done linearly here rather than by the narrator and most points
+    are asked for twice, so this is only used when the split is asked for (see make_run_narrator).
+    """
+
+    def __init__ (self, plevels, cache_root, narrator_class=None, time_step_hours=GFS_FORECAST_STEP_HOURS) :
+        """
+        :param plevels:         the pressure levels, highest pressure first
+        :param cache_root:      the root directory of the persistent cache
+        :param narrator_class:  the class to use, the VirtualRadiosondeNarrator if this is None
+        :param time_step_hours: the number of hours between GFS outputs
+        """
+
+        self.plevels         = plevels
+        self.cache_root      = cache_root
+        self.narrator_class  = narrator_class
+        self.time_step_hours = time_step_hours
+        self._narrators      = { }
+
+    def narrator_for_time (self, output_time) :
+        """get the narrator for the GFS forecast file valid at one output time"""
+
+        if output_time not in self._narrators :
+            self._narrators[output_time] = make_narrator(self.plevels, vr_cache_entry_dir(self.cache_root, output_time),
+                                                         narrator_class=self.narrator_class)
+
+        return self._narrators[output_time]
+
+    def __call__ (self, desired_points) :
+
+        return query_narrators_by_time(self.narrator_for_time, desired_points, time_step_hours=self.time_step_hours)
+
+def make_run_narrator (plevels, cache_root, start_time, narrator_class=None, split_times=False,
+                       time_step_hours=GFS_FORECAST_STEP_HOURS) :
+    """create the narrator for one run of observations, with its GFS data in the persistent cache
+
+    :param plevels:         the pressure levels, highest pressure first
+    :param cache_root:      the root directory of the persistent cache
+    :param start_time:      the datetime of the earliest observation the narrator will be asked for
+    :param narrator_class:  the class to use, the VirtualRadiosondeNarrator if this is None
+    :param split_times:     split the queries by GFS output time with a CachedForecastNarrator
+    :param time_step_hours: the number of hours between GFS outputs
+    :return: a narrator, which is asked for the observations at their own times unless split_times is set
+    """
+
+    if split_times :
+        return CachedForecastNarrator(plevels, cache_root, narrator_class=narrator_class,
+                                      time_step_hours=time_step_hours)
+
+    return make_narrator(plevels, vr_cache_run_dir(cache_root, start_time, time_step_hours=time_step_hours),
+                         narrator_class=narrator_class)
+
+class FirstGuessProduct (object) :
+    """the first guess state vectors and pressure grids that make up an fg.nc file"""
+
+    def __init__ (self, layout, state_vector, pressure_grid) :
+        """
+        :param layout:        the StateVectorLayout of the state vectors
+        :param state_vector:  a (num_obs, layout.size) array of first guess state vectors
+        :param pressure_grid: a (num_obs, layout.size) array of the pressures that go with the state vectors
+        """
+
+        self.layout        = layout
+        self.state_vector  = state_vector
+        self.pressure_grid = pressure_grid
+
+    @property
+    def num_obs (self) :
+        return self.state_vector.shape[0]
+
+def fov_points (fov_product, time_zone=DEFAULT_TIME_ZONE_POLICY) :
+    """build the list of time / lon / lat dictionaries the narrator takes for each fov observation
+
+    :param fov_product: a FovProduct
+    :param time_zone:   the time zone policy used to convert the times to datetimes
+    :return: a list of dictionaries, one per observation
+    """
+
+    dt_times = fov_product.datetimes(time_zone=time_zone)
+    lat_data = fov_product.lat
+    lon_data = fov_product.lon
+
+    desired_points = [ ]
+    for index in range(0, lon_data.size) :
+        desired_points.append({
+                                VR_INPUT_DATETIME_KEY: dt_times[index],
+                                VR_INPUT_LAT_KEY:      lat_data[index],
+                                VR_INPUT_LON_KEY:      lon_data[index]
+                              })
+
+    return desired_points
+
+def build_first_guess (fov_product, plevels, narrator, time_zone=DEFAULT_TIME_ZONE_POLICY, use_planner=False,
+                       grid_spacing=GFS_GRID_SPACING_DEGREES, time_step_hours=GFS_FORECAST_STEP_HOURS,
+                       native_levels=None) :
+    """build the first guess for each observation in a FovProduct
+
+    :param fov_product:     a FovProduct; only the positions and times are used
+    :param plevels:         the pressure levels of the first guess, highest pressure first; the narrator
+                            should have been made with these unless native_levels is given
+    :param narrator:        a VirtualRadiosondeNarrator (or anything that can be called the same way)
+    :param time_zone:       the time zone policy used to convert the times to datetimes
+    :param use_planner:     only ask the narrator for each distinct GFS grid corner and time once
+    :param grid_spacing:    the spacing of the GFS grid in degrees, used by the planner
+    :param time_step_hours: the number of hours between GFS outputs, used by the planner
+    :param native_levels:   the pressure levels the narrator was made with, if they aren't plevels; the
+                            profiles are remapped to plevels with a cached VerticalRemap
+    :return: a FirstGuessProduct
+    """
+
+    desired_points = fov_points(fov_product, time_zone=time_zone)
+    num_obs        = len(desired_points)
+
+    log.info("Running Virtual Radiosonde code")
+
+    if use_planner :
+        results = query_narrator_by_corners(narrator, desired_points, grid_spacing=grid_spacing,
+                                            time_step_hours=time_step_hours)
+    else :
+        results = list(narrator(desired_points))
+
+    # take the profiles from the levels the narrator gave us to the ones we want, all at once
+    if native_levels is not None :
+        results = remap_vr_results(results, vertical_remap(native_levels, plevels))
+
+    # allocate one buffer for the first guess state vector and one for the pressure grid that
+    # goes with it, the parts of the state vector are filled in place (see StateVectorLayout)
+    layout            = StateVectorLayout(numpy.size(plevels))
+    state_vector_data = layout.allocate(num_obs)
+    press_vector_data = layout.allocate(num_obs)
+    layout.segment(state_vector_data, STATE_CO2_SEGMENT)[:]                = C02_CONST_STARTING_PT_IN_PPMV
+    layout.segment(state_vector_data, STATE_SURFACE_EMISSIVITY_SEGMENT)[:] = SURFACE_EMISSIVITY_COEFFICIENTS
+
+    # convert the virtual radiosonde data for all the observations at once and put it in place
+    fill_state_from_vr_results(results, layout, state_vector_data, press_vector_data)
+
+    return FirstGuessProduct(layout, state_vector_data, press_vector_data)
+
+def time_ordered_shards (epoch_seconds, num_shards) :
+    """split the observations into shards that each cover one stretch of time
+
+    Keeping each shard to a stretch of time keeps down the number of GFS times each
+    shard's narrator needs.
+
+    >>> [shard.tolist() for shard in time_ordered_shards(numpy.array([5.0, 1.0, 3.0, 2.0]), 2)]
+    [[1, 3], [2, 0]]
+
+    :param epoch_seconds: a (num_obs,) array of observation times
+    :param num_shards:    how many shards to make; fewer are made if there aren't enough observations
+    :return: a list of arrays of observation indexes, each in time order
+    """
+
+    time_order = numpy.argsort(epoch_seconds, kind='mergesort')
+    num_shards = max(1, min(num_shards, time_order.size))
+
+    return numpy.array_split(time_order, num_shards)
+
+def _build_first_guess_shard (task) :
+    """build the first guess for one shard of observations, this is the work done in each pool process
+
+    :param task: a tuple of (FovProduct, pressure levels, cache root, narrator class, the datetime of the
+                 run's earliest observation, whether to split the narrator queries by GFS output time,
+                 build_first_guess keyword arguments)
+    :return: a FirstGuessProduct
+    """
+
+    fov_shard, plevels, cache_root, narrator_class, start_time, split_times, build_kwargs = task
+    narrator_levels = build_kwargs['native_levels'] if build_kwargs.get('native_levels') is not None else plevels
+    narrator        = make_run_narrator(narrator_levels, cache_root, start_time, narrator_class=narrator_class,
+                                        split_times=split_times, time_step_hours=build_kwargs['time_step_hours'])
+
+    return build_first_guess(fov_shard, plevels, narrator, **build_kwargs)
+
+def build_first_guess_parallel (fov_product, plevels, cache_root, num_workers, narrator_class=None,
+                                time_zone=DEFAULT_TIME_ZONE_POLICY, use_planner=False,
+                                grid_spacing=GFS_GRID_SPACING_DEGREES, time_step_hours=GFS_FORECAST_STEP_HOURS,
+                                native_levels=None, split_times=False) :
+    """build the first guess for each observation in a FovProduct, spread across a pool of processes
+
+    The observations are split with time_ordered_shards, each process makes its own narrator
+    (see make_run_narrator) sharing the run's entries in the persistent GFS cache, and the shards are put back
+    in the original observation order, so the result is the same as build_first_guess would give.
+
+    :param fov_product:     a FovProduct; only the positions and times are used
+    :param plevels:         the pressure levels, highest pressure first
+    :param cache_root:      the root directory of the persistent cache the narrators keep their GFS data in
+    :param num_workers:     how many processes to use
+    :param narrator_class:  the class to use, the VirtualRadiosondeNarrator if this is None
+    :param time_zone:       the time zone policy used to convert the times to datetimes
+    :param use_planner:     only ask the narrator for each distinct GFS grid corner and time once
+    :param grid_spacing:    the spacing of the GFS grid in degrees, used by the planner
+    :param time_step_hours: the number of hours between GFS outputs, used by the planner
+    :param native_levels:   the pressure levels to make the narrators with, if they aren't plevels; the
+                            profiles are remapped to plevels
+    :param split_times:     split each narrator's queries by GFS output time (see CachedForecastNarrator)
+    :return: a FirstGuessProduct
+    """
+
+    build_kwargs = {
+                    'time_zone':       time_zone,
+                    'use_planner':     use_planner,
+                    'grid_spacing':    grid_spacing,
+                    'time_step_hours': time_step_hours,
+                    'native_levels':   native_levels,
+                   }
+    start_time   = min(fov_product.datetimes(time_zone=time_zone))
+    shards       = time_ordered_shards(fov_product.epoch_seconds(), num_workers)
+    tasks        = [(fov_product.subset(shard_indexes), plevels, cache_root, narrator_class, start_time, split_times,
+                     build_kwargs) for shard_indexes in shards]
+
+    log.info("Building the first guess for " + str(fov_product.num_obs) + " observations in " + str(len(tasks)) +
+             " shards")
+
+    if len(tasks) == 1 :
+        shard_products = [_build_first_guess_shard(tasks[0])]
+    else :
+        pool = multiprocessing.Pool(processes=len(tasks))
+        try :
+            shard_products = pool.map(_build_first_guess_shard, tasks)
+        finally :
+            pool.close()
+            pool.join()
+
+    # put each shard's rows back where its observations came from
+    layout            = StateVectorLayout(numpy.size(plevels))
+    state_vector_data = layout.allocate(fov_product.num_obs)
+    press_vector_data = layout.allocate(fov_product.num_obs)
+    for shard_indexes, shard_product in zip(shards, shard_products) :
+        state_vector_data[shard_indexes] = shard_product.state_vector
+        press_vector_data[shard_indexes] = shard_product.pressure_grid
+
+    return FirstGuessProduct(layout, state_vector_data, press_vector_data)
+
+def write_first_guess_file (product, file_path, output_format=None, unlimited_obs=False, selected_indexes=None,
+                            compact=False, provenance=None) :
+    """write a FirstGuessProduct to an fg.nc file
+
+    :param product:          the FirstGuessProduct to save
+    :param file_path:        the path of the fg.nc file to create
+    :param output_format:    the OutputFormat to write, classic if this is None
+    :param unlimited_obs:    make the obsnum dimension unlimited, so the file can be appended to later
+    :param selected_indexes: the 0 based indexes of the state variables in varindx and the sel* variables,
+                             all of them if this is None (see StateVectorLayout.selection_indexes)
+    :param compact:          leave out xa and the sel* variables, see OUT_FG_COMPACT_CONVENTION
+    :param provenance:       an optional Provenance to record in the file's global attributes
+    """
+
+    output_format     = OutputFormat() if output_format is None else output_format
+    layout            = product.layout
+    num_obs           = product.num_obs
+    state_vector_size = layout.size
+    state_vector_data = product.state_vector
+    press_vector_data = product.pressure_grid
+    state_dtype       = state_vector_data.dtype
+    selected_indexes  = numpy.arange(state_vector_size) if selected_indexes is None else numpy.asarray(selected_indexes)
+    num_selected      = selected_indexes.size
+
+    out_fg_file = output_format.create_dataset(file_path)
+    if compact :
+        out_fg_file.setncattr(OUT_FG_COMPACT_ATTR_NAME, OUT_FG_COMPACT_CONVENTION)
+    if provenance is not None :
+        provenance.write_attributes(out_fg_file)
+
+    # build the dimensions for the first guess file
+    layout.create_dimensions(out_fg_file, None if unlimited_obs else num_obs, num_selected=num_selected)
+
+    # create xa and x0
+    if not compact :
+        temp_var = output_format.create_variable(out_fg_file, OUT_FG_LIN_POINT_VAR_NAME, state_dtype,
+                                                 (OUT_FG_OBS_NUM_DIM_NAME, OUT_FG_NUM_STATEVAR_DIM_NAME))
+        temp_var[0:num_obs, 0:state_vector_size] = state_vector_data
+    temp_var = output_format.create_variable(out_fg_file, OUT_FG_FIRST_GUESS_STATE_VEC_VAR_NAME, state_dtype,
+                                             (OUT_FG_OBS_NUM_DIM_NAME, OUT_FG_NUM_STATEVAR_DIM_NAME))
+    temp_var[0:num_obs, 0:state_vector_size] = state_vector_data
+
+    # create p
+    temp_var = output_format.create_variable(out_fg_file, OUT_FG_PRESSURE_GRID_VAR_NAME, state_dtype,
+                                             (OUT_FG_OBS_NUM_DIM_NAME, OUT_FG_NUM_STATEVAR_DIM_NAME))
+    temp_var[0:num_obs, 0:state_vector_size] = press_vector_data
+
+    # create xdim and varindx
+    layout.write_xdim(out_fg_file,    output_format=output_format)
+    layout.write_varindx(out_fg_file, output_format=output_format, selected_indexes=selected_indexes)
+
+    if not compact :
+        # the selected columns; when everything is selected these are the matrices themselves
+        if num_selected != state_vector_size :
+            state_vector_data = state_vector_data.take(selected_indexes, axis=1)
+            press_vector_data = press_vector_data.take(selected_indexes, axis=1)
+
+        # create selxa and selx0
+        temp_var = output_format.create_variable(out_fg_file, OUT_FG_SEL_LIN_POINT_VAR_NAME, state_dtype,
+                                                 (OUT_FG_OBS_NUM_DIM_NAME, OUT_FG_NUM_SELECTED_STATEVAR_DIM_NAME))
+        temp_var[0:num_obs, 0:num_selected] = state_vector_data
+        temp_var = output_format.create_variable(out_fg_file, OUT_FG_SEL_FG_STATE_VEC_VAR_NAME, state_dtype,
+                                                 (OUT_FG_OBS_NUM_DIM_NAME, OUT_FG_NUM_SELECTED_STATEVAR_DIM_NAME))
+        temp_var[0:num_obs, 0:num_selected] = state_vector_data
+
+        # create selp
+        temp_var = output_format.create_variable(out_fg_file, OUT_FG_SEL_PRESSURE_GRID_VAR_NAME, state_dtype,
+                                                 (OUT_FG_OBS_NUM_DIM_NAME, OUT_FG_NUM_SELECTED_STATEVAR_DIM_NAME))
+        temp_var[0:num_obs, 0:num_selected] = press_vector_data
+
+    # close the finished file
+    if provenance is not None :
+        provenance.mark_complete(out_fg_file)
+    out_fg_file.close()
+
+def first_guess_num_obs (file_path) :
+    """get the number of observations already in an fg.nc file
+
+    :param file_path: the path of the fg.nc file
+    :return: the length of the obsnum dimension
+    """
+
+    import netCDF4 as nc
+
+    fg_file = nc.Dataset(file_path, 'r')
+    num_obs = len(fg_file.dimensions[OUT_FG_OBS_NUM_DIM_NAME])
+    fg_file.close()
+
+    return num_obs
+
+def append_first_guess_file (product, file_path, provenance=None) :
+    """add the observations in a FirstGuessProduct to the end of an existing fg.nc file
+
+    :param product:    the FirstGuessProduct to add
+    :param file_path:  the path of an fg.nc file with an unlimited obsnum dimension
+    :param provenance: an optional Provenance to record in the file's global attributes in place of the one it had
+    :raises ValueError: if the file can't be appended to or has a different state vector layout
+    """
+
+    import netCDF4 as nc
+
+    out_fg_file = nc.Dataset(file_path, 'a')
+    try :
+        obs_dim = out_fg_file.dimensions[OUT_FG_OBS_NUM_DIM_NAME]
+        if not obs_dim.isunlimited() :
+            raise ValueError("Unable to append to " + file_path + " because its " + OUT_FG_OBS_NUM_DIM_NAME +
+                             " dimension isn't unlimited")
+        if len(out_fg_file.dimensions[OUT_FG_NUM_STATEVAR_DIM_NAME]) != product.layout.size :
+            raise ValueError("Unable to append to " + file_path + " because its state vector has a different size")
+        if provenance is not None :
+            provenance.write_attributes(out_fg_file)
+
+        # the sel* variables get the columns the file's varindx picks; compact files don't have them
+        selected_indexes = numpy.asarray(out_fg_file.variables[OUT_FG_SEL_STATE_VECTOR_IDX_VAR_NAME][:], dtype=numpy.int64) - 1
+        out_start        = len(obs_dim)
+        out_stop         = out_start + product.num_obs
+        for var_names, data in ((OUT_FG_STATE_VECTOR_VAR_NAMES,  product.state_vector),
+                                (OUT_FG_PRESSURE_GRID_VAR_NAMES, product.pressure_grid)) :
+            for var_name in var_names :
+                if var_name not in out_fg_file.variables :
+                    continue
+                if var_name in OUT_FG_SELECTED_VAR_NAMES and selected_indexes.size != product.layout.size :
+                    out_fg_file.variables[var_name][out_start:out_stop, :] = data.take(selected_indexes, axis=1)
+                else :
+                    out_fg_file.variables[var_name][out_start:out_stop, :] = data
+        if provenance is not None :
+            provenance.mark_complete(out_fg_file)
+    finally :
+        out_fg_file.close()
+
+def expand_first_guess_file (in_file_path, out_file_path, output_format=None) :
+    """rebuild a full fg.nc file, with every variable, from a compact one
+
+    :param in_file_path:  the path of the compact fg.nc file
+    :param out_file_path: the path of the full fg.nc file to create
+    :param output_format: the OutputFormat to write, classic if this is None
+    :raises ValueError: if the input file isn't a compact file
+    """
+
+    import netCDF4 as nc
+
+    in_fg_file = nc.Dataset(in_file_path, 'r')
+    try :
+        if OUT_FG_COMPACT_ATTR_NAME not in in_fg_file.ncattrs() :
+            raise ValueError(in_file_path + " isn't a compact first guess file")
+        variables        = in_fg_file.variables
+        xdim             = numpy.asarray(variables[OUT_FG_STATE_VECTOR_DIMS_VAR_NAME][:], dtype=numpy.int64)
+        layout           = StateVectorLayout(int(xdim[0]), num_emiss_consts=int(xdim[-1]))
+        product          = FirstGuessProduct(layout, variables[OUT_FG_FIRST_GUESS_STATE_VEC_VAR_NAME][:],
+                                             variables[OUT_FG_PRESSURE_GRID_VAR_NAME][:])
+        selected_indexes = numpy.asarray(variables[OUT_FG_SEL_STATE_VECTOR_IDX_VAR_NAME][:], dtype=numpy.int64) - 1
+        unlimited_obs    = in_fg_file.dimensions[OUT_FG_OBS_NUM_DIM_NAME].isunlimited()
+    finally :
+        in_fg_file.close()
+
+    write_first_guess_file(product, out_file_path, output_format=output_format, unlimited_obs=unlimited_obs,
+                           selected_indexes=selected_indexes)
@@ -0,0 +1,681 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Select SHIS observations and channels for Mirto and build the fov.nc product.
+
+This file is part of the shis2mirto software package. The selection works on anything
+laid out like a netCDF4 Dataset, with a variables dictionary of sliceable arrays. That
+can be an open SHIS file or the in memory copy of one made by load_shis_data, so a SHIS
+file can be loaded once and then used for several fov angle windows:
+
+    shis_data = load_shis_data(netCDF4.Dataset("SHIS.nc"))
+    nadir     = select_fov(shis_data, wavenumbers, 0.0,  1.5)
+    left      = select_fov(shis_data, wavenumbers, -30.0, 1.5)
+    write_fov_file(nadir, "fov.nc")
+
+The products are plain numpy arrays; writing them to an fov.nc file is a separate step.
+When several windows are wanted from a file that is too big to load, select_fov_windows
+and iter_window_blocks read each record once and hand it to every window it falls in.
+
+"""
+__docformat__ = "restructuredtext en"
+
+import logging
+
+import numpy
+
+from shis2mirto.guidebook  import *
+from shis2mirto.channels   import match_wavenumbers_cached
+from shis2mirto.extraction import read_masked_records, record_blocks
+from shis2mirto.ncoutput   import OutputFormat
+from shis2mirto.pipeline   import NETCDF_LOCK, prefetch
+from shis2mirto.timeconv   import epoch_seconds_to_matlab_datenum, epoch_seconds_to_datetimes
+
+log = logging.getLogger(__name__)
+
+class ShisData (object) :
+    """SHIS data held in memory, with a variables dictionary like a netCDF4 Dataset"""
+
+    def __init__ (self, variables) :
+        """
+        :param variables: a dictionary of arrays keyed on the SHIS variable names
+        """
+
+        self.variables = variables
+
+def load_shis_data (shis_dataset, variable_names=SHIS_VAR_NAMES) :
+    """read the SHIS variables we use into memory
+
+    :param shis_dataset:   an open SHIS netCDF4 Dataset
+    :param variable_names: the variables to read
+    :return: a ShisData object that can be used in place of the Dataset
+    """
+
+    return ShisData(dict((name, shis_dataset.variables[name][:]) for name in variable_names))
+
+class FovProduct (object) :
+    """the selected SHIS observations and channels that make up an fov.nc file
+
+    Any of the per observation arrays may be None if they weren't loaded (ie. the radiances
+    when only the positions of the observations are needed).
+    """
+
+    def __init__ (self, base_time, lon, lat, time_offset, matlab_time, fov_angle,
+                  radiances, wavenumbers, selected_indexes, selected_radiances=None, fov_count=None) :
+        """
+        :param base_time:          the SHIS base time in seconds since the epoch
+        :param lon:                a (num_obs,) array of longitudes
+        :param lat:                a (num_obs,) array of latitudes
+        :param time_offset:        a (num_obs,) array of seconds since the base time
+        :param matlab_time:        a (num_obs,) array of matlab datenums
+        :param fov_angle:          a (num_obs,) array of fov angles
+        :param radiances:          a (num_obs, num_channels) array of radiances, or None if only the
+                                   selected channels were read
+        :param wavenumbers:        a (num_channels,) array of all the SHIS wave numbers
+        :param selected_indexes:   a (num_selected_channels,) array of 0 based channel indexes
+        :param selected_radiances: a (num_obs, num_selected_channels) array, taken from the radiances if not given
+        :param fov_count:          a (num_obs,) array of the number of fovs averaged into each observation, or
+                                   None if the observations are single fovs
+        """
+
+        self.base_time          = base_time
+        self.lon                = lon
+        self.lat                = lat
+        self.time_offset        = time_offset
+        self.matlab_time        = matlab_time
+        self.fov_angle          = fov_angle
+        self.radiances          = radiances
+        self.wavenumbers        = wavenumbers
+        self.selected_indexes   = numpy.asarray(selected_indexes)
+        if selected_radiances is None and radiances is not None :
+            # one take along the channel axis, into a new buffer laid out for writing
+            selected_radiances  = radiances.take(self.selected_indexes, axis=1)
+        self.selected_radiances = selected_radiances
+        self.fov_count          = fov_count
+
+    @property
+    def num_obs (self) :
+        return self.lon.size
+
+    @property
+    def selected_wavenumbers (self) :
+        return self.wavenumbers[self.selected_indexes]
+
+    def subset (self, obs_mask) :
+        """get a new FovProduct with only some of the observations
+
+        :param obs_mask: a (num_obs,) boolean array, True for each observation to keep, or an array
+                         of the indexes of the observations to keep, in the order to keep them
+        :return: a FovProduct
+        """
+
+        def _take (data) :
+            return None if data is None else data[obs_mask]
+
+        return FovProduct(self.base_time, _take(self.lon), _take(self.lat), _take(self.time_offset),
+                          _take(self.matlab_time), _take(self.fov_angle), _take(self.radiances),
+                          self.wavenumbers, self.selected_indexes, selected_radiances=_take(self.selected_radiances),
+                          fov_count=_take(self.fov_count))
+
+    def epoch_seconds (self) :
+        """get the time of each observation in seconds since the epoch"""
+
+        return self.time_offset + self.base_time
+
+    def datetimes (self, time_zone=DEFAULT_TIME_ZONE_POLICY) :
+        """get the time of each observation as a datetime"""
+
+        return epoch_seconds_to_datetimes(self.epoch_seconds(), time_zone=time_zone)
+
+def fov_angle_mask (fov_angles, center_angle, angle_range) :
+    """build a mask of the fov angles that fall within angle_range of the center_angle
+
+    >>> fov_angle_mask(numpy.array([-3.0, -1.0, 0.0, 1.5, 2.0]), 0.0, 1.5).tolist()
+    [False, True, True, True, False]
+
+    :param fov_angles:   an array of fov angles
+    :param center_angle: the central fov angle we want
+    :param angle_range:  how far to either side of the center angle is acceptable
+    :return: a boolean array the same shape as fov_angles
+    """
+
+    temp_mask = (fov_angles >= (center_angle - angle_range)) & (fov_angles <= (center_angle + angle_range))
+
+    return numpy.ma.filled(temp_mask, False)
+
+def select_channels (shis_data, desired_wavenumbers, tolerance=None, cache_dir=None) :
+    """find the SHIS channels that best match the desired wave numbers
+
+    :param shis_data:           an open SHIS Dataset or a ShisData object
+    :param desired_wavenumbers: the sorted wave numbers we want
+    :param tolerance:           the largest acceptable difference between a desired wave number and a channel
+    :param cache_dir:           a directory to save and reuse the index maps in, or None
+    :return: a (num_selected_channels,) array of 0 based channel indexes
+    :raises ValueError: if any of the desired wave numbers couldn't be matched
+    """
+
+    desired_wavenumbers = numpy.asarray(desired_wavenumbers)
+    found_indexes       = match_wavenumbers_cached(desired_wavenumbers, shis_data.variables[SHIS_WAVE_NUMBER_VAR_NAME][:],
+                                                   tolerance=tolerance, cache_dir=cache_dir)
+    if numpy.min(found_indexes) < 0 :
+        raise ValueError("Unable to find desired wave numbers in SHIS file: " +
+                         str(desired_wavenumbers[found_indexes < 0]))
+
+    return found_indexes
+
+def parse_fov_windows (windows_spec) :
+    """parse a list of fov angle windows, given as comma separated name:center:range entries
+
+    >>> parse_fov_windows("nadir:0:1.5, left15:-15:1.5")
+    [('nadir', 0.0, 1.5), ('left15', -15.0, 1.5)]
+
+    :param windows_spec: the window list string
+    :return: a list of (name, center angle, angle range) tuples
+    :raises ValueError: if an entry can't be parsed or a name is used twice
+    """
+
+    windows = [ ]
+    for entry in windows_spec.split(",") :
+        if not entry.strip() :
+            continue
+        parts = entry.strip().split(":")
+        if len(parts) != 3 or not parts[0] :
+            raise ValueError("Unable to parse fov window, expected name:center:range: " + entry.strip())
+        windows.append((parts[0], float(parts[1]), float(parts[2])))
+
+    names = [window[0] for window in windows]
+    if len(set(names)) != len(names) :
+        raise ValueError("Each fov window must have a different name: " + ", ".join(names))
+
+    return windows
+
+def count_fov_obs (shis_data, center_angle, angle_range, block_size=None) :
+    """count the observations with acceptable fov angles, one block of records at a time
+
+    :param shis_data:    an open SHIS Dataset or a ShisData object
+    :param center_angle: the central fov angle we want
+    :param angle_range:  how far to either side of the center angle is acceptable
+    :param block_size:   the number of records to look at at once; None for all of them
+    :return: the number of acceptable observations
+    """
+
+    return count_window_obs(shis_data, [(None, center_angle, angle_range)], block_size=block_size)[0]
+
+def new_record_mask (shis_data, existing_epoch_seconds, time_resolution=SHIS_TIME_RESOLUTION_SECONDS) :
+    """find the SHIS records whose times aren't already in a list of existing times
+
+    The times are compared after rounding them to the time resolution, so a record still
+    matches when its time was written relative to a different base time and came back a
+    tiny bit off.
+
+    >>> shis_data = ShisData({SHIS_BASE_TIME_VAR_NAME: numpy.array([100.0]),
+    ...                       SHIS_TIME_OFFSET_VAR_NAME: numpy.array([0.0, 0.5, 1.0])})
+    >>> new_record_mask(shis_data, numpy.array([100.0, 100.5])).tolist()
+    [False, False, True]
+    >>> new_record_mask(shis_data, numpy.array([100.0 - 1.0e-6, 100.5 + 1.0e-6])).tolist()
+    [False, False, True]
+
+    :param shis_data:              an open SHIS Dataset or a ShisData object
+    :param existing_epoch_seconds: the times already written, in seconds since the epoch
+    :param time_resolution:        times that round to the same multiple of this many seconds are the same
+    :return: a boolean array with one entry per record, True for the new records
+    """
+
+    epoch_seconds  = (numpy.ma.getdata(shis_data.variables[SHIS_TIME_OFFSET_VAR_NAME][:]) +
+                      shis_data.variables[SHIS_BASE_TIME_VAR_NAME][0])
+    record_ticks   = numpy.rint(numpy.asarray(epoch_seconds, dtype=numpy.float64) / time_resolution).astype(numpy.int64)
+    existing_ticks = numpy.rint(numpy.asarray(numpy.ma.getdata(existing_epoch_seconds), dtype=numpy.float64) /
+                                time_resolution).astype(numpy.int64)
+
+    return ~numpy.isin(record_ticks, existing_ticks)
+
+def _window_masks (temp_angles, windows, record_filters, block_start, block_stop) :
+    """build the mask of acceptable records in a block for each window"""
+
+    window_masks = [ ]
+    for index, (name, center_angle, angle_range) in enumerate(windows) :
+        window_mask = fov_angle_mask(temp_angles, center_angle, angle_range)
+        if record_filters is not None and record_filters[index] is not None :
+            window_mask = window_mask & record_filters[index][block_start:block_stop]
+        window_masks.append(window_mask)
+
+    return window_masks
+
+def count_window_obs (shis_data, windows, block_size=None, record_filters=None) :
+    """count the observations in each of several fov angle windows, reading the angles once
+
+    :param shis_data:      an open SHIS Dataset or a ShisData object
+    :param windows:        a list of (name, center angle, angle range) tuples
+    :param block_size:     the number of records to look at at once; None for all of them
+    :param record_filters: an optional list with one entry per window of either None or a boolean array
+                           over all the records, False for records the window should skip
+    :return: a list with the number of acceptable observations in each window
+    """
+
+    angle_variable = shis_data.variables[SHIS_FOV_ANGLE_VAR_NAME]
+    num_obs        = [0] * len(windows)
+    for block_start, block_stop in record_blocks(angle_variable.shape[0], block_size) :
+        window_masks = _window_masks(angle_variable[block_start:block_stop], windows, record_filters, block_start, block_stop)
+        for index, window_mask in enumerate(window_masks) :
+            num_obs[index] += int(numpy.sum(window_mask))
+
+    return num_obs
+
+def _read_windows_block (shis_data, windows, block_start, block_stop, record_filters=None, selected_indexes=None) :
+    """read the records in one block that fall in at least one window
+
+    This is the only part of the selection that reads from the SHIS data, so it holds
+    the NETCDF_LOCK while it works. If selected_indexes are given, only those channels
+    of the radiances are read (as 'selected_radiances') and 'radiances' is None.
+
+    :return: a dictionary of the window masks, the block mask and the data for the records in the block mask
+    """
+
+    with NETCDF_LOCK :
+        variables   = shis_data.variables
+
+        # figure out which observations in this block have acceptable fov angles for any window
+        temp_angles  = variables[SHIS_FOV_ANGLE_VAR_NAME][block_start:block_stop]
+        window_masks = _window_masks(temp_angles, windows, record_filters, block_start, block_stop)
+        block_mask   = numpy.logical_or.reduce(window_masks) if len(window_masks) > 1 else window_masks[0]
+
+        # one read per contiguous run of records, of either all the channels or just the selected ones
+        radiance_var = variables[SHIS_RADIANCE_VAR_NAME]
+        if selected_indexes is None :
+            all_radiances = read_masked_records(radiance_var, block_mask, first_record=block_start)
+            sel_radiances = None
+        else :
+            all_radiances = None
+            sel_radiances = read_masked_records(radiance_var, block_mask, first_record=block_start,
+                                                columns=selected_indexes)
+
+        return {
+                'window_masks':       window_masks,
+                'block_mask':         block_mask,
+                'base_time':          variables[SHIS_BASE_TIME_VAR_NAME][0],
+                'lon':                variables[SHIS_LON_VAR_NAME][block_start:block_stop][block_mask],
+                'lat':                variables[SHIS_LAT_VAR_NAME][block_start:block_stop][block_mask],
+                'time_offset':        variables[SHIS_TIME_OFFSET_VAR_NAME][block_start:block_stop][block_mask],
+                'fov_angle':          temp_angles[block_mask],
+                'radiances':          all_radiances,
+                'selected_radiances': sel_radiances,
+                'wavenumbers':        variables[SHIS_WAVE_NUMBER_VAR_NAME][:],
+               }
+
+def _split_windows_block (block_data, selected_indexes, time_zone) :
+    """select the channels from a block read by _read_windows_block and split its records up between the windows
+
+    :return: a list of FovProducts, one per window
+    """
+
+    base_time     = block_data['base_time']
+    block_mask    = block_data['block_mask']
+    block_product = FovProduct(base_time,
+                               block_data['lon'],
+                               block_data['lat'],
+                               block_data['time_offset'],
+                               epoch_seconds_to_matlab_datenum(block_data['time_offset'] + base_time, time_zone=time_zone),
+                               block_data['fov_angle'],
+                               block_data['radiances'],
+                               block_data['wavenumbers'],
+                               selected_indexes,
+                               selected_radiances=block_data['selected_radiances'])
+
+    # split the records up between the windows, without copying when a window wants all of them
+    window_products = [ ]
+    for window_mask in block_data['window_masks'] :
+        obs_mask = window_mask[block_mask]
+        window_products.append(block_product if numpy.all(obs_mask) else block_product.subset(obs_mask))
+
+    return window_products
+
+def _select_windows_block (shis_data, selected_indexes, windows, block_start, block_stop, time_zone, record_filters=None,
+                           selected_only=False) :
+    """build a FovProduct for each window from one block of records
+
+    The records are read once for all the windows, only the records that fall in at least
+    one window are read, and then each window takes its own observations from them.
+    """
+
+    block_data = _read_windows_block(shis_data, windows, block_start, block_stop, record_filters=record_filters,
+                                     selected_indexes=selected_indexes if selected_only else None)
+
+    return _split_windows_block(block_data, selected_indexes, time_zone)
+
+def iter_fov_blocks (shis_data, selected_indexes, center_angle, angle_range, block_size=None,
+                     time_zone=DEFAULT_TIME_ZONE_POLICY, selected_only=False) :
+    """generate a FovProduct for each block of records that has acceptable observations
+
+    This lets large files be streamed, so memory use depends on the block size rather than
+    on the file size.
+
+    :param shis_data:        an open SHIS Dataset or a ShisData object
+    :param selected_indexes: the 0 based indexes of the selected channels
+    :param center_angle:     the central fov angle we want
+    :param angle_range:      how far to either side of the center angle is acceptable
+    :param block_size:       the number of records per block; None for all of them at once
+    :param time_zone:        the time zone policy used for the matlab datenums
+    :param selected_only:    only read the selected channels; the products won't have the full radiances
+    """
+
+    for window_blocks in iter_window_blocks(shis_data, selected_indexes, [(None, center_angle, angle_range)],
+                                            block_size=block_size, time_zone=time_zone, selected_only=selected_only) :
+        yield window_blocks[0]
+
+def iter_window_blocks (shis_data, selected_indexes, windows, block_size=None, time_zone=DEFAULT_TIME_ZONE_POLICY,
+                        record_filters=None, queue_depth=None, selected_only=False) :
+    """generate a list of FovProducts, one per window, for each block of records
+
+    Every block of records is read once, no matter how many windows there are. Blocks
+    without any acceptable observations for any of the windows are skipped; individual
+    windows may still have no observations in a block.
+
+    With a queue_depth, the blocks are read in one background thread and their channels
+    are selected in another, each keeping up to queue_depth blocks ready, so reading the
+    next blocks overlaps with whatever the caller does with this one. The blocks come out
+    the same either way. Anything the caller does with netCDF files while iterating
+    should hold the NETCDF_LOCK (FovFileWriter does).
+
+    :param shis_data:        an open SHIS Dataset or a ShisData object
+    :param selected_indexes: the 0 based indexes of the selected channels
+    :param windows:          a list of (name, center angle, angle range) tuples
+    :param block_size:       the number of records per block; None for all of them at once
+    :param time_zone:        the time zone policy used for the matlab datenums
+    :param record_filters:   an optional list with one entry per window of either None or a boolean array
+                             over all the records, False for records the window should skip (see new_record_mask)
+    :param queue_depth:      the number of blocks to read ahead in background threads; None to work serially
+    :param selected_only:    only read the selected channels; the products won't have the full radiances
+    """
+
+    num_records = shis_data.variables[SHIS_FOV_ANGLE_VAR_NAME].shape[0]
+    all_blocks  = record_blocks(num_records, block_size)
+
+    if queue_depth :
+        read_indexes  = selected_indexes if selected_only else None
+        raw_blocks    = prefetch((_read_windows_block(shis_data, windows, block_start, block_stop,
+                                                      record_filters=record_filters, selected_indexes=read_indexes)
+                                  for block_start, block_stop in all_blocks), queue_depth=queue_depth)
+        window_blocks = prefetch((_split_windows_block(block_data, selected_indexes, time_zone)
+                                  for block_data in raw_blocks), queue_depth=queue_depth)
+    else :
+        window_blocks = (_select_windows_block(shis_data, selected_indexes, windows, block_start, block_stop, time_zone,
+                                               record_filters=record_filters, selected_only=selected_only)
+                         for block_start, block_stop in all_blocks)
+
+    for window_products in window_blocks :
+        if any(product.num_obs > 0 for product in window_products) :
+            yield window_products
+
+def select_fov (shis_data, desired_wavenumbers, center_angle=0.0, angle_range=1.5,
+                tolerance=None, cache_dir=None, time_zone=DEFAULT_TIME_ZONE_POLICY, selected_only=False) :
+    """select the observations and channels from SHIS data that go in an fov.nc file
+
+    :param shis_data:           an open SHIS Dataset or a ShisData object
+    :param desired_wavenumbers: the wave numbers we want
+    :param center_angle:        the central fov angle we want
+    :param angle_range:         how far to either side of the center angle is acceptable
+    :param tolerance:           the largest acceptable difference between a desired wave number and a channel
+    :param cache_dir:           a directory to save and reuse the wave number index maps in, or None
+    :param time_zone:           the time zone policy used for the matlab datenums
+    :param selected_only:       only read the selected channels; the product won't have the full radiances
+    :return: a FovProduct
+    :raises ValueError: if any of the desired wave numbers couldn't be matched
+    """
+
+    return select_fov_windows(shis_data, desired_wavenumbers, [(None, center_angle, angle_range)],
+                              tolerance=tolerance, cache_dir=cache_dir, time_zone=time_zone,
+                              selected_only=selected_only)[0]
+
+def select_fov_windows (shis_data, desired_wavenumbers, windows,
+                        tolerance=None, cache_dir=None, time_zone=DEFAULT_TIME_ZONE_POLICY, selected_only=False) :
+    """select the observations for several fov angle windows at once, reading the SHIS data once
+
+    :param shis_data:           an open SHIS Dataset or a ShisData object
+    :param desired_wavenumbers: the wave numbers we want
+    :param windows:             a list of (name, center angle, angle range) tuples
+    :param tolerance:           the largest acceptable difference between a desired wave number and a channel
+    :param cache_dir:           a directory to save and reuse the wave number index maps in, or None
+    :param time_zone:           the time zone policy used for the matlab datenums
+    :param selected_only:       only read the selected channels; the products won't have the full radiances
+    :return: a list of FovProducts, one per window
+    :raises ValueError: if any of the desired wave numbers couldn't be matched
+    """
+
+    selected_indexes = select_channels(shis_data, numpy.sort(desired_wavenumbers), tolerance=tolerance, cache_dir=cache_dir)
+    num_records      = shis_data.variables[SHIS_FOV_ANGLE_VAR_NAME].shape[0]
+
+    return _select_windows_block(shis_data, selected_indexes, windows, 0, num_records, time_zone,
+                                 selected_only=selected_only)
+
+class FovFileWriter (object) :
+    """write an fov.nc file, one block of observations at a time
+
+    New files are created by the constructor; use FovFileWriter.append_to to add
+    observations to the end of an existing file that has an unlimited obsnum dimension.
+    A selected only file leaves out the full Radiance variable, only selradiances is written.
+    Files of thinned super-observations also have a variable with the number of fovs in each.
+    """
+
+    def __init__ (self, file_path, num_obs, wavenumbers, selected_indexes, base_time,
+                  radiance_dtype=numpy.float64, output_format=None, selected_only=False, fov_count=False,
+                  provenance=None) :
+        """create the file and all its variables, and fill in the ones that don't depend on the observations
+
+        :param file_path:        the path of the fov.nc file to create
+        :param num_obs:          the total number of observations that will be written, or None to make
+                                 the obsnum dimension unlimited so the file can be appended to later
+        :param wavenumbers:      a (num_channels,) array of all the SHIS wave numbers
+        :param selected_indexes: a (num_selected_channels,) array of 0 based channel indexes
+        :param base_time:        the SHIS base time in seconds since the epoch
+        :param radiance_dtype:   the data type of the SHIS radiances, kept in formats that allow it
+        :param output_format:    the OutputFormat to write, classic if this is None
+        :param selected_only:    leave out the full Radiance variable
+        :param fov_count:        add the variable with the number of fovs in each observation
+        :param provenance:       an optional Provenance to record in the file's global attributes
+        """
+
+        output_format         = OutputFormat() if output_format is None else output_format
+        num_channels          = wavenumbers.size
+        num_selected_channels = selected_indexes.size
+        self.num_obs          = num_obs
+        self.base_time        = base_time
+        self.selected_indexes = selected_indexes
+        self.position         = 0
+        self.provenance       = provenance
+
+        self.out_fov_file = output_format.create_dataset(file_path)
+        out_fov_file      = self.out_fov_file
+        if provenance is not None :
+            provenance.write_attributes(out_fov_file)
+
+        def _create_variable (var_name, native_dtype, dimensions=()) :
+            return output_format.create_variable(out_fov_file, var_name, native_dtype, dimensions)
+
+        # create the global dimensions we're going to need
+        out_fov_file.createDimension(OUT_FOV_OBS_NUM_DIM_NAME,               size=num_obs)
+        out_fov_file.createDimension(OUT_FOV_NUM_CHANNELS_DIM_NAME,          size=num_channels)
+        out_fov_file.createDimension(OUT_FOV_NUM_SELECTED_CHANNELS_DIM_NAME, size=num_selected_channels)
+
+        # create the longitude and latitude variables
+        self.out_lon_var = _create_variable(OUT_FOV_LON_VAR_NAME, numpy.float64, (OUT_FOV_OBS_NUM_DIM_NAME))
+        self.out_lat_var = _create_variable(OUT_FOV_LAT_VAR_NAME, numpy.float64, (OUT_FOV_OBS_NUM_DIM_NAME))
+
+        # copy the base time and create the other time variables
+        temp_var = _create_variable(OUT_FOV_BASE_TIME_VAR_NAME, numpy.float64)
+        temp_var.assignValue(base_time)
+        self.out_time_offset_var = _create_variable(OUT_FOV_TIME_OFFSET_VAR_NAME, numpy.float64, (OUT_FOV_OBS_NUM_DIM_NAME))
+        # also need the time in the matlab datenum format
+        # "TimeFracDay == is the equivalent of the matlab datenum function, 1 corresponds to Jan-1-0000 "
+        self.out_matlab_time_var = _create_variable(OUT_FOV_MATLAB_DATENUM_TIME_VAR_NAME, numpy.float64, OUT_FOV_OBS_NUM_DIM_NAME)
+
+        # create the fov angles and radiances variables
+        self.out_fov_angle_var = _create_variable(OUT_FOV_FOV_ANGLE_VAR_NAME, numpy.float64, (OUT_FOV_OBS_NUM_DIM_NAME))
+        self.out_radiance_var  = None
+        if not selected_only :
+            self.out_radiance_var = _create_variable(OUT_FOV_RADIANCE_VAR_NAME, radiance_dtype, (OUT_FOV_OBS_NUM_DIM_NAME, 'channels'))
+
+        # the full list of wave numbers
+        temp_var = _create_variable(OUT_FOV_WAVE_NUMBER_VAR_NAME, numpy.float64, (OUT_FOV_NUM_CHANNELS_DIM_NAME))
+        temp_var[0:num_channels] = wavenumbers
+
+        # the selected wave numbers
+        temp_var = _create_variable(OUT_FOV_SELECTED_WAVE_NUMBER_VAR_NAME, numpy.float64, (OUT_FOV_NUM_SELECTED_CHANNELS_DIM_NAME))
+        temp_var[0:num_selected_channels] = wavenumbers[selected_indexes]
+
+        # the indexes of the selected channels
+        temp_var = _create_variable(OUT_FOV_SELECTED_CHANNEL_IDX_VAR_NAME, numpy.int32, (OUT_FOV_NUM_SELECTED_CHANNELS_DIM_NAME))
+        temp_var[0:num_selected_channels] = selected_indexes + 1 # we will use matlab indexing here
+
+        # create the selected radiances variable
+        self.out_sel_radiance_var = _create_variable(OUT_FOV_SELECTED_RADIANCE_VAR_NAME, radiance_dtype,
+                                                     (OUT_FOV_OBS_NUM_DIM_NAME, OUT_FOV_NUM_SELECTED_CHANNELS_DIM_NAME))
+
+        # the number of fovs that went into each super-observation
+        self.out_fov_count_var = None
+        if fov_count :
+            self.out_fov_count_var = _create_variable(OUT_FOV_FOV_COUNT_VAR_NAME, numpy.int32, (OUT_FOV_OBS_NUM_DIM_NAME))
+
+    @classmethod
+    def append_to (cls, file_path, selected_indexes, provenance=None) :
+        """open an existing fov.nc file to add more observations to the end of it
+
+        :param file_path:        the path of the existing fov.nc file
+        :param selected_indexes: the 0 based channel indexes of the observations that will be added
+        :param provenance:       an optional Provenance to record in the file's global attributes in place of
+                                 the one it had
+        :return: a FovFileWriter, which is selected only if the file doesn't have the full Radiance variable
+        :raises ValueError: if the file can't be appended to or was made with different channels
+        """
+
+        import netCDF4 as nc
+
+        out_fov_file = nc.Dataset(file_path, 'a')
+        variables    = out_fov_file.variables
+        if not out_fov_file.dimensions[OUT_FOV_OBS_NUM_DIM_NAME].isunlimited() :
+            out_fov_file.close()
+            raise ValueError("Unable to append to " + file_path + " because its " + OUT_FOV_OBS_NUM_DIM_NAME +
+                             " dimension isn't unlimited")
+        file_indexes = numpy.asarray(variables[OUT_FOV_SELECTED_CHANNEL_IDX_VAR_NAME][:], dtype=numpy.int64) - 1
+        if not numpy.array_equal(file_indexes, selected_indexes) :
+            out_fov_file.close()
+            raise ValueError("Unable to append to " + file_path + " because it has different selected channels")
+
+        if provenance is not None :
+            provenance.write_attributes(out_fov_file)
+
+        writer = cls.__new__(cls)
+        writer.provenance           = provenance
+        writer.out_fov_file         = out_fov_file
+        writer.num_obs              = None
+        writer.base_time            = variables[OUT_FOV_BASE_TIME_VAR_NAME][0]
+        writer.selected_indexes     = selected_indexes
+        writer.position             = len(out_fov_file.dimensions[OUT_FOV_OBS_NUM_DIM_NAME])
+        writer.out_lon_var          = variables[OUT_FOV_LON_VAR_NAME]
+        writer.out_lat_var          = variables[OUT_FOV_LAT_VAR_NAME]
+        writer.out_time_offset_var  = variables[OUT_FOV_TIME_OFFSET_VAR_NAME]
+        writer.out_matlab_time_var  = variables[OUT_FOV_MATLAB_DATENUM_TIME_VAR_NAME]
+        writer.out_fov_angle_var    = variables[OUT_FOV_FOV_ANGLE_VAR_NAME]
+        writer.out_radiance_var     = variables.get(OUT_FOV_RADIANCE_VAR_NAME)
+        writer.out_sel_radiance_var = variables[OUT_FOV_SELECTED_RADIANCE_VAR_NAME]
+        writer.out_fov_count_var    = variables.get(OUT_FOV_FOV_COUNT_VAR_NAME)
+
+        return writer
+
+    @property
+    def selected_only (self) :
+        return self.out_radiance_var is None
+
+    def epoch_seconds (self) :
+        """get the times of the observations already in the file, in seconds since the epoch"""
+
+        return self.out_time_offset_var[0:self.position] + self.base_time
+
+    def write_block (self, product) :
+        """write the observations in a FovProduct after the ones already written
+
+        :param product: a FovProduct with the same channels the file was created with; it only needs
+                        the full radiances if the file isn't selected only
+        """
+
+        out_start = self.position
+        out_stop  = out_start + product.num_obs
+        if self.num_obs is not None and out_stop > self.num_obs :
+            raise ValueError("More observations written than the fov file was created for: " + str(out_stop))
+        if product.radiances is None and not self.selected_only :
+            raise ValueError("Unable to write the full radiances to the fov file, only the selected channels were read")
+
+        # keep the time offsets relative to the base time in the file
+        time_offset = product.time_offset
+        if product.base_time != self.base_time :
+            time_offset = product.epoch_seconds() - self.base_time
+
+        # the SHIS file may be being read in another thread (see iter_window_blocks)
+        with NETCDF_LOCK :
+            self.out_lon_var[out_start:out_stop]             = product.lon
+            self.out_lat_var[out_start:out_stop]             = product.lat
+            self.out_time_offset_var[out_start:out_stop]     = time_offset
+            self.out_matlab_time_var[out_start:out_stop]     = product.matlab_time
+            self.out_fov_angle_var[out_start:out_stop]       = product.fov_angle
+            if not self.selected_only :
+                self.out_radiance_var[out_start:out_stop, :] = product.radiances
+            self.out_sel_radiance_var[out_start:out_stop, :] = product.selected_radiances
+            if self.out_fov_count_var is not None :
+                fov_count = product.fov_count if product.fov_count is not None else numpy.ones(product.num_obs, dtype=numpy.int32)
+                self.out_fov_count_var[out_start:out_stop]   = fov_count
+
+        self.position = out_stop
+
+    def close (self) :
+        """close the file, recording that it was finished if it has a provenance"""
+
+        with NETCDF_LOCK :
+            if self.provenance is not None :
+                self.provenance.mark_complete(self.out_fov_file)
+            self.out_fov_file.close()
+
+def write_fov_file (product, file_path, output_format=None) :
+    """write a FovProduct to an fov.nc file
+
+    :param product:       the FovProduct to save
+    :param file_path:     the path of the fov.nc file to create
+    :param output_format: the OutputFormat to write, classic if this is None; the file is selected only
+                          if the product doesn't have the full radiances, and has the fov counts if the product does
+    """
+
+    radiance_dtype = product.selected_radiances.dtype if product.selected_radiances is not None else numpy.float64
+    writer         = FovFileWriter(file_path, product.num_obs, product.wavenumbers, product.selected_indexes,
+                                   product.base_time, radiance_dtype=radiance_dtype, output_format=output_format,
+                                   selected_only=product.radiances is None, fov_count=product.fov_count is not None)
+    if product.num_obs > 0 :
+        writer.write_block(product)
+    writer.close()
+
+def read_fov_file (file_path, include_radiances=True) :
+    """load an fov.nc file back into a FovProduct
+
+    :param file_path:         the path of the fov.nc file
+    :param include_radiances: whether to load the radiances; without them only the positions and times are loaded
+    :return: a FovProduct, without the full radiances if the file is selected only
+    """
+
+    import netCDF4 as nc
+
+    fov_file  = nc.Dataset(file_path, 'r')
+    variables = fov_file.variables
+    has_all   = include_radiances and OUT_FOV_RADIANCE_VAR_NAME in variables
+    radiances = variables[OUT_FOV_RADIANCE_VAR_NAME][:]          if has_all           else None
+    sel_rads  = variables[OUT_FOV_SELECTED_RADIANCE_VAR_NAME][:] if include_radiances else None
+    fov_count = variables[OUT_FOV_FOV_COUNT_VAR_NAME][:]         if OUT_FOV_FOV_COUNT_VAR_NAME in variables else None
+    product   = FovProduct(variables[OUT_FOV_BASE_TIME_VAR_NAME][0],
+                           variables[OUT_FOV_LON_VAR_NAME][:],
+                           variables[OUT_FOV_LAT_VAR_NAME][:],
+                           variables[OUT_FOV_TIME_OFFSET_VAR_NAME][:],
+                           variables[OUT_FOV_MATLAB_DATENUM_TIME_VAR_NAME][:],
+                           variables[OUT_FOV_FOV_ANGLE_VAR_NAME][:],
+                           radiances,
+                           variables[OUT_FOV_WAVE_NUMBER_VAR_NAME][:],
+                           numpy.asarray(variables[OUT_FOV_SELECTED_CHANNEL_IDX_VAR_NAME][:], dtype=numpy.int64) - 1,
+                           selected_radiances=sel_rads, fov_count=fov_count)
+    fov_file.close()
+
+    return product
@@ -18,8 +18,9 @@ constants that are shared throughout the package.
 """
 __docformat__ = "restructuredtext en"
 
-import sys
+import sys, os
 import logging
+import tempfile
 import numpy
 
 log = logging.getLogger(__name__)
@@ -38,9 +39,32 @@ SHIS_LON_VAR_NAME                      = 'Longitude'
 SHIS_LAT_VAR_NAME                      = 'Latitude'
 SHIS_BASE_TIME_VAR_NAME                = "base_time"
 SHIS_TIME_OFFSET_VAR_NAME              = "time_offset"
+SHIS_VAR_NAMES                         = [SHIS_WAVE_NUMBER_VAR_NAME, SHIS_FOV_ANGLE_VAR_NAME, SHIS_RADIANCE_VAR_NAME,
+                                          SHIS_LON_VAR_NAME, SHIS_LAT_VAR_NAME, SHIS_BASE_TIME_VAR_NAME,
+                                          SHIS_TIME_OFFSET_VAR_NAME]
+SHIS_TIME_RESOLUTION_SECONDS           = 0.01 # records whose times round to the same 10 ms are the same record
+
+# the ways SHIS files can be read
+SHIS_READER_NETCDF4                    = 'netcdf4' # through the netCDF library
+SHIS_READER_MMAP                       = 'mmap'    # NETCDF3 classic files through memory maps, others through netCDF4
+SHIS_READERS                           = [SHIS_READER_NETCDF4, SHIS_READER_MMAP]
+DEFAULT_SHIS_READER                    = SHIS_READER_NETCDF4
+
+# constants for the lat/lon and time index of the SHIS records
+DEFAULT_OBS_INDEX_BUCKET_DEGREES       = 1.0    # the size of the lat/lon grid buckets
+OBS_INDEX_FILE_SUFFIX                  = ".npz" # saved indexes are named with a key for the granule and this
+
+# constants for thinning the observations into distance and time buckets
+THIN_MODE_PICK                         = 'pick'    # keep some of the fovs in each bucket as they are
+THIN_MODE_AVERAGE                      = 'average' # replace the fovs in each bucket with one super-observation
+THIN_MODES                             = [THIN_MODE_PICK, THIN_MODE_AVERAGE]
+DEFAULT_THIN_DISTANCE_KM               = 10.0  # the size of the buckets along and across the ground
+DEFAULT_THIN_SECONDS                   = 60.0  # the length of the buckets in time
+KM_PER_DEGREE_LATITUDE                 = 111.195
 
 # constants for the output fov.nc file
 OUT_FOV_FILE_NAME                      = "fov.nc"
+OUT_FOV_WINDOW_FILE_NAME_PATTERN       = "fov_%s.nc" # filled in with the window name
 OUT_FOV_OBS_NUM_DIM_NAME               = 'obsnum'
 OUT_FOV_NUM_CHANNELS_DIM_NAME          = "channels"
 OUT_FOV_NUM_SELECTED_CHANNELS_DIM_NAME = "selected_channels"
@@ -55,6 +79,7 @@ OUT_FOV_WAVE_NUMBER_VAR_NAME           = "Wavenumber"
 OUT_FOV_SELECTED_WAVE_NUMBER_VAR_NAME  = "SelWavenumber"
 OUT_FOV_SELECTED_CHANNEL_IDX_VAR_NAME  = "indxselchannel"
 OUT_FOV_SELECTED_RADIANCE_VAR_NAME     = "selradiances"
+OUT_FOV_FOV_COUNT_VAR_NAME             = "FOVcount" # only in thinned files, the number of fovs in each observation
 
 # constants from the virtual radiosonde data
 VR_INPUT_DATETIME_KEY                  = 'datetime'
@@ -62,12 +87,29 @@ VR_INPUT_LON_KEY                       = 'longitude'
 VR_INPUT_LAT_KEY                       = 'latitude'
 VR_INPUT_SURFACE_TEMPERATURE_KEY       = ("Temperature","surface")
 VR_INPUT_SEA_SURFACE_PRESSURE_KEY      = ("Pressure reduced to MSL","meanSea")
+VR_INPUT_SURFACE_PRESSURE_KEY          = ("Surface pressure","surface")
 VR_INPUT_OZONE_MR_KEY                  = "Ozone mixing ratio"
 VR_TEMPERATURE_KEY                     = 'tdry'
 VR_PRESSURE_KEY                        = 'pres'
+VR_RELATIVE_HUMIDITY_KEY               = 'rh'
 VR_OZONE_MR_KEY                        = 'Ozone mixing ratio'
 VR_SURFACE_TEMPERATURE_KEY             = 'Temperature_surface'
 VR_SEA_SURFACE_PRESSURE_KEY            = 'Pressure reduced to MSL_meanSea'
+VR_SURFACE_PRESSURE_KEY                = 'Surface pressure_surface'
+
+# constants for reading the SHIS records ahead in background threads
+DEFAULT_PIPELINE_CHUNK_RECORDS         = 1024 # records per block when --queue_depth is given without -k
+
+# constants for the persistent virtual radiosonde cache
+DEFAULT_VR_CACHE_DIR                   = os.path.join(tempfile.gettempdir(), 'vr')
+VR_CACHE_LAST_USED_FILE_NAME           = ".last_used"
+GFS_CYCLE_HOURS                        = 6 # the GFS is run every 6 hours
+GFS_FORECAST_STEP_HOURS                = 3 # and the forecast hours we use come every 3 hours
+GFS_GRID_SPACING_DEGREES               = 0.5
+GFS_PRESSURE_LEVELS_HPA                = [1000.0, 975.0, 950.0, 925.0, 900.0, 850.0, 800.0, 750.0, 700.0, 650.0,
+                                          600.0,  550.0, 500.0, 450.0, 400.0, 350.0, 300.0, 250.0, 200.0, 150.0,
+                                          100.0,  70.0,  50.0,  30.0,  20.0,  10.0] # the isobaric levels in the GFS files
+PASCALS_PER_HECTOPASCAL                = 100.0 # the pressure levels are in hPa, the VR surface pressures in Pa
 
 # constants for the output fg.nc file
 OUT_FG_FILE_NAME                       = "fg.nc"
@@ -83,6 +125,57 @@ OUT_FG_SEL_STATE_VECTOR_IDX_VAR_NAME   = 'varindx'
 OUT_FG_SEL_LIN_POINT_VAR_NAME          = 'selxa'
 OUT_FG_SEL_FG_STATE_VEC_VAR_NAME       = 'selx0'
 OUT_FG_SEL_PRESSURE_GRID_VAR_NAME      = 'selp'
+OUT_FG_STATE_VECTOR_VAR_NAMES          = [OUT_FG_LIN_POINT_VAR_NAME,     OUT_FG_FIRST_GUESS_STATE_VEC_VAR_NAME,
+                                          OUT_FG_SEL_LIN_POINT_VAR_NAME, OUT_FG_SEL_FG_STATE_VEC_VAR_NAME]
+OUT_FG_PRESSURE_GRID_VAR_NAMES         = [OUT_FG_PRESSURE_GRID_VAR_NAME, OUT_FG_SEL_PRESSURE_GRID_VAR_NAME]
+OUT_FG_SELECTED_VAR_NAMES              = [OUT_FG_SEL_LIN_POINT_VAR_NAME, OUT_FG_SEL_FG_STATE_VEC_VAR_NAME,
+                                          OUT_FG_SEL_PRESSURE_GRID_VAR_NAME]
+# compact fg.nc files write each distinct matrix once; this global attribute says how to rebuild the rest
+OUT_FG_COMPACT_ATTR_NAME               = "compact"
+OUT_FG_COMPACT_CONVENTION              = "xa=x0; selxa=x0(:,varindx); selx0=x0(:,varindx); selp=p(:,varindx)"
+
+# the global attributes that record what an output file was made from
+OUT_PROVENANCE_FINGERPRINT_ATTR_NAME   = "provenance_fingerprint"
+OUT_PROVENANCE_VERSION_ATTR_NAME       = "provenance_version"
+OUT_PROVENANCE_COMMAND_ATTR_NAME       = "provenance_command"
+OUT_PROVENANCE_INPUTS_ATTR_NAME        = "provenance_inputs"
+OUT_PROVENANCE_GRIDS_ATTR_NAME         = "provenance_grids"
+OUT_PROVENANCE_OPTIONS_ATTR_NAME       = "provenance_options"
+PROVENANCE_INCOMPLETE_FINGERPRINT      = "0" * 40 # a file that hasn't been finished yet
+PROVENANCE_CLASSIC_ATTR_WIDTH          = 1024 # the room kept for each of the others in classic files
+PROVENANCE_DIGEST_PREFIX               = "sha1:" # marks a value too long for its room, saved as a digest
+
+# output file format constants
+OUTPUT_FORMAT_CLASSIC                  = 'classic' # what the Mirto reader expects
+OUTPUT_FORMAT_NETCDF4                  = 'netcdf4' # HDF5 based, with chunking, compression and native data types
+OUTPUT_FORMATS                         = {
+                                          OUTPUT_FORMAT_CLASSIC: "NETCDF3_CLASSIC",
+                                          OUTPUT_FORMAT_NETCDF4: "NETCDF4",
+                                         }
+DEFAULT_OUTPUT_FORMAT                  = OUTPUT_FORMAT_CLASSIC
+DEFAULT_OUTPUT_CHUNK_OBS               = 256 # observations per chunk along the obsnum dimension
+DEFAULT_OUTPUT_COMPRESSION_LEVEL       = 4
+
+# time conversion constants
+TIME_ZONE_UTC                          = 'utc'   # epoch seconds are interpreted as UTC
+TIME_ZONE_LOCAL                        = 'local' # epoch seconds are shifted to the local time zone of the machine (the old behavior)
+TIME_ZONE_POLICIES                     = [TIME_ZONE_UTC, TIME_ZONE_LOCAL]
+DEFAULT_TIME_ZONE_POLICY               = TIME_ZONE_UTC
+SECONDS_PER_DAY                        = 24.0 * 60.0 * 60.0
+MATLAB_DATENUM_AT_UNIX_EPOCH           = 719529.0 # the matlab datenum of 1970-01-01 00:00:00
+
+# the segments of the fg.nc state vector, in the order they appear
+STATE_TEMPERATURE_SEGMENT              = 'temperature'
+STATE_WATER_VAPOR_SEGMENT              = 'water_vapor'
+STATE_CO2_SEGMENT                      = 'co2'
+STATE_OZONE_SEGMENT                    = 'ozone'
+STATE_SURFACE_TEMPERATURE_SEGMENT      = 'surface_temperature'
+STATE_SURFACE_EMISSIVITY_SEGMENT       = 'surface_emissivity'
+STATE_VECTOR_PROFILE_SEGMENTS          = [STATE_TEMPERATURE_SEGMENT, STATE_WATER_VAPOR_SEGMENT,
+                                          STATE_CO2_SEGMENT,         STATE_OZONE_SEGMENT]
+STATE_VECTOR_SURFACE_SEGMENTS          = [STATE_SURFACE_TEMPERATURE_SEGMENT, STATE_SURFACE_EMISSIVITY_SEGMENT]
+STATE_VECTOR_SEGMENTS                  = STATE_VECTOR_PROFILE_SEGMENTS + STATE_VECTOR_SURFACE_SEGMENTS
+STATE_SELECT_ALL                       = 'all' # the state selection spec that picks the whole state vector
 
 # science constants
 SURFACE_EMISSIVITY_COEFFICIENTS        = numpy.array([numpy.nan, numpy.nan, numpy.nan, numpy.nan ,numpy.nan]) # todo get constants from Paolo
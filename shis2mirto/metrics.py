@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Record how long each stage of a conversion command takes and what it costs.
+
+This file is part of the shis2mirto software package. A RunMetrics collects the wall
+time, the bytes read and written and how much each named stage of a command raised the
+peak resident memory, along with the peak of the whole run. The byte counts come from
+/proc/self/io and the memory from getrusage, so on systems that don't have them those
+numbers are left out (None). The results are plain dictionaries so they can be saved as
+JSON and fed to other tools:
+
+    metrics = RunMetrics("create_fov_file")
+    with metrics.stage("read_wavenumbers") :
+        ...
+    for block in metrics.timed_iter("extract_radiances", blocks) :
+        ...
+
+"""
+__docformat__ = "restructuredtext en"
+
+import os
+import time
+import logging
+import platform
+import contextlib
+
+log = logging.getLogger(__name__)
+
+# where linux keeps the I/O counters for the current process
+PROC_SELF_IO_PATH = "/proc/self/io"
+
+def read_io_counters () :
+    """get the number of bytes this process has read and written so far
+
+    These are the rchar / wchar counters, which count every read and write call
+    (including ones served from the page cache), so they reflect the work the
+    process asked for rather than what hit the disk.
+
+    :return: a (bytes read, bytes written) tuple, or (None, None) if they aren't available
+    """
+
+    try :
+        with open(PROC_SELF_IO_PATH, 'r') as io_file :
+            counters = dict(line.split(":", 1) for line in io_file if ":" in line)
+        return int(counters['rchar']), int(counters['wchar'])
+    except (IOError, OSError, KeyError, ValueError) :
+        return None, None
+
+def peak_rss_bytes () :
+    """get the peak resident memory of this process so far in bytes, or None if it isn't available
+
+    >>> peak_rss_bytes() is None or peak_rss_bytes() > 0
+    True
+    """
+
+    try :
+        import resource
+    except ImportError :
+        return None
+
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # linux reports kilobytes, mac os reports bytes
+    return max_rss if platform.system() == 'Darwin' else max_rss * 1024
+
+def _difference (end_value, start_value) :
+    return None if end_value is None or start_value is None else end_value - start_value
+
+class RunMetrics (object) :
+    """the timings and costs of the named stages of one command
+
+    A stage that is entered more than once (ie. once per block of records) adds up
+    its times and byte counts, and counts how many times it was entered. The process
+    only keeps its peak memory so far, so rather than a peak of its own each stage gets
+    how far it pushed that peak up (peak_rss_growth_bytes); a stage that ran after a
+    bigger one can have used a lot of memory and still show no growth.
+
+    >>> metrics = RunMetrics("example")
+    >>> with metrics.stage("first") :
+    ...     pass
+    >>> [number for number in metrics.timed_iter("second", range(3))]
+    [0, 1, 2]
+    >>> [(stage['name'], stage['calls']) for stage in metrics.as_dict()['stages']]
+    [('first', 1), ('second', 3)]
+    """
+
+    def __init__ (self, command=None) :
+        """
+        :param command: the name of the command being measured
+        """
+
+        self.command     = command
+        self.start_time  = time.time()
+        self.end_time    = None
+        self.stages      = [ ]
+        self.outputs     = { }
+        self._stage_dict = { }
+
+    def _get_stage (self, name) :
+        if name not in self._stage_dict :
+            stage_info = {
+                          'name':                  name,
+                          'seconds':               0.0,
+                          'calls':                 0,
+                          'bytes_read':            0,
+                          'bytes_written':         0,
+                          'peak_rss_growth_bytes': 0,
+                         }
+            self._stage_dict[name] = stage_info
+            self.stages.append(stage_info)
+
+        return self._stage_dict[name]
+
+    def _add_to_stage (self, name, seconds, start_io, end_io, start_rss, calls=1) :
+        stage_info = self._get_stage(name)
+        stage_info['seconds'] += seconds
+        stage_info['calls']   += calls
+        for key, start_value, end_value in (('bytes_read',            start_io[0], end_io[0]),
+                                            ('bytes_written',         start_io[1], end_io[1]),
+                                            ('peak_rss_growth_bytes', start_rss,   peak_rss_bytes())) :
+            difference = _difference(end_value, start_value)
+            stage_info[key] = None if difference is None or stage_info[key] is None else stage_info[key] + difference
+
+    @contextlib.contextmanager
+    def stage (self, name) :
+        """measure the code run inside a with block as the named stage"""
+
+        start_io   = read_io_counters()
+        start_rss  = peak_rss_bytes()
+        start_time = time.time()
+        try :
+            yield
+        finally :
+            self._add_to_stage(name, time.time() - start_time, start_io, read_io_counters(), start_rss)
+
+    def timed_iter (self, name, iterable) :
+        """iterate over something, measuring the time spent getting each item as the named stage
+
+        The time the caller spends on each item isn't counted, so a loop that reads
+        blocks from one file and writes them to another can measure each part separately.
+        """
+
+        iterator = iter(iterable)
+        while True :
+            start_io   = read_io_counters()
+            start_rss  = peak_rss_bytes()
+            start_time = time.time()
+            try :
+                item = next(iterator)
+            except StopIteration :
+                # finding out there's nothing left still takes time, but it isn't another item
+                self._add_to_stage(name, time.time() - start_time, start_io, read_io_counters(), start_rss, calls=0)
+                return
+            self._add_to_stage(name, time.time() - start_time, start_io, read_io_counters(), start_rss)
+            yield item
+
+    def add_output (self, file_path) :
+        """record the size of a file the command made"""
+
+        self.outputs[file_path] = os.path.getsize(file_path) if os.path.exists(file_path) else None
+
+    def finish (self) :
+        self.end_time = time.time()
+
+    def slowest_stage (self) :
+        """get the name of the stage that took the most time, or None if there weren't any"""
+
+        if not self.stages :
+            return None
+
+        return max(self.stages, key=lambda stage_info : stage_info['seconds'])['name']
+
+    def as_dict (self) :
+        """get the metrics as a dictionary that can be saved as JSON"""
+
+        end_time = self.end_time if self.end_time is not None else time.time()
+
+        return {
+                'command':        self.command,
+                'timestamp':      time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(self.start_time)),
+                'total_seconds':  end_time - self.start_time,
+                'peak_rss_bytes': peak_rss_bytes(),
+                'slowest_stage':  self.slowest_stage(),
+                'stages':         [dict(stage_info) for stage_info in self.stages],
+                'outputs':        dict(self.outputs),
+               }
+
+    def log_summary (self, level=logging.INFO) :
+        """log one line per stage, slowest first"""
+
+        for stage_info in sorted(self.stages, key=lambda stage_info : stage_info['seconds'], reverse=True) :
+            log.log(level, "%-24s %9.3f s  %6d calls" % (stage_info['name'], stage_info['seconds'], stage_info['calls']))
@@ -0,0 +1,422 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Read NETCDF3 classic SHIS files through memory maps instead of the netCDF library.
+
+This file is part of the shis2mirto software package. In a NETCDF3 classic (or 64-bit
+offset) file every variable sits at a fixed offset and the records of the record
+variables are a fixed stride apart, so once the header has been parsed each variable can
+be viewed as a numpy array over a memory map of the file. A ClassicDataset offers the
+parts of a netCDF4 Dataset the conversion uses (variables, dimensions, shape, dtype and
+slicing), so it can be passed to the selection code in place of one:
+
+    shis_data = open_shis_file("SHIS.nc", reader=SHIS_READER_MMAP)
+
+Slicing a variable only touches the pages of the file that hold the requested values.
+The values are stored big endian, so they are copied into the native byte order as they
+are sliced, and values equal to the fill value are masked like netCDF4 would mask them.
+Files the memory maps can't handle the same way netCDF4 would (HDF5 based files and
+variables with scale_factor, add_offset or valid range attributes) are opened with netCDF4.
+
+"""
+__docformat__ = "restructuredtext en"
+
+import struct
+import logging
+
+import numpy
+
+from shis2mirto.guidebook import *
+
+log = logging.getLogger(__name__)
+
+# the tags and magic numbers in a classic file header
+CLASSIC_MAGIC          = b'CDF'
+CLASSIC_VERSION_OFFSET = 2 # 64-bit offset files have 8 byte variable offsets
+CLASSIC_VERSION_DATA   = 5 # CDF5 files also have 8 byte counts
+CLASSIC_ABSENT         = 0
+CLASSIC_TAG_DIMENSION  = 10
+CLASSIC_TAG_VARIABLE   = 11
+CLASSIC_TAG_ATTRIBUTE  = 12
+CLASSIC_STREAMING      = -1 # the number of records while a file is still being written
+
+# the classic nc_type codes, as big endian numpy data types
+CLASSIC_TYPES = {
+                 1:  numpy.dtype('>i1'),
+                 2:  numpy.dtype('S1'),
+                 3:  numpy.dtype('>i2'),
+                 4:  numpy.dtype('>i4'),
+                 5:  numpy.dtype('>f4'),
+                 6:  numpy.dtype('>f8'),
+                 7:  numpy.dtype('>u1'),
+                 8:  numpy.dtype('>u2'),
+                 9:  numpy.dtype('>u4'),
+                 10: numpy.dtype('>i8'),
+                 11: numpy.dtype('>u8'),
+                }
+
+# the netCDF default fill values, which netCDF4 masks when a variable has no _FillValue; classic
+# files can't record that a variable was written without filling, so the byte types are included
+CLASSIC_DEFAULT_FILL_VALUES = {
+                               'i1': -127,
+                               'i2': -32767,
+                               'i4': -2147483647,
+                               'f4': 9.9692099683868690e+36,
+                               'f8': 9.9692099683868690e+36,
+                               'u1': 255,
+                               'u2': 65535,
+                               'u4': 4294967295,
+                               'i8': -9223372036854775806,
+                               'u8': 18446744073709551614,
+                              }
+
+# attributes that make netCDF4 change the values as they're read, which the memory maps don't do
+UNSUPPORTED_ATTRIBUTES = ['scale_factor', 'add_offset', 'valid_min', 'valid_max', 'valid_range']
+
+class _HeaderParser (object) :
+    """walk through the bytes of a classic file header"""
+
+    def __init__ (self, header_bytes, version) :
+        wide_offsets       = version in (CLASSIC_VERSION_OFFSET, CLASSIC_VERSION_DATA)
+        self.header_bytes  = header_bytes
+        self.position      = 4
+        self.count_format  = '>q' if version == CLASSIC_VERSION_DATA else '>i'
+        self.count_size    = 8    if version == CLASSIC_VERSION_DATA else 4
+        self.offset_format = '>q' if wide_offsets else '>i'
+        self.offset_size   = 8    if wide_offsets else 4
+
+    def _unpack (self, format_string, size) :
+        if self.position + size > len(self.header_bytes) :
+            raise EOFError("the header runs past the bytes read")
+        value = struct.unpack(format_string, self.header_bytes[self.position:self.position + size])[0]
+        self.position += size
+        return value
+
+    def int32 (self) :
+        return self._unpack('>i', 4)
+
+    def count (self) :
+        return self._unpack(self.count_format, self.count_size)
+
+    def offset (self) :
+        return self._unpack(self.offset_format, self.offset_size)
+
+    def padded_bytes (self, num_bytes) :
+        if self.position + num_bytes > len(self.header_bytes) :
+            raise EOFError("the header runs past the bytes read")
+        value = self.header_bytes[self.position:self.position + num_bytes]
+        self.position += num_bytes + (-num_bytes % 4)
+        return value
+
+    def name (self) :
+        return self.padded_bytes(self.count()).decode('utf-8')
+
+    def list_header (self, expected_tag) :
+        """read the tag and length of a list, returning the length (0 for an absent list)"""
+
+        tag       = self.int32()
+        num_items = self.count()
+        if tag not in (CLASSIC_ABSENT, expected_tag) :
+            raise ValueError("unexpected tag in the classic header: " + str(tag))
+
+        return num_items
+
+    def attributes (self) :
+        attributes = { }
+        for attr_number in range(self.list_header(CLASSIC_TAG_ATTRIBUTE)) :
+            attr_name  = self.name()
+            attr_dtype = CLASSIC_TYPES[self.int32()]
+            num_values = self.count()
+            raw_values = self.padded_bytes(num_values * attr_dtype.itemsize)
+            if attr_dtype.kind == 'S' :
+                attributes[attr_name] = raw_values.decode('utf-8', 'replace')
+            else :
+                values = numpy.frombuffer(raw_values, dtype=attr_dtype).astype(attr_dtype.newbyteorder('='))
+                attributes[attr_name] = values[0] if values.size == 1 else values
+
+        return attributes
+
+def parse_classic_header (header_bytes) :
+    """parse the header of a NETCDF3 classic, 64-bit offset or CDF5 file
+
+    :param header_bytes: the bytes at the start of the file, at least the whole header
+    :return: a dictionary with the number of records and the dimensions, global attributes and variables
+    :raises ValueError: if the bytes aren't a classic file header
+    :raises EOFError: if the header is longer than the bytes given
+    """
+
+    if header_bytes[0:3] != CLASSIC_MAGIC :
+        raise ValueError("not a NETCDF3 classic file")
+    version = bytearray(header_bytes[3:4])[0]
+    if version not in (1, CLASSIC_VERSION_OFFSET, CLASSIC_VERSION_DATA) :
+        raise ValueError("unknown NETCDF3 classic version: " + str(version))
+
+    parser      = _HeaderParser(header_bytes, version)
+    num_records = parser.count()
+
+    dimensions = [ ]
+    for dim_number in range(parser.list_header(CLASSIC_TAG_DIMENSION)) :
+        dimensions.append((parser.name(), parser.count()))
+
+    global_attributes = parser.attributes()
+
+    variables = [ ]
+    for var_number in range(parser.list_header(CLASSIC_TAG_VARIABLE)) :
+        var_name   = parser.name()
+        dim_ids    = [parser.count() for dim_number in range(parser.count())]
+        attributes = parser.attributes()
+        var_dtype  = CLASSIC_TYPES[parser.int32()]
+        var_size   = parser.count()
+        var_begin  = parser.offset()
+        variables.append({
+                          'name':       var_name,
+                          'dim_ids':    dim_ids,
+                          'attributes': attributes,
+                          'dtype':      var_dtype,
+                          'vsize':      var_size,
+                          'begin':      var_begin,
+                         })
+
+    return {
+            'version':     version,
+            'num_records': num_records,
+            'dimensions':  dimensions,
+            'attributes':  global_attributes,
+            'variables':   variables,
+           }
+
+class ClassicDimension (object) :
+    """a dimension of a ClassicDataset, with the parts of the netCDF4 Dimension interface we use"""
+
+    def __init__ (self, name, size, is_record) :
+        self.name       = name
+        self.size       = size
+        self._is_record = is_record
+
+    def __len__ (self) :
+        return self.size
+
+    def isunlimited (self) :
+        return self._is_record
+
+def _safe_attribute_values (value, dtype) :
+    """cast a missing data attribute to a variable's type, or give None if it doesn't fit the type
+
+    netCDF4 ignores these attributes when they can't be stored in the variable's type without
+    changing, and so do we.
+
+    >>> _safe_attribute_values(-9999.0, numpy.dtype('int16')).tolist()
+    [-9999]
+    >>> _safe_attribute_values(1.0e6, numpy.dtype('int16')) is None
+    True
+    """
+
+    if value is None :
+        return None
+
+    values = numpy.atleast_1d(numpy.array(value))
+    try :
+        with numpy.errstate(all='ignore') :
+            cast_values = values.astype(dtype)
+            is_safe     = numpy.allclose(values.astype(numpy.float64), cast_values.astype(numpy.float64), equal_nan=True)
+    except (TypeError, ValueError) :
+        return None # ie. text that doesn't go with a numeric variable
+
+    return cast_values if is_safe else None
+
+class ClassicVariable (object) :
+    """a variable of a ClassicDataset, sliced like a netCDF4 Variable
+
+    Values are masked the way netCDF4 masks them by default: anything equal to one of the
+    missing_value values or to the _FillValue (where a NaN matches NaNs), or, for variables
+    without a usable _FillValue, anything equal to the netCDF default fill value for the type.
+
+    >>> raw = numpy.array([[1.0, 2.0], [9.9692099683868690e+36, 4.0]], dtype='>f4')
+    >>> variable = ClassicVariable('example', ('record', 'wnum'), raw, { })
+    >>> variable.dtype, variable.shape
+    (dtype('float32'), (2, 2))
+    >>> variable[0].tolist()
+    [1.0, 2.0]
+    >>> variable[:, 0].mask.tolist()
+    [False, True]
+    >>> raw = numpy.array([numpy.nan, -1.0, 3.0, 9.9692099683868690e+36], dtype='>f4')
+    >>> ClassicVariable('example', ('record',), raw, {'_FillValue': numpy.nan, 'missing_value': 3.0})[:].mask.tolist()
+    [True, False, True, False]
+    """
+
+    def __init__ (self, name, dimensions, raw_view, attributes) :
+        """
+        :param name:       the name of the variable
+        :param dimensions: the names of the variable's dimensions
+        :param raw_view:   a numpy view of the values as they are stored in the file
+        :param attributes: a dictionary of the variable's attributes
+        """
+
+        self.name       = name
+        self.dimensions = tuple(dimensions)
+        self.raw_view   = raw_view
+        self.attributes = attributes
+        self.dtype      = raw_view.dtype.newbyteorder('=')
+
+        # figure out which values mean missing data the same way netCDF4 would; the default
+        # fill value only counts when there isn't a usable _FillValue
+        self.missing_values = _safe_attribute_values(attributes.get('missing_value'), self.dtype)
+        fill_values         = _safe_attribute_values(attributes.get('_FillValue'),    self.dtype)
+        for attr_name, attr_values in (('missing_value', self.missing_values), ('_FillValue', fill_values)) :
+            if attr_values is None and attr_name in attributes and self.dtype.kind in 'iuf' :
+                log.warn("Ignoring the " + attr_name + " of " + name + " because it doesn't fit in " + str(self.dtype))
+        if fill_values is None :
+            default_fill = CLASSIC_DEFAULT_FILL_VALUES.get(self.dtype.kind + str(self.dtype.itemsize))
+            fill_values  = None if default_fill is None else numpy.array([default_fill], dtype=self.dtype)
+        self.fill_value     = None if fill_values is None else fill_values[0]
+
+    @property
+    def shape (self) :
+        return self.raw_view.shape
+
+    @property
+    def size (self) :
+        return self.raw_view.size
+
+    def ncattrs (self) :
+        return list(self.attributes.keys())
+
+    def getncattr (self, attr_name) :
+        return self.attributes[attr_name]
+
+    def __len__ (self) :
+        return self.shape[0]
+
+    def __getitem__ (self, key) :
+        """copy the selected values out of the memory map, in the native byte order"""
+
+        data = numpy.array(self.raw_view[key], dtype=self.dtype)
+        if self.dtype.kind not in 'iuf' :
+            return data # character data is never masked
+
+        fill_mask = numpy.zeros(data.shape, dtype=bool)
+        for missing_value in ([ ] if self.missing_values is None else self.missing_values.tolist()) + \
+                             ([ ] if self.fill_value is None else [self.fill_value]) :
+            if self.dtype.kind == 'f' and numpy.isnan(missing_value) :
+                fill_mask |= numpy.isnan(data)
+            else :
+                fill_mask |= (data == missing_value)
+        if numpy.any(fill_mask) :
+            return numpy.ma.array(data, mask=fill_mask)
+
+        return data
+
+class ClassicDataset (object) :
+    """a NETCDF3 classic file opened through a memory map, laid out like a netCDF4 Dataset"""
+
+    def __init__ (self, file_path) :
+        """
+        :param file_path: the path of the classic file to open
+        :raises ValueError: if the file isn't a classic file
+        """
+
+        self.file_path = file_path
+        self._mmap     = numpy.memmap(file_path, dtype=numpy.uint8, mode='r')
+        header         = self._read_header()
+
+        self.data_model = {1: "NETCDF3_CLASSIC", CLASSIC_VERSION_OFFSET: "NETCDF3_64BIT_OFFSET",
+                           CLASSIC_VERSION_DATA: "NETCDF3_64BIT_DATA"}[header['version']]
+        self.attributes = header['attributes']
+
+        dim_names    = [dim_name for dim_name, dim_size in header['dimensions']]
+        record_vars  = [var_info for var_info in header['variables']
+                        if var_info['dim_ids'] and header['dimensions'][var_info['dim_ids'][0]][1] == 0]
+        record_names = set(var_info['name'] for var_info in record_vars)
+
+        # the records of all the record variables are interleaved, one after another
+        record_size = sum(var_info['vsize'] for var_info in record_vars)
+        if len(record_vars) == 1 :
+            # with only one record variable the records aren't padded
+            var_info    = record_vars[0]
+            record_size = var_info['dtype'].itemsize * int(numpy.prod([header['dimensions'][dim_id][1]
+                                                                       for dim_id in var_info['dim_ids'][1:]]))
+        num_records = header['num_records']
+        if num_records == CLASSIC_STREAMING :
+            num_records = 0
+            if record_vars and record_size > 0 :
+                num_records = (self._mmap.size - min(var_info['begin'] for var_info in record_vars)) // record_size
+
+        self.dimensions = dict((dim_name, ClassicDimension(dim_name, num_records if dim_size == 0 else dim_size, dim_size == 0))
+                               for dim_name, dim_size in header['dimensions'])
+
+        self.variables = { }
+        for var_info in header['variables'] :
+            var_dims  = [dim_names[dim_id] for dim_id in var_info['dim_ids']]
+            shape     = tuple(len(self.dimensions[dim_name]) for dim_name in var_dims)
+            var_dtype = var_info['dtype']
+
+            # C ordered strides, except that records are a whole record apart
+            strides = [ ]
+            stride  = var_dtype.itemsize
+            for dim_size in reversed(shape) :
+                strides.insert(0, stride)
+                stride *= dim_size
+            if var_info['name'] in record_names :
+                strides[0] = record_size
+
+            if 0 in shape :
+                raw_view = numpy.zeros(shape, dtype=var_dtype)
+            else :
+                raw_view = numpy.ndarray(shape, dtype=var_dtype, buffer=self._mmap, offset=var_info['begin'],
+                                         strides=tuple(strides))
+            self.variables[var_info['name']] = ClassicVariable(var_info['name'], var_dims, raw_view,
+                                                               var_info['attributes'])
+
+    def _read_header (self) :
+        """parse the header, reading more of the file until the whole header has been seen"""
+
+        header_size = 4096
+        while True :
+            try :
+                return parse_classic_header(self._mmap[0:header_size].tobytes())
+            except EOFError :
+                if header_size >= self._mmap.size :
+                    raise ValueError("the classic header of " + self.file_path + " is truncated")
+                header_size *= 4
+
+    def ncattrs (self) :
+        return list(self.attributes.keys())
+
+    def close (self) :
+        """let go of the memory map; the variables can't be sliced after this"""
+
+        self.variables = { }
+        self._mmap     = None
+
+def is_classic_file (file_path) :
+    """check whether a file starts with the NETCDF3 classic magic number"""
+
+    with open(file_path, 'rb') as in_file :
+        return in_file.read(3) == CLASSIC_MAGIC
+
+def open_shis_file (file_path, reader=DEFAULT_SHIS_READER) :
+    """open a SHIS file with the requested reader
+
+    The mmap reader is only used for classic files without any attributes that would
+    change the values netCDF4 reads; anything else is opened with netCDF4.
+
+    :param file_path: the path of the SHIS file
+    :param reader:    one of the SHIS_READERS
+    :return: an open netCDF4 Dataset or ClassicDataset
+    """
+
+    if reader == SHIS_READER_MMAP :
+        if is_classic_file(file_path) :
+            dataset     = ClassicDataset(file_path)
+            unsupported = [var_name + "." + attr_name for var_name in SHIS_VAR_NAMES if var_name in dataset.variables
+                           for attr_name in UNSUPPORTED_ATTRIBUTES if attr_name in dataset.variables[var_name].attributes]
+            if not unsupported :
+                return dataset
+            log.info("Reading " + file_path + " with netCDF4 because of the attributes: " + ", ".join(unsupported))
+            dataset.close()
+        else :
+            log.info("Reading " + file_path + " with netCDF4 because it isn't a NETCDF3 classic file")
+
+    import netCDF4 as nc
+
+    return nc.Dataset(file_path, 'r')
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Control how the fov.nc and fg.nc output files are written.
+
+This file is part of the shis2mirto software package. By default the output files are
+NETCDF3_CLASSIC with every variable stored as 'f8', which is what the Mirto reader
+expects. For archiving, the files can instead be written as NETCDF4 (HDF5), where each
+variable keeps a sensible data type (float32 radiances stay float32, channel and state
+vector indexes are stored as integers) and the observation variables are chunked along
+the obsnum dimension and can be compressed with zlib and the shuffle filter.
+
+"""
+__docformat__ = "restructuredtext en"
+
+import logging
+
+import numpy
+
+from shis2mirto.guidebook import *
+
+log = logging.getLogger(__name__)
+
+class OutputFormat (object) :
+    """the format settings used when creating output files and their variables
+
+    >>> OutputFormat().variable_dtype(numpy.float32)
+    'f8'
+    >>> OutputFormat(OUTPUT_FORMAT_NETCDF4).variable_dtype(numpy.float32)
+    dtype('float32')
+    >>> OutputFormat(OUTPUT_FORMAT_NETCDF4, chunk_obs=100).chunk_sizes((OUT_FOV_OBS_NUM_DIM_NAME, 'channels'), (1000, 20))
+    (100, 20)
+    """
+
+    def __init__ (self, format_name=DEFAULT_OUTPUT_FORMAT, chunk_obs=DEFAULT_OUTPUT_CHUNK_OBS,
+                  zlib=False, complevel=DEFAULT_OUTPUT_COMPRESSION_LEVEL, shuffle=False) :
+        """
+        :param format_name: one of the OUTPUT_FORMATS keys
+        :param chunk_obs:   the number of observations per chunk, only used for netcdf4 output
+        :param zlib:        whether to compress the variables, only used for netcdf4 output
+        :param complevel:   the zlib compression level from 1 to 9
+        :param shuffle:     whether to use the shuffle filter, only used for netcdf4 output
+        """
+
+        if format_name not in OUTPUT_FORMATS :
+            raise ValueError("Unknown output format: " + str(format_name))
+
+        self.format_name = format_name
+        self.chunk_obs   = chunk_obs
+        self.zlib        = zlib
+        self.complevel   = complevel
+        self.shuffle     = shuffle
+
+    @property
+    def netcdf_format (self) :
+        """the format string netCDF4.Dataset takes"""
+
+        return OUTPUT_FORMATS[self.format_name]
+
+    @property
+    def is_classic (self) :
+        return self.format_name == OUTPUT_FORMAT_CLASSIC
+
+    def create_dataset (self, file_path) :
+        """create a new output file in this format
+
+        :param file_path: the path of the file to create
+        :return: an open netCDF4 Dataset
+        """
+
+        import netCDF4 as nc
+
+        return nc.Dataset(file_path, 'w', format=self.netcdf_format)
+
+    def variable_dtype (self, native_dtype) :
+        """get the data type to store a variable as
+
+        Classic output stores everything as 'f8', the others keep the native data type.
+        """
+
+        return 'f8' if self.is_classic else numpy.dtype(native_dtype)
+
+    def chunk_sizes (self, dimensions, shape) :
+        """get the chunk sizes for a variable, or None if it shouldn't be chunked
+
+        Only variables along the obsnum dimension are chunked; each chunk holds up to
+        chunk_obs whole observations. An unlimited obsnum dimension has a length of None.
+        """
+
+        along_obs = bool(dimensions) and dimensions[0] in (OUT_FOV_OBS_NUM_DIM_NAME, OUT_FG_OBS_NUM_DIM_NAME)
+        if self.is_classic or not along_obs or not self.chunk_obs :
+            return None
+
+        obs_chunk = self.chunk_obs if shape[0] is None else max(1, min(self.chunk_obs, shape[0]))
+
+        return (obs_chunk,) + tuple(shape[1:])
+
+    def create_variable (self, dataset, var_name, native_dtype, dimensions=()) :
+        """create a variable in an output file using these format settings
+
+        :param dataset:      an open netCDF4 Dataset from create_dataset
+        :param var_name:     the name of the new variable
+        :param native_dtype: the data type the variable has in memory
+        :param dimensions:   the names of the variable's dimensions, or a single dimension name
+        :return: the new netCDF4 variable
+        """
+
+        if self.is_classic :
+            # keep the variables exactly as the Mirto reader has always seen them
+            return dataset.createVariable(var_name, 'f8', dimensions)
+
+        dimensions = (dimensions,) if isinstance(dimensions, str) else tuple(dimensions)
+        shape      = tuple(None if dataset.dimensions[dim_name].isunlimited() else len(dataset.dimensions[dim_name])
+                           for dim_name in dimensions)
+        chunks     = self.chunk_sizes(dimensions, shape)
+        compress   = self.zlib and len(dimensions) > 0
+
+        return dataset.createVariable(var_name, self.variable_dtype(native_dtype), dimensions,
+                                      zlib=compress, complevel=self.complevel, shuffle=(self.shuffle and compress),
+                                      chunksizes=chunks)
@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Find the SHIS records inside a lon/lat box and a time window.
+
+This file is part of the shis2mirto software package. An ObservationIndex is built once
+per granule from the record positions and times. It keeps the records sorted by time, so
+a time window is two binary searches, and sorted by a coarse lat/lon grid bucket, so a
+box only has to look at the records in the buckets it overlaps. The index can be saved
+and reused (in memory and optionally on disk) keyed on the granule file, the same way the
+wave number index maps are cached:
+
+    obs_index   = observation_index_for_file(shis_data, "SHIS.nc", cache_dir="/scratch/idx")
+    record_mask = obs_index.select(bbox=(-95.0, 28.0, -90.0, 32.0), time_window=(start, end))
+
+The record mask can be used as a record filter for the fov selection, so only the
+matching records have their radiances read.
+
+"""
+__docformat__ = "restructuredtext en"
+
+import os
+import hashlib
+import logging
+import tempfile
+from datetime import datetime
+
+import numpy
+
+from shis2mirto.guidebook import *
+
+log = logging.getLogger(__name__)
+
+# indexes we've already built during this run, keyed on the granule
+_index_memory_cache = { }
+
+# the date formats a time window may be given in, besides seconds since the epoch (always UTC)
+TIME_WINDOW_FORMATS = ["%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M", "%Y-%m-%d %H:%M:%S", "%Y%m%dT%H%M%S", "%Y-%m-%d"]
+
+def parse_bbox (bbox_spec) :
+    """parse a "lon0,lat0,lon1,lat1" box; if lon0 is east of lon1 the box crosses the date line
+
+    >>> parse_bbox("-95,28,-90,32.5")
+    (-95.0, 28.0, -90.0, 32.5)
+
+    :param bbox_spec: the box as a string
+    :return: a (lon0, lat0, lon1, lat1) tuple of floats
+    :raises ValueError: if the box isn't understood
+    """
+
+    try :
+        lon0, lat0, lon1, lat1 = [float(part) for part in bbox_spec.split(",")]
+    except ValueError :
+        raise ValueError("Unable to understand bounding box (expected lon0,lat0,lon1,lat1): " + bbox_spec)
+    if lat0 > lat1 :
+        raise ValueError("The bounding box's first latitude must be south of its second: " + bbox_spec)
+
+    return lon0, lat0, lon1, lat1
+
+def _parse_time (time_spec) :
+    """parse a time as seconds since the epoch or a UTC date"""
+
+    time_spec = time_spec.strip()
+    try :
+        return float(time_spec)
+    except ValueError :
+        pass
+
+    for time_format in TIME_WINDOW_FORMATS :
+        try :
+            temp_time = datetime.strptime(time_spec, time_format)
+        except ValueError :
+            continue
+        return (temp_time - datetime(1970, 1, 1)).total_seconds()
+
+    raise ValueError("Unable to understand time: " + time_spec)
+
+def parse_time_window (window_spec) :
+    """parse a "start,end" time window, each either seconds since the epoch or a UTC date
+
+    >>> parse_time_window("2014-09-06T10:40:00,1410000600")
+    (1410000000.0, 1410000600.0)
+
+    :param window_spec: the window as a string
+    :return: a (start, end) tuple of seconds since the epoch
+    :raises ValueError: if the window isn't understood
+    """
+
+    parts = window_spec.split(",")
+    if len(parts) != 2 :
+        raise ValueError("Unable to understand time window (expected start,end): " + window_spec)
+    start_time, end_time = _parse_time(parts[0]), _parse_time(parts[1])
+    if start_time > end_time :
+        raise ValueError("The time window ends before it starts: " + window_spec)
+
+    return start_time, end_time
+
+class ObservationIndex (object) :
+    """a sorted time index and a coarse lat/lon grid bucket index over the records of a granule
+
+    >>> obs_index = ObservationIndex(numpy.array([-91.2, -90.5, 10.0, 179.5]),
+    ...                              numpy.array([ 30.1,  30.4, 45.0, -10.0]),
+    ...                              numpy.array([  3.0,   1.0,  2.0,   4.0]))
+    >>> obs_index.bbox_mask(-91.0, 30.0, -90.0, 31.0).tolist()
+    [False, True, False, False]
+    >>> obs_index.bbox_mask(170.0, -20.0, -170.0, 50.0).tolist()
+    [False, False, False, True]
+    >>> obs_index.time_window_mask(1.5, 3.0).tolist()
+    [True, False, True, False]
+    >>> obs_index.select(bbox=(-92.0, 30.0, 20.0, 50.0), time_window=(2.0, 4.0)).tolist()
+    [True, False, True, False]
+    """
+
+    def __init__ (self, lon, lat, epoch_seconds, bucket_degrees=DEFAULT_OBS_INDEX_BUCKET_DEGREES) :
+        """
+        :param lon:            a (num_records,) array of longitudes
+        :param lat:            a (num_records,) array of latitudes
+        :param epoch_seconds:  a (num_records,) array of record times in seconds since the epoch
+        :param bucket_degrees: the size of the lat/lon grid buckets in degrees
+        """
+
+        self.lon            = numpy.ma.filled(numpy.ma.asarray(lon,           dtype=numpy.float64), numpy.nan)
+        self.lat            = numpy.ma.filled(numpy.ma.asarray(lat,           dtype=numpy.float64), numpy.nan)
+        self.epoch_seconds  = numpy.ma.filled(numpy.ma.asarray(epoch_seconds, dtype=numpy.float64), numpy.nan)
+        self.bucket_degrees = float(bucket_degrees)
+
+        # the records in time order
+        self.time_order   = numpy.argsort(self.epoch_seconds, kind='mergesort')
+        self.sorted_times = self.epoch_seconds[self.time_order]
+
+        # the records in grid bucket order
+        bucket_keys       = self._bucket_keys(self.lon, self.lat)
+        self.bucket_order = numpy.argsort(bucket_keys, kind='mergesort')
+        self.sorted_keys  = bucket_keys[self.bucket_order]
+
+    @property
+    def num_records (self) :
+        return self.lon.size
+
+    @property
+    def num_lon_buckets (self) :
+        return int(numpy.ceil(360.0 / self.bucket_degrees))
+
+    def _lat_bucket (self, lat) :
+        return numpy.floor((numpy.asarray(lat) + 90.0) / self.bucket_degrees).astype(numpy.int64)
+
+    def _lon_bucket (self, lon) :
+        return numpy.floor(numpy.mod(numpy.asarray(lon) + 180.0, 360.0) / self.bucket_degrees).astype(numpy.int64)
+
+    def _bucket_keys (self, lon, lat) :
+        """get the grid bucket of each position, -1 for positions that aren't valid"""
+
+        valid = numpy.isfinite(lon) & numpy.isfinite(lat)
+        keys  = numpy.full(lon.shape, -1, dtype=numpy.int64)
+        keys[valid] = self._lat_bucket(lat[valid]) * self.num_lon_buckets + self._lon_bucket(lon[valid])
+
+        return keys
+
+    def time_window_mask (self, start_time, end_time) :
+        """find the records with times from start_time to end_time, inclusive
+
+        :return: a boolean array with one entry per record
+        """
+
+        first_index = numpy.searchsorted(self.sorted_times, start_time, side='left')
+        last_index  = numpy.searchsorted(self.sorted_times, end_time,   side='right')
+        record_mask = numpy.zeros(self.num_records, dtype=bool)
+        record_mask[self.time_order[first_index:last_index]] = True
+
+        return record_mask
+
+    def bbox_mask (self, lon0, lat0, lon1, lat1) :
+        """find the records inside a lon/lat box, edges included
+
+        If lon0 is east of lon1 the box crosses the date line.
+
+        :return: a boolean array with one entry per record
+        """
+
+        # the columns of grid buckets the box covers, in one or two runs if it crosses the date line
+        first_lon, last_lon = int(self._lon_bucket(lon0)), int(self._lon_bucket(lon1))
+        if lon1 - lon0 >= 360.0 :
+            lon_runs = [(0, self.num_lon_buckets - 1)]
+        elif first_lon <= last_lon and lon0 <= lon1 :
+            lon_runs = [(first_lon, last_lon)]
+        else :
+            lon_runs = [(first_lon, self.num_lon_buckets - 1), (0, last_lon)]
+
+        # gather the records in the covered buckets; each row of buckets is a contiguous run of keys
+        candidates = [ ]
+        for lat_bucket in range(int(self._lat_bucket(lat0)), int(self._lat_bucket(lat1)) + 1) :
+            for first_bucket, last_bucket in lon_runs :
+                first_key = lat_bucket * self.num_lon_buckets + first_bucket
+                last_key  = lat_bucket * self.num_lon_buckets + last_bucket
+                start     = numpy.searchsorted(self.sorted_keys, first_key, side='left')
+                stop      = numpy.searchsorted(self.sorted_keys, last_key,  side='right')
+                candidates.append(self.bucket_order[start:stop])
+        candidates = numpy.concatenate(candidates) if candidates else numpy.zeros(0, dtype=numpy.int64)
+
+        # only the candidates need the exact test
+        cand_lon = self.lon[candidates]
+        cand_lat = self.lat[candidates]
+        inside   = (cand_lat >= lat0) & (cand_lat <= lat1)
+        if lon0 <= lon1 :
+            inside &= (cand_lon >= lon0) & (cand_lon <= lon1)
+        else :
+            inside &= (cand_lon >= lon0) | (cand_lon <= lon1)
+
+        record_mask = numpy.zeros(self.num_records, dtype=bool)
+        record_mask[candidates[inside]] = True
+
+        return record_mask
+
+    def select (self, bbox=None, time_window=None) :
+        """find the records inside a box and a time window; either may be None to not limit by it
+
+        :param bbox:        a (lon0, lat0, lon1, lat1) tuple, see bbox_mask
+        :param time_window: a (start, end) tuple of seconds since the epoch
+        :return: a boolean array with one entry per record
+        """
+
+        record_mask = numpy.ones(self.num_records, dtype=bool)
+        if bbox is not None :
+            record_mask &= self.bbox_mask(*bbox)
+        if time_window is not None :
+            record_mask &= self.time_window_mask(*time_window)
+
+        return record_mask
+
+    def save (self, file_path) :
+        """save the index to a numpy .npz file"""
+
+        with open(file_path, 'wb') as out_file :
+            numpy.savez(out_file, lon=self.lon, lat=self.lat, epoch_seconds=self.epoch_seconds,
+                        bucket_degrees=self.bucket_degrees, time_order=self.time_order,
+                        bucket_order=self.bucket_order, sorted_keys=self.sorted_keys)
+
+    @classmethod
+    def load (cls, file_path) :
+        """load an index saved with save"""
+
+        obs_index = cls.__new__(cls)
+        with numpy.load(file_path) as saved :
+            obs_index.lon            = saved['lon']
+            obs_index.lat            = saved['lat']
+            obs_index.epoch_seconds  = saved['epoch_seconds']
+            obs_index.bucket_degrees = float(saved['bucket_degrees'])
+            obs_index.time_order     = saved['time_order']
+            obs_index.bucket_order   = saved['bucket_order']
+            obs_index.sorted_keys    = saved['sorted_keys']
+        obs_index.sorted_times = obs_index.epoch_seconds[obs_index.time_order]
+
+        return obs_index
+
+def build_observation_index (shis_data, bucket_degrees=DEFAULT_OBS_INDEX_BUCKET_DEGREES) :
+    """build the index of a SHIS granule's record positions and times
+
+    :param shis_data:      an open SHIS Dataset or a ShisData object
+    :param bucket_degrees: the size of the lat/lon grid buckets in degrees
+    :return: an ObservationIndex
+    """
+
+    variables     = shis_data.variables
+    epoch_seconds = (numpy.ma.getdata(variables[SHIS_TIME_OFFSET_VAR_NAME][:]).astype(numpy.float64) +
+                     variables[SHIS_BASE_TIME_VAR_NAME][0])
+
+    return ObservationIndex(variables[SHIS_LON_VAR_NAME][:], variables[SHIS_LAT_VAR_NAME][:], epoch_seconds,
+                            bucket_degrees=bucket_degrees)
+
+def granule_key (file_path, bucket_degrees=DEFAULT_OBS_INDEX_BUCKET_DEGREES) :
+    """build a key that identifies a granule file as it is now
+
+    :param file_path:      the path of the SHIS file
+    :param bucket_degrees: the size of the lat/lon grid buckets in degrees
+    :return: a hex digest string
+    """
+
+    file_stat = os.stat(file_path)
+    temp_hash = hashlib.sha1()
+    temp_hash.update(("|".join([os.path.abspath(file_path), str(file_stat.st_size), repr(file_stat.st_mtime),
+                                repr(float(bucket_degrees))])).encode('utf-8'))
+
+    return temp_hash.hexdigest()
+
+def observation_index_for_file (shis_data, file_path, cache_dir=None, bucket_degrees=DEFAULT_OBS_INDEX_BUCKET_DEGREES) :
+    """get the index of a granule, reusing one that was already built for the file if we have it
+
+    Indexes are always remembered for the rest of the run; if a cache directory is given
+    they are also saved there so later runs on the same granule can reuse them. A granule
+    that has been changed since (a different size or modification time) gets a new index.
+
+    :param shis_data:      the open SHIS Dataset or a ShisData object for the file
+    :param file_path:      the path of the SHIS file
+    :param cache_dir:      an optional directory to save and load indexes
+    :param bucket_degrees: the size of the lat/lon grid buckets in degrees
+    :return: an ObservationIndex
+    """
+
+    key = granule_key(file_path, bucket_degrees=bucket_degrees)
+
+    if key in _index_memory_cache :
+        log.debug("using observation index from memory: " + key)
+        return _index_memory_cache[key]
+
+    cache_path = os.path.join(cache_dir, key + OBS_INDEX_FILE_SUFFIX) if cache_dir is not None else None
+    if cache_path is not None and os.path.exists(cache_path) :
+        log.debug("loading observation index from " + cache_path)
+        obs_index = ObservationIndex.load(cache_path)
+    else :
+        obs_index = build_observation_index(shis_data, bucket_degrees=bucket_degrees)
+
+        # save the index so other runs can use it; write to a temporary file first so
+        # concurrent runs never see a partially written index
+        if cache_path is not None :
+            if not os.path.isdir(cache_dir) :
+                try :
+                    os.makedirs(cache_dir)
+                except OSError :
+                    if not os.path.isdir(cache_dir) :
+                        raise # it wasn't just another process making the same directory
+            temp_fd, temp_path = tempfile.mkstemp(suffix=OBS_INDEX_FILE_SUFFIX, dir=cache_dir)
+            os.close(temp_fd)
+            obs_index.save(temp_path)
+            os.rename(temp_path, cache_path)
+            log.debug("saved observation index to " + cache_path)
+
+    _index_memory_cache[key] = obs_index
+
+    return obs_index
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Convert Virtual Radiosonde profiles into the physical quantities Mirto wants.
+
+This file is part of the shis2mirto software package. The conversions here work on whole
+(num_obs, num_plvls) arrays at once. The Virtual Radiosonde results are stacked into
+arrays a single time and every conversion can write its output in place.
+
+"""
+__docformat__ = "restructuredtext en"
+
+import logging
+import numpy
+
+from shis2mirto.guidebook import *
+
+log = logging.getLogger(__name__)
+
+def relative_humidity_to_specific_humidity (relative_humidity_ratio, temperature, out=None) :
+    """convert the relative humidity to a specific humidity
+
+    qair <- rh * 2.541e6 * exp(-5415.0 / T) * 18/29
+
+    The math is always done in float64, even if the temperatures are float32.
+
+    >>> relative_humidity_to_specific_humidity(numpy.array([0.5]), numpy.array([290.0], dtype=numpy.float32))
+    array([0.00613088])
+
+    :param relative_humidity_ratio: the relative humidity as a ratio (not a percent)
+    :param temperature:             the temperature in K
+    :param out:                     an optional float64 array to hold the result, may be relative_humidity_ratio itself
+    :return: the specific humidity in kg/kg
+    """
+
+    temp_t = numpy.divide(-5415.0, temperature, dtype=numpy.float64)
+    numpy.exp(temp_t, out=temp_t)
+
+    specific_humidity = numpy.multiply(relative_humidity_ratio, 2.541e6, out=out)
+    numpy.multiply(specific_humidity, temp_t,        out=specific_humidity)
+    numpy.multiply(specific_humidity, 18.0 / 29.0,   out=specific_humidity)
+
+    return specific_humidity
+
+def celsius_to_kelvin (temperature, out=None) :
+    """convert temperatures from C to K
+
+    :param temperature: the temperature in C
+    :param out:         an optional array to hold the result, may be temperature itself
+    :return: the temperature in K
+    """
+
+    return numpy.add(temperature, CELSIUS_TO_KELVIN_ADD_CONST, out=out)
+
+def clamped_log_specific_humidity (specific_humidity, minimum=WATER_VAPOR_MINIMUM, out=None) :
+    """take the log of the specific humidity, after raising it to a minimum so the log is valid
+
+    >>> clamped_log_specific_humidity(numpy.array([0.0, 1.0]), minimum=1.0).tolist()
+    [0.0, 0.0]
+
+    :param specific_humidity: the specific humidity in kg/kg
+    :param minimum:           the smallest specific humidity allowed
+    :param out:               an optional array to hold the result, may be specific_humidity itself
+    :return: log(q)
+    """
+
+    temp_q = numpy.maximum(specific_humidity, minimum, out=out)
+
+    return numpy.log(temp_q, out=temp_q)
+
+def ozone_mixing_ratio_to_log_specific_humidity (ozone_mixing_ratio, out=None) :
+    """convert an ozone mixing ratio to specific humidity and take the log
+
+    Note: for very small mixing ratios of ozone this conversion may not make a lot of difference
+
+    :param ozone_mixing_ratio: the ozone mixing ratio in kg/kg
+    :param out:                an optional array to hold the result, may be ozone_mixing_ratio itself
+    :return: log(q)
+    """
+
+    temp_denominator = numpy.add(ozone_mixing_ratio, 1.0)
+    temp_q           = numpy.divide(ozone_mixing_ratio, temp_denominator, out=out)
+
+    return numpy.log(temp_q, out=temp_q)
+
+def stack_vr_results (results, key, dtype=numpy.float64) :
+    """stack one entry from each of the Virtual Radiosonde results into a single array
+
+    Masked values (ie. levels below the ground) come out as NaN rather than as whatever
+    data happened to be under the mask.
+
+    >>> stack_vr_results([{'a': [1, 2]}, {'a': [3, 4]}], 'a').shape
+    (2, 2)
+    >>> stack_vr_results([{'a': numpy.ma.array([1.0, 2.0], mask=[True, False])}], 'a')
+    array([[nan,  2.]])
+
+    :param results: a list of result dictionaries from the Virtual Radiosonde
+    :param key:     the entry to pull out of each result
+    :param dtype:   the data type of the stacked array
+    :return: an array shaped (number of results,) + the shape of the entry
+    """
+
+    return numpy.array([numpy.ma.filled(numpy.ma.asanyarray(result[key], dtype=dtype), numpy.nan) for result in results], dtype=dtype)
+
+def fill_state_from_vr_results (results, layout, state_vector_data, press_vector_data) :
+    """convert the Virtual Radiosonde results and put them in the state vector and pressure grid
+
+    This gives the same numbers as converting the results one profile at a time:
+
+    >>> from shis2mirto.statevector import StateVectorLayout
+    >>> rng     = numpy.random.RandomState(0)
+    >>> results = [{VR_TEMPERATURE_KEY: rng.uniform(-60.0, 30.0, 4), VR_PRESSURE_KEY: numpy.arange(1.0, 5.0),
+    ...             VR_RELATIVE_HUMIDITY_KEY: rng.uniform(0.0, 100.0, 4), VR_OZONE_MR_KEY: rng.uniform(1.0e-8, 1.0e-5, 4),
+    ...             VR_SURFACE_TEMPERATURE_KEY: rng.uniform(250.0, 310.0),
+    ...             VR_SEA_SURFACE_PRESSURE_KEY: rng.uniform(99000.0, 103000.0)} for index in range(3)]
+    >>> layout  = StateVectorLayout(4)
+    >>> state, press = layout.allocate(3), layout.allocate(3)
+    >>> fill_state_from_vr_results(results, layout, state, press)
+    >>> old_temp = numpy.zeros((3, 4), dtype=numpy.float32)
+    >>> old_wv   = numpy.zeros((3, 4), dtype=numpy.float32)
+    >>> old_o3   = numpy.zeros((3, 4), dtype=numpy.float32)
+    >>> for index in range(3) :
+    ...     old_temp[index] = results[index][VR_TEMPERATURE_KEY] + CELSIUS_TO_KELVIN_ADD_CONST
+    ...     temp_q = (results[index][VR_RELATIVE_HUMIDITY_KEY] / 100.0 * 2.541e6) * numpy.exp(numpy.ones(4) * -5415.0 / old_temp[index]) * (18.0 / 29.0)
+    ...     temp_q[temp_q < WATER_VAPOR_MINIMUM] = WATER_VAPOR_MINIMUM
+    ...     old_wv[index] = numpy.log(temp_q)
+    ...     temp_o3 = results[index][VR_OZONE_MR_KEY]
+    ...     old_o3[index] = numpy.log(temp_o3 / (temp_o3 + 1))
+    >>> numpy.array_equal(layout.segment(state, STATE_TEMPERATURE_SEGMENT), old_temp)
+    True
+    >>> numpy.array_equal(layout.segment(state, STATE_WATER_VAPOR_SEGMENT), old_wv)
+    True
+    >>> numpy.array_equal(layout.segment(state, STATE_OZONE_SEGMENT), old_o3)
+    True
+
+    :param results:           a list of result dictionaries from the Virtual Radiosonde, one per observation
+    :param layout:            the StateVectorLayout of the buffers
+    :param state_vector_data: a (num_obs, layout.size) buffer for the state vector
+    :param press_vector_data: a (num_obs, layout.size) buffer for the pressure grid
+    """
+
+    if len(results) <= 0 :
+        return
+
+    # temperature; vr is in C, we need K
+    temperature = layout.segment(state_vector_data, STATE_TEMPERATURE_SEGMENT)
+    temp_data   = stack_vr_results(results, VR_TEMPERATURE_KEY)
+    temperature[:] = celsius_to_kelvin(temp_data, out=temp_data)
+
+    # water vapor is the log of specific humidity; the humidity is calculated from the
+    # stored temperature so we get the same numbers as we would from the file
+    temp_data   = stack_vr_results(results, VR_RELATIVE_HUMIDITY_KEY)
+    numpy.divide(temp_data, 100.0, out=temp_data)
+    relative_humidity_to_specific_humidity(temp_data, temperature, out=temp_data)
+    layout.segment(state_vector_data, STATE_WATER_VAPOR_SEGMENT)[:] = clamped_log_specific_humidity(temp_data, out=temp_data)
+
+    # ozone is the log of the specific humidity
+    temp_data   = stack_vr_results(results, VR_OZONE_MR_KEY)
+    layout.segment(state_vector_data, STATE_OZONE_SEGMENT)[:] = ozone_mixing_ratio_to_log_specific_humidity(temp_data, out=temp_data)
+
+    # surface temperature is already in K
+    layout.segment(state_vector_data, STATE_SURFACE_TEMPERATURE_SEGMENT)[:, 0] = stack_vr_results(results, VR_SURFACE_TEMPERATURE_KEY)
+
+    # fill in the pressure profile and surface pressure, then spread them across the pressure grid
+    pressure     = layout.segment(press_vector_data, STATE_TEMPERATURE_SEGMENT)
+    surface_pres = layout.segment(press_vector_data, STATE_SURFACE_TEMPERATURE_SEGMENT)
+    pressure[:]        = stack_vr_results(results, VR_PRESSURE_KEY)
+    surface_pres[:, 0] = stack_vr_results(results, VR_SEA_SURFACE_PRESSURE_KEY)
+    layout.fill_pressure_grid(press_vector_data, pressure, surface_pres)
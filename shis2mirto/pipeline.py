@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Overlap reading, selecting and writing blocks of records with background threads.
+
+This file is part of the shis2mirto software package. prefetch runs an iterator in a
+background thread and hands its items over through a bounded queue, so the next items
+are being produced while the caller works on the current one. Chaining two of them gives
+a reader thread, a worker thread and the caller as the writer:
+
+    raw_blocks      = prefetch(read_blocks(),                            queue_depth=2)
+    selected_blocks = prefetch((select(block) for block in raw_blocks),  queue_depth=2)
+    for block in selected_blocks :
+        write(block)
+
+The netCDF C library isn't thread safe, so every call into it, for reading or writing,
+must hold NETCDF_LOCK. The numpy work done between the calls runs in parallel.
+
+"""
+__docformat__ = "restructuredtext en"
+
+import queue
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+# held around every netCDF read or write that might happen while another thread is using the library
+NETCDF_LOCK = threading.RLock()
+
+# how often a blocked producer checks whether the consumer has gone away, in seconds
+PREFETCH_POLL_SECONDS = 0.1
+
+class _PrefetchError (object) :
+    """wraps an exception raised in the producer thread so it can be re-raised in the consumer"""
+
+    def __init__ (self, error) :
+        self.error = error
+
+_PREFETCH_DONE = object()
+
+def _produce (iterator, item_queue, stop_event) :
+    """put the items from an iterator on a queue until it runs out or the consumer stops"""
+
+    def _put (item) :
+        while not stop_event.is_set() :
+            try :
+                item_queue.put(item, timeout=PREFETCH_POLL_SECONDS)
+                return True
+            except queue.Full :
+                pass
+        return False
+
+    try :
+        for item in iterator :
+            if not _put(item) :
+                break
+        else :
+            _put(_PREFETCH_DONE)
+    except BaseException as err :
+        _put(_PrefetchError(err))
+    finally :
+        # let a chained prefetch know that nobody wants its items any more
+        if hasattr(iterator, 'close') :
+            iterator.close()
+
+def prefetch (iterable, queue_depth=2) :
+    """iterate over something in a background thread, keeping up to queue_depth items ready
+
+    The items come out in the same order they would without the thread. An exception
+    raised while producing an item is raised again here, after the items before it.
+
+    >>> list(prefetch(range(5), queue_depth=1))
+    [0, 1, 2, 3, 4]
+    >>> list(prefetch(number * 2 for number in prefetch(range(5))))
+    [0, 2, 4, 6, 8]
+
+    :param iterable:    the things to iterate over
+    :param queue_depth: the most items to have waiting at once
+    """
+
+    item_queue = queue.Queue(maxsize=max(1, queue_depth))
+    stop_event = threading.Event()
+    producer   = threading.Thread(target=_produce, args=(iter(iterable), item_queue, stop_event))
+    producer.daemon = True
+    producer.start()
+
+    try :
+        while True :
+            item = item_queue.get()
+            if item is _PREFETCH_DONE :
+                break
+            if isinstance(item, _PrefetchError) :
+                raise item.error
+            yield item
+    finally :
+        stop_event.set()
+        producer.join()
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Record what each output file was made from, so unchanged outputs don't have to be remade.
+
+This file is part of the shis2mirto software package. A Provenance collects the inputs of
+a command (the path, size and modification time of each input file, or the fingerprint
+of an input that was itself made by this package, and the files in any input directory,
+like the cache entry holding a GFS forecast file), hashes of the wave number and pressure
+grids it used, the options that change the output and the package version. These are
+saved as global attributes of the output, along with a fingerprint of all of them:
+
+    provenance = Provenance("create_fov_file", version)
+    provenance.add_input("shis", "SHIS.nc")
+    provenance.add_grid("wavenumbers", desired_wnums)
+    provenance.add_options({'center_angle': 0.0, 'angle_range': 1.5})
+    if is_up_to_date(["fov.nc"], provenance) :
+        ... # nothing to do
+
+The fingerprint is written as a placeholder when a file is created and only filled in
+once it has been finished, so a file left behind by a run that failed part way through
+is never taken to be up to date.
+
+The header of a classic file sits right before its data, so if an append made any of the
+attributes longer the whole file would be rewritten to make room. In classic files each
+attribute is padded with spaces to a fixed width instead, and a value too long to fit is
+saved as a digest (the fingerprint is always made from the full values).
+
+"""
+__docformat__ = "restructuredtext en"
+
+import os
+import json
+import hashlib
+import logging
+
+import numpy
+
+from shis2mirto.guidebook import *
+
+log = logging.getLogger(__name__)
+
+def file_signature (file_path) :
+    """describe a file as it is now by its path, size and modification time
+
+    :param file_path: the path of the file
+    :return: a string, which changes whenever the file does
+    """
+
+    file_stat = os.stat(file_path)
+
+    return "|".join([os.path.abspath(file_path), str(file_stat.st_size), repr(file_stat.st_mtime)])
+
+def directory_signature (dir_path) :
+    """describe the files under a directory as they are now, leaving out hidden files
+
+    :param dir_path: the path of the directory, which doesn't have to exist
+    :return: a string, which changes whenever a file is added, removed or changed
+    """
+
+    if not os.path.isdir(dir_path) :
+        return "missing|" + os.path.abspath(dir_path)
+
+    temp_hash = hashlib.sha1()
+    for parent_path, dir_names, file_names in os.walk(dir_path) :
+        dir_names[:] = sorted(dir_name for dir_name in dir_names if not dir_name.startswith('.'))
+        for file_name in sorted(file_names) :
+            if not file_name.startswith('.') :
+                file_path = os.path.join(parent_path, file_name)
+                file_stat = os.stat(file_path)
+                temp_hash.update("|".join([os.path.relpath(file_path, dir_path), str(file_stat.st_size),
+                                           repr(file_stat.st_mtime)]).encode('utf-8') + b"\n")
+
+    return "directory|" + os.path.abspath(dir_path) + "|" + temp_hash.hexdigest()
+
+def array_digest (values) :
+    """get a hash of the values in an array
+
+    >>> array_digest([1.0, 2.0]) == array_digest(numpy.array([1, 2], dtype=numpy.int32))
+    True
+
+    :param values: an array (or list) of numbers
+    :return: a hex digest string
+    """
+
+    values = numpy.ascontiguousarray(numpy.ma.getdata(values), dtype=numpy.float64)
+
+    return hashlib.sha1(values.tobytes()).hexdigest()
+
+def fixed_width_value (value, width) :
+    """pad an attribute value with spaces to a fixed width, or replace it with a digest if it doesn't fit
+
+    >>> len(fixed_width_value("create_fov_file", 64))
+    64
+    >>> fixed_width_value("x" * 100, 64).startswith(PROVENANCE_DIGEST_PREFIX)
+    True
+
+    :param value: the attribute value string
+    :param width: the number of characters to take up
+    :return: a string exactly width characters long
+    """
+
+    if len(value.encode('utf-8')) > width or len(value) != len(value.encode('utf-8')) :
+        value = PROVENANCE_DIGEST_PREFIX + hashlib.sha1(value.encode('utf-8')).hexdigest()
+
+    return value.ljust(width)
+
+def read_fingerprint (file_path) :
+    """get the fingerprint saved in an output file
+
+    :param file_path: the path of a file made by this package
+    :return: the fingerprint, or None if the file doesn't exist, can't be read or wasn't finished
+    """
+
+    if not os.path.exists(file_path) :
+        return None
+
+    import netCDF4 as nc
+
+    try :
+        dataset = nc.Dataset(file_path, 'r')
+    except (IOError, OSError, RuntimeError) :
+        return None
+    try :
+        if OUT_PROVENANCE_FINGERPRINT_ATTR_NAME not in dataset.ncattrs() :
+            return None
+        fingerprint = str(dataset.getncattr(OUT_PROVENANCE_FINGERPRINT_ATTR_NAME)).strip()
+    finally :
+        dataset.close()
+
+    return None if fingerprint == PROVENANCE_INCOMPLETE_FINGERPRINT else fingerprint
+
+class Provenance (object) :
+    """the inputs, grids, options and version an output file depends on
+
+    >>> first = Provenance("create_fov_file", "shis2mirto, version 0.1")
+    >>> first.add_grid("wavenumbers", [700.0, 800.0])
+    >>> first.add_options({'angle_range': 1.5, 'center_angle': 0.0})
+    >>> second = Provenance("create_fov_file", "shis2mirto, version 0.1")
+    >>> second.add_options({'center_angle': 0.0, 'angle_range': 1.5})
+    >>> second.add_grid("wavenumbers", [700.0, 800.0])
+    >>> first.fingerprint == second.fingerprint
+    True
+    >>> second.add_options({'angle_range': 3.0})
+    >>> first.fingerprint == second.fingerprint
+    False
+    """
+
+    def __init__ (self, command, version) :
+        """
+        :param command: the name of the command making the output
+        :param version: the version string of the package
+        """
+
+        self.command = command
+        self.version = version
+        self.inputs  = { }
+        self.grids   = { }
+        self.options = { }
+
+    def add_input (self, role, file_path, prefer_fingerprint=False) :
+        """add an input file
+
+        :param role:               what the file is used for (ie. "shis" or "fov")
+        :param file_path:          the path of the file
+        :param prefer_fingerprint: if the file was made by this package, depend on its fingerprint rather than
+                                   its modification time, so remaking it with the same inputs doesn't make
+                                   this output out of date
+        """
+
+        fingerprint = read_fingerprint(file_path) if prefer_fingerprint else None
+        self.inputs[role] = ("fingerprint|" + fingerprint) if fingerprint is not None else file_signature(file_path)
+
+    def add_directory (self, role, dir_path) :
+        """add an input directory, which depends on the files in it (see directory_signature)
+
+        :param role:     what the directory is used for (ie. "gfs 20140906/t06z/f003")
+        :param dir_path: the path of the directory
+        """
+
+        self.inputs[role] = directory_signature(dir_path)
+
+    def add_grid (self, name, values) :
+        """add the values of a grid the output depends on (ie. the wave numbers or pressure levels)"""
+
+        self.grids[name] = array_digest(values)
+
+    def add_options (self, options) :
+        """add options that change the output
+
+        :param options: a dictionary of the option values, which must be simple enough to save as JSON
+        """
+
+        self.options.update(options)
+
+    def _parts (self) :
+        return [
+                (OUT_PROVENANCE_VERSION_ATTR_NAME, self.version),
+                (OUT_PROVENANCE_COMMAND_ATTR_NAME, self.command),
+                (OUT_PROVENANCE_INPUTS_ATTR_NAME,  json.dumps(self.inputs,  sort_keys=True)),
+                (OUT_PROVENANCE_GRIDS_ATTR_NAME,   json.dumps(self.grids,   sort_keys=True)),
+                (OUT_PROVENANCE_OPTIONS_ATTR_NAME, json.dumps(self.options, sort_keys=True)),
+               ]
+
+    @property
+    def fingerprint (self) :
+        """a hash of everything the output depends on"""
+
+        temp_hash = hashlib.sha1()
+        for attr_name, attr_value in self._parts() :
+            temp_hash.update((attr_name + "=" + attr_value + "\n").encode('utf-8'))
+
+        return temp_hash.hexdigest()
+
+    def write_attributes (self, dataset) :
+        """save the provenance as global attributes of an output file that is being made or appended to
+
+        The fingerprint is only a placeholder until mark_complete is called. In classic files
+        the attributes keep the width they already have (or PROVENANCE_CLASSIC_ATTR_WIDTH), so
+        the header never grows when a file is appended to.
+
+        :param dataset: an open netCDF4 Dataset
+        """
+
+        is_classic = dataset.data_model.startswith("NETCDF3")
+        old_names  = set(dataset.ncattrs())
+        for attr_name, attr_value in self._parts() :
+            if is_classic :
+                old_width  = len(str(dataset.getncattr(attr_name))) if attr_name in old_names else 0
+                attr_value = fixed_width_value(attr_value, max(old_width, PROVENANCE_CLASSIC_ATTR_WIDTH))
+            dataset.setncattr(attr_name, attr_value)
+        dataset.setncattr(OUT_PROVENANCE_FINGERPRINT_ATTR_NAME, PROVENANCE_INCOMPLETE_FINGERPRINT)
+
+    def mark_complete (self, dataset) :
+        """fill in the fingerprint of a finished output file
+
+        The placeholder is the same length as a fingerprint, so replacing it never makes a
+        classic file's header grow.
+
+        :param dataset: an open netCDF4 Dataset that write_attributes was used on
+        """
+
+        dataset.setncattr(OUT_PROVENANCE_FINGERPRINT_ATTR_NAME, self.fingerprint)
+
+def is_up_to_date (file_paths, provenance) :
+    """check whether output files were all finished from the same inputs, grids, options and version
+
+    :param file_paths: the paths of the output files
+    :param provenance: the Provenance the outputs would be made with now
+    :return: True if every file exists and has the same fingerprint
+    """
+
+    fingerprint = provenance.fingerprint
+
+    return all(read_fingerprint(file_path) == fingerprint for file_path in file_paths)
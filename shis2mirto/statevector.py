@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Describe the layout of the Mirto state vector.
+
+This file is part of the shis2mirto software package. The state vector in the fg.nc file
+is built up of several segments, one after another:
+
+    Temperature in [K] <- num_plvls values
+    Water vapor in [log(q)] where q is specific humidity in [kg/kg] <- num_plvls values
+    Carbon dioxide [ ppmv ] <- num_plvls values (may be constant repeated or from GFS data)
+    Ozone in [log(q)] where q is specific humidity in [kg/kg] <- num_plvls values (may be constant repeated or from GFS data)
+    Surface temperature in [K] <- one value
+    Surface emissivity principal component coefficients in logit space <- 5 values, constants from Paolo
+
+The StateVectorLayout keeps track of where each segment starts and ends, so the state
+vector and pressure grid can be filled in place and the xdim / varindx variables are
+always consistent with the data.
+
+The selected state variables (varindx and the sel* variables) are picked with a spec of
+comma separated segment names, each optionally limited to a range of its levels, counted
+from 1 at the first (highest pressure) level like the matlab indexes in varindx:
+
+    temperature,water_vapor:20-101,surface_temperature
+
+"""
+__docformat__ = "restructuredtext en"
+
+import logging
+import numpy
+
+from shis2mirto.guidebook import *
+from shis2mirto.ncoutput  import OutputFormat
+
+log = logging.getLogger(__name__)
+
+class StateVectorLayout (object) :
+    """the segments of the state vector and where they fall
+
+    >>> layout = StateVectorLayout(3, num_emiss_consts=2)
+    >>> layout.size, layout.xdim().tolist()
+    (15, [3, 3, 3, 3, 1, 2])
+    >>> layout.segment_slice(STATE_OZONE_SEGMENT)
+    slice(9, 12, None)
+    >>> layout.selection_indexes("surface_temperature, temperature:2-3, ozone:1").tolist()
+    [1, 2, 9, 12]
+    """
+
+    def __init__ (self, num_plvls, num_emiss_consts=SURFACE_EMISSIVITY_COEFFICIENTS.size) :
+        """create the layout for a given number of pressure levels and emissivity coefficients
+
+        :param num_plvls:        the number of pressure levels in each profile
+        :param num_emiss_consts: the number of surface emissivity coefficients
+        """
+
+        self.num_plvls        = num_plvls
+        self.num_emiss_consts = num_emiss_consts
+        self.segment_names    = list(STATE_VECTOR_SEGMENTS)
+        self.segment_lengths  = [num_plvls, num_plvls, num_plvls, num_plvls, 1, num_emiss_consts]
+        self.segment_offsets  = [int(offset) for offset in numpy.cumsum([0] + self.segment_lengths[:-1])]
+        self.size             = int(numpy.sum(self.segment_lengths))
+
+    def segment_slice (self, segment_name) :
+        """get the slice of the state vector that holds one segment
+
+        :param segment_name: one of the STATE_*_SEGMENT names
+        :return: a slice object
+        """
+
+        index = self.segment_names.index(segment_name)
+
+        return slice(self.segment_offsets[index], self.segment_offsets[index] + self.segment_lengths[index])
+
+    def segment (self, buffer, segment_name) :
+        """get a view of one segment of a (num_obs, size) state vector buffer
+
+        :param buffer:       a buffer from allocate
+        :param segment_name: one of the STATE_*_SEGMENT names
+        :return: a (num_obs, segment length) view into the buffer
+        """
+
+        return buffer[:, self.segment_slice(segment_name)]
+
+    def allocate (self, num_obs, dtype=numpy.float32, fill_value=numpy.nan) :
+        """allocate a (num_obs, size) buffer to be filled in segment by segment
+
+        :param num_obs:    the number of observations
+        :param dtype:      the data type of the buffer
+        :param fill_value: the value to start the buffer with, None to leave it uninitialized
+        :return: a new numpy array
+        """
+
+        if fill_value is None :
+            return numpy.empty((num_obs, self.size), dtype=dtype)
+
+        return numpy.full((num_obs, self.size), fill_value, dtype=dtype)
+
+    def fill_pressure_grid (self, buffer, pressure_profiles, surface_pressures) :
+        """fill in the pressure that goes with each part of the state vector
+
+        The profile segments get the pressure profile and the single value segments (surface
+        temperature and emissivity) get the surface pressure. The pressures may themselves be
+        segment views of the buffer.
+
+        :param buffer:            a (num_obs, size) buffer from allocate
+        :param pressure_profiles: a (num_obs, num_plvls) array of pressures
+        :param surface_pressures: a (num_obs,) or (num_obs, 1) array of surface pressures
+        """
+
+        surface_pressures = numpy.reshape(surface_pressures, (-1, 1))
+        for segment_name in STATE_VECTOR_PROFILE_SEGMENTS :
+            self.segment(buffer, segment_name)[:] = pressure_profiles
+        for segment_name in STATE_VECTOR_SURFACE_SEGMENTS :
+            self.segment(buffer, segment_name)[:] = surface_pressures
+
+    def selection_indexes (self, selection_spec=None) :
+        """get the 0 based state vector indexes picked by a selection spec
+
+        :param selection_spec: comma separated segment or segment:first-last or segment:level items;
+                               None (or "all") for the whole state vector
+        :return: a sorted array of unique indexes
+        :raises ValueError: if the spec names an unknown segment or levels outside a segment
+        """
+
+        if selection_spec is None or selection_spec.strip().lower() == STATE_SELECT_ALL :
+            return numpy.arange(self.size)
+
+        selected = [ ]
+        for item in selection_spec.split(",") :
+            item = item.strip()
+            if not item :
+                continue
+            segment_name, _, level_spec = item.partition(":")
+            segment_name = segment_name.strip()
+            if segment_name not in self.segment_names :
+                raise ValueError("Unknown state vector segment '" + segment_name + "', expected one of: " +
+                                 ", ".join(self.segment_names))
+            segment_slice = self.segment_slice(segment_name)
+            num_levels    = segment_slice.stop - segment_slice.start
+
+            first_level, last_level = 1, num_levels
+            if level_spec.strip() :
+                try :
+                    first_text, _, last_text = level_spec.partition("-")
+                    first_level = int(first_text)
+                    last_level  = int(last_text) if last_text.strip() else first_level
+                except ValueError :
+                    raise ValueError("Unable to understand the levels in the state selection item: " + item)
+            if not 1 <= first_level <= last_level <= num_levels :
+                raise ValueError("The levels in the state selection item " + item + " must be from 1 to " +
+                                 str(num_levels) + ", in order")
+
+            selected.append(numpy.arange(segment_slice.start + first_level - 1, segment_slice.start + last_level))
+
+        if not selected :
+            raise ValueError("The state selection doesn't pick anything: " + selection_spec)
+
+        return numpy.unique(numpy.concatenate(selected))
+
+    def xdim (self) :
+        """get the length of each segment, as stored in the xdim variable"""
+
+        return numpy.array(self.segment_lengths)
+
+    def create_dimensions (self, out_fg_file, num_obs, num_selected=None) :
+        """create the state vector related dimensions in a first guess file
+
+        :param out_fg_file:  an open netCDF4 Dataset
+        :param num_obs:      the number of observations, or None to make the obsnum dimension unlimited
+        :param num_selected: the number of selected state variables, all of them if this is None
+        """
+
+        num_selected = self.size if num_selected is None else num_selected
+        out_fg_file.createDimension(OUT_FG_NUM_STATEVAR_DIM_NAME,          size=self.size)
+        out_fg_file.createDimension(OUT_FG_OBS_NUM_DIM_NAME,               size=num_obs)
+        out_fg_file.createDimension(OUT_FG_STATEVAR_DIMS_DIM_NAME,         size=len(self.segment_lengths))
+        out_fg_file.createDimension(OUT_FG_NUM_SELECTED_STATEVAR_DIM_NAME, size=num_selected)
+
+    def write_xdim (self, out_fg_file, output_format=None) :
+        """create and fill the xdim variable in a first guess file
+
+        :param out_fg_file:   an open netCDF4 Dataset with the dimensions from create_dimensions
+        :param output_format: the OutputFormat of the file, classic if this is None
+        """
+
+        output_format = OutputFormat() if output_format is None else output_format
+        temp_var = output_format.create_variable(out_fg_file, OUT_FG_STATE_VECTOR_DIMS_VAR_NAME, numpy.int32,
+                                                 (OUT_FG_STATEVAR_DIMS_DIM_NAME))
+        temp_var[0:len(self.segment_lengths)] = self.xdim()
+
+    def write_varindx (self, out_fg_file, output_format=None, selected_indexes=None) :
+        """create and fill the varindx variable in a first guess file
+
+        :param out_fg_file:      an open netCDF4 Dataset with the dimensions from create_dimensions
+        :param output_format:    the OutputFormat of the file, classic if this is None
+        :param selected_indexes: the 0 based indexes of the selected state variables, all of them if this is None
+        """
+
+        output_format      = OutputFormat() if output_format is None else output_format
+        temp_selected_indx = numpy.arange(0, self.size) if selected_indexes is None else selected_indexes
+        temp_var = output_format.create_variable(out_fg_file, OUT_FG_SEL_STATE_VECTOR_IDX_VAR_NAME, numpy.int32,
+                                                 (OUT_FG_NUM_SELECTED_STATEVAR_DIM_NAME))
+        temp_var[0:temp_selected_indx.size] = temp_selected_indx + 1 # use matlab indexing
@@ -0,0 +1,377 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Thin the selected fovs into distance and time buckets before the retrieval.
+
+This file is part of the shis2mirto software package. Each fov falls in a bucket made of
+a square of ground distance_km across (on a grid of latitude rows, each cut into columns
+of that width) and a stretch of time seconds long. The buckets only depend on the fov's
+own position and time, so they come out the same however the records are split into
+blocks. There are two ways to thin:
+
+    pick:    keep the first fov in each bucket, or every k-th one in record order
+    average: replace the fovs in each bucket with one super-observation, the mean of their
+             radiances, positions, times and angles, and record how many fovs went into it
+
+The buckets of the whole granule are planned first, from the positions and times alone,
+so the size of the output is known before any radiances are read. Picking only needs
+the plan, as a record filter:
+
+    thinning = Thinning(THIN_MODE_AVERAGE, distance_km=10.0, seconds=60.0)
+    plans    = plan_thinning(shis_data, windows, thinning)
+    builders = [SuperObservationBuilder(thinning, plan.bucket_sizes) for plan in plans]
+
+A SuperObservationBuilder collects the fovs of each bucket as the blocks go by and
+hands back each super-observation once the last fov in its bucket has been seen.
+
+Fovs without a usable position or time can't be put in a bucket, so they're left out
+of the thinned output entirely rather than being merged with each other.
+
+"""
+__docformat__ = "restructuredtext en"
+
+import logging
+
+import numpy
+
+from shis2mirto.guidebook import *
+from shis2mirto.fov       import FovProduct, fov_angle_mask
+
+log = logging.getLogger(__name__)
+
+# the bucket row and column of fovs that don't have a usable position
+INVALID_BUCKET = numpy.iinfo(numpy.int64).min
+
+class Thinning (object) :
+    """how to thin the fovs: the mode and the size of the buckets
+
+    >>> thinning = Thinning(THIN_MODE_PICK, distance_km=10.0, seconds=60.0)
+    >>> thinning.bucket_keys(numpy.array([-90.0, -90.01, -89.5]), numpy.array([30.0, 30.01, 30.0]),
+    ...                      numpy.array([10.0, 50.0, 70.0])).tolist()
+    [[0, 333, -867], [0, 333, -867], [1, 333, -862]]
+    """
+
+    def __init__ (self, mode, distance_km=DEFAULT_THIN_DISTANCE_KM, seconds=DEFAULT_THIN_SECONDS, every=None) :
+        """
+        :param mode:        one of the THIN_MODES
+        :param distance_km: the width of the buckets on the ground, 0 to only bucket by time
+        :param seconds:     the length of the buckets in time, 0 to only bucket by position
+        :param every:       in pick mode keep every k-th fov of each bucket; None to only keep the first
+        :raises ValueError: if the mode or the bucket sizes don't make sense
+        """
+
+        if mode not in THIN_MODES :
+            raise ValueError("Unknown thinning mode: " + str(mode))
+        if distance_km < 0.0 or seconds < 0.0 or (distance_km == 0.0 and seconds == 0.0) :
+            raise ValueError("Thinning needs a positive bucket distance or time")
+        if every is not None and every < 1 :
+            raise ValueError("Thinning can't pick every " + str(every) + " fovs")
+
+        self.mode        = mode
+        self.distance_km = float(distance_km)
+        self.seconds     = float(seconds)
+        self.every       = every
+
+    def bucket_keys (self, lon, lat, epoch_seconds) :
+        """get the (time, row, column) bucket of each fov
+
+        :param lon:           a (num_obs,) array of longitudes
+        :param lat:           a (num_obs,) array of latitudes
+        :param epoch_seconds: a (num_obs,) array of times in seconds since the epoch
+        :return: a (num_obs, 3) integer array
+        """
+
+        lon   = numpy.ma.filled(numpy.ma.asarray(lon,           dtype=numpy.float64), numpy.nan)
+        lat   = numpy.ma.filled(numpy.ma.asarray(lat,           dtype=numpy.float64), numpy.nan)
+        times = numpy.ma.filled(numpy.ma.asarray(epoch_seconds, dtype=numpy.float64), numpy.nan)
+        keys  = numpy.zeros((lon.size, 3), dtype=numpy.int64)
+
+        if self.seconds > 0.0 :
+            valid          = numpy.isfinite(times)
+            keys[:, 0]     = INVALID_BUCKET
+            keys[valid, 0] = numpy.floor(times[valid] / self.seconds)
+
+        if self.distance_km > 0.0 :
+            # rows of latitude, each cut into columns the same distance wide at the row's center
+            valid           = numpy.isfinite(lon) & numpy.isfinite(lat)
+            rows            = numpy.floor(lat[valid] * KM_PER_DEGREE_LATITUDE / self.distance_km)
+            row_centers     = numpy.radians((rows + 0.5) * self.distance_km / KM_PER_DEGREE_LATITUDE)
+            km_per_degree   = KM_PER_DEGREE_LATITUDE * numpy.maximum(numpy.cos(row_centers), 1.0e-6)
+            wrapped_lon     = numpy.mod(lon[valid] + 180.0, 360.0) - 180.0
+            keys[:, 1:]     = INVALID_BUCKET
+            keys[valid, 1]  = rows
+            keys[valid, 2]  = numpy.floor(wrapped_lon * km_per_degree / self.distance_km)
+
+        return keys
+
+def valid_bucket_mask (keys) :
+    """find the fovs that have a bucket, the ones with a usable position and time
+
+    >>> valid_bucket_mask(numpy.array([[0, 1, 1], [0, INVALID_BUCKET, INVALID_BUCKET]])).tolist()
+    [True, False]
+
+    :param keys: a (num_obs, 3) array of bucket keys
+    :return: a (num_obs,) boolean array
+    """
+
+    return ~numpy.any(keys == INVALID_BUCKET, axis=1)
+
+def bucket_ranks (keys) :
+    """number the fovs within each bucket, in the order they come
+
+    >>> bucket_ranks(numpy.array([[0, 1, 1], [0, 1, 2], [0, 1, 1], [0, 1, 1]])).tolist()
+    [0, 0, 1, 2]
+
+    :param keys: a (num_obs, 3) array of bucket keys
+    :return: a (num_obs,) array, 0 for the first fov in its bucket, 1 for the next, ...
+    """
+
+    if keys.shape[0] == 0 :
+        return numpy.zeros(0, dtype=numpy.int64)
+
+    unique_keys, inverse = numpy.unique(keys, axis=0, return_inverse=True)
+    inverse      = inverse.ravel()
+    order        = numpy.argsort(inverse, kind='mergesort')
+    group_starts = numpy.searchsorted(inverse[order], numpy.arange(len(unique_keys)))
+    ranks        = numpy.empty(keys.shape[0], dtype=numpy.int64)
+    ranks[order] = numpy.arange(keys.shape[0]) - group_starts[inverse[order]]
+
+    return ranks
+
+def bucket_sizes (keys) :
+    """count the fovs in each bucket
+
+    :param keys: a (num_obs, 3) array of bucket keys
+    :return: a dictionary of the number of fovs keyed on (time, row, column) tuples
+    """
+
+    if keys.shape[0] == 0 :
+        return { }
+
+    unique_keys, counts = numpy.unique(keys, axis=0, return_counts=True)
+
+    return dict((tuple(key), int(count)) for key, count in zip(unique_keys.tolist(), counts))
+
+class ThinningPlan (object) :
+    """the buckets of one window's fovs over a whole granule"""
+
+    def __init__ (self, record_mask, bucket_sizes) :
+        """
+        :param record_mask:  a (num_records,) boolean array of the records to read for the window; in pick
+                             mode only the picked ones
+        :param bucket_sizes: a dictionary of the number of fovs in each bucket
+        """
+
+        self.record_mask  = record_mask
+        self.bucket_sizes = bucket_sizes
+
+    @property
+    def num_obs (self) :
+        """the number of observations the window will have after thinning"""
+
+        return len(self.bucket_sizes) if self.bucket_sizes is not None else int(numpy.count_nonzero(self.record_mask))
+
+def plan_thinning (shis_data, windows, thinning, record_filters=None) :
+    """work out the buckets of each window's fovs, from the positions and times of all the records
+
+    :param shis_data:      an open SHIS Dataset or a ShisData object
+    :param windows:        a list of (name, center angle, angle range) tuples
+    :param thinning:       the Thinning to plan
+    :param record_filters: an optional list with one entry per window of either None or a boolean array
+                           over all the records, False for records the window should skip
+    :return: a list with a ThinningPlan for each window, whose record masks can be used as record filters;
+             in pick mode the plans have no bucket sizes
+    """
+
+    variables     = shis_data.variables
+    fov_angles    = variables[SHIS_FOV_ANGLE_VAR_NAME][:]
+    epoch_seconds = (numpy.ma.getdata(variables[SHIS_TIME_OFFSET_VAR_NAME][:]).astype(numpy.float64) +
+                     variables[SHIS_BASE_TIME_VAR_NAME][0])
+    record_keys   = thinning.bucket_keys(variables[SHIS_LON_VAR_NAME][:], variables[SHIS_LAT_VAR_NAME][:], epoch_seconds)
+    valid_records = valid_bucket_mask(record_keys)
+
+    plans = [ ]
+    for index, (name, center_angle, angle_range) in enumerate(windows) :
+        record_mask = fov_angle_mask(fov_angles, center_angle, angle_range)
+        if record_filters is not None and record_filters[index] is not None :
+            record_mask = record_mask & record_filters[index]
+        num_invalid = int(numpy.count_nonzero(record_mask & ~valid_records))
+        if num_invalid > 0 :
+            log.info("Leaving out " + str(num_invalid) + " fovs without a usable position or time from the thinning")
+        record_mask = record_mask & valid_records
+        window_keys = record_keys[record_mask]
+
+        if thinning.mode == THIN_MODE_PICK :
+            ranks      = bucket_ranks(window_keys)
+            picked     = (ranks % thinning.every == 0) if thinning.every is not None else (ranks == 0)
+            pick_mask  = numpy.zeros(record_mask.shape, dtype=bool)
+            pick_mask[numpy.flatnonzero(record_mask)[picked]] = True
+            plans.append(ThinningPlan(pick_mask, None))
+        else :
+            plans.append(ThinningPlan(record_mask, bucket_sizes(window_keys)))
+
+    return plans
+
+def _group_sums (values, order, group_starts) :
+    """add up the values of each group, leaving out masked values
+
+    :return: the sums and the number of values that went into each
+    """
+
+    mask   = numpy.ma.getmaskarray(values)[order]
+    data   = numpy.where(mask, 0.0, numpy.ma.getdata(values)[order].astype(numpy.float64))
+    sums   = numpy.add.reduceat(data,  group_starts, axis=0)
+    counts = numpy.add.reduceat(~mask, group_starts, axis=0, dtype=numpy.int64)
+
+    return sums, counts
+
+def _mean (sums, counts) :
+    """divide the sums by the counts, masking anything that had no values"""
+
+    no_values = counts == 0
+    means     = sums / numpy.where(no_values, 1, counts)
+
+    return numpy.ma.array(means, mask=no_values) if numpy.any(no_values) else means
+
+class SuperObservationBuilder (object) :
+    """average the fovs in each bucket into super-observations as the blocks of fovs go by
+
+    The super-observations come out in the order the last fov of each bucket was seen, so
+    the result is the same whether the fovs come in one block or many.
+
+    >>> thinning = Thinning(THIN_MODE_AVERAGE, distance_km=0.0, seconds=10.0)
+    >>> def block (times, lons) :
+    ...     lons = numpy.array(lons)
+    ...     return FovProduct(0.0, lons, numpy.zeros(lons.size), numpy.array(times), numpy.zeros(lons.size),
+    ...                       numpy.zeros(lons.size), numpy.array([lons, -lons]).T, numpy.array([1.0, 2.0]), [1])
+    >>> builder = SuperObservationBuilder(thinning, {(0, 0, 0): 2, (1, 0, 0): 2})
+    >>> first  = builder.add(block([1.0, 2.0, 11.0], [179.0, -179.0, 10.0]))
+    >>> first.lon.tolist(), first.fov_count.tolist(), first.selected_radiances.tolist()
+    ([-180.0], [2], [[0.0]])
+    >>> second = builder.add(block([12.0, numpy.nan], [20.0, 30.0]))
+    >>> second.lon.tolist(), second.time_offset.tolist(), builder.num_pending
+    ([15.0], [11.5], 0)
+    """
+
+    def __init__ (self, thinning, bucket_sizes) :
+        """
+        :param thinning:     the Thinning the buckets were planned with
+        :param bucket_sizes: a dictionary of the number of fovs in each bucket, see plan_thinning
+        """
+
+        self.thinning     = thinning
+        self.bucket_sizes = bucket_sizes
+        self._pending     = { }
+
+    @property
+    def num_pending (self) :
+        """the number of buckets that have some of their fovs but not all of them"""
+
+        return len(self._pending)
+
+    def add (self, product) :
+        """add a block of fovs and get any super-observations that are now complete
+
+        :param product: a FovProduct of the next fovs; any without a usable position or time are left out
+        :return: a FovProduct of the finished super-observations, which may have none
+        :raises ValueError: if a fov doesn't fit in the planned buckets
+        """
+
+        epoch_seconds = numpy.ma.getdata(product.epoch_seconds()).astype(numpy.float64)
+        keys          = self.thinning.bucket_keys(product.lon, product.lat, epoch_seconds)
+        valid         = valid_bucket_mask(keys)
+        if not numpy.all(valid) :
+            product       = product.subset(valid)
+            epoch_seconds = epoch_seconds[valid]
+            keys          = keys[valid]
+        if keys.shape[0] == 0 :
+            return product
+
+        unique_keys, first_positions, inverse = numpy.unique(keys, axis=0, return_index=True, return_inverse=True)
+        inverse      = inverse.ravel()
+        order        = numpy.argsort(inverse, kind='mergesort')
+        group_starts = numpy.searchsorted(inverse[order], numpy.arange(len(unique_keys)))
+        last_seen    = numpy.zeros(len(unique_keys), dtype=numpy.int64)
+        numpy.maximum.at(last_seen, inverse, numpy.arange(keys.shape[0]))
+
+        # the longitudes and times are added up relative to the first fov in each bucket, so buckets at the
+        # date line average properly and the times come out the same however the fovs were split into blocks
+        lon         = numpy.ma.asarray(product.lon,         dtype=numpy.float64)
+        matlab_time = numpy.ma.asarray(product.matlab_time, dtype=numpy.float64)
+        reference   = [ ]
+        for group, key in enumerate(map(tuple, unique_keys.tolist())) :
+            if key not in self._pending :
+                first = first_positions[group]
+                self._pending[key] = { 'count': 0, 'ref_lon': float(numpy.ma.getdata(lon)[first]),
+                                       'ref_time': float(epoch_seconds[first]),
+                                       'ref_matlab_time': float(numpy.ma.getdata(matlab_time)[first]), 'sums': { } }
+            reference.append(self._pending[key])
+        ref_lon         = numpy.array([bucket['ref_lon']         for bucket in reference])[inverse]
+        ref_time        = numpy.array([bucket['ref_time']        for bucket in reference])[inverse]
+        ref_matlab_time = numpy.array([bucket['ref_matlab_time'] for bucket in reference])[inverse]
+
+        fields = {
+                  'lon':         numpy.mod(lon - ref_lon + 180.0, 360.0) - 180.0,
+                  'lat':         product.lat,
+                  'time':        numpy.ma.array(epoch_seconds - ref_time, mask=numpy.ma.getmask(product.time_offset)),
+                  'matlab_time': matlab_time - ref_matlab_time,
+                  'fov_angle':   product.fov_angle,
+                 }
+        if product.radiances is not None :
+            fields['radiances'] = product.radiances
+        else :
+            fields['selected_radiances'] = product.selected_radiances
+
+        # add this block's sums to the buckets
+        for field_name, values in fields.items() :
+            sums, counts = _group_sums(values, order, group_starts)
+            for group, bucket in enumerate(reference) :
+                if field_name in bucket['sums'] :
+                    bucket['sums'][field_name][0] += sums[group]
+                    bucket['sums'][field_name][1] += counts[group]
+                else :
+                    bucket['sums'][field_name] = [sums[group], counts[group]]
+        block_counts = numpy.bincount(inverse, minlength=len(unique_keys))
+
+        # hand back the buckets this block finished
+        finished = [ ]
+        for group, key in enumerate(map(tuple, unique_keys.tolist())) :
+            bucket = reference[group]
+            bucket['count'] += int(block_counts[group])
+            expected = self.bucket_sizes.get(key)
+            if expected is None or bucket['count'] > expected :
+                raise ValueError("Found more fovs than were planned for the thinning bucket " + str(key))
+            if bucket['count'] == expected :
+                finished.append((last_seen[group], key))
+        finished.sort()
+        buckets = [self._pending.pop(key) for position, key in finished]
+
+        return self._build_product(product, buckets)
+
+    def _build_product (self, product, buckets) :
+        """average finished buckets into a FovProduct"""
+
+        def _field_mean (field_name) :
+            sums   = numpy.array([bucket['sums'][field_name][0] for bucket in buckets])
+            counts = numpy.array([bucket['sums'][field_name][1] for bucket in buckets])
+            return _mean(sums, counts)
+
+        if not buckets :
+            return product.subset(numpy.zeros(product.num_obs, dtype=bool))
+
+        lon = numpy.array([bucket['ref_lon'] for bucket in buckets]) + _field_mean('lon')
+        lon = numpy.where(lon >= 180.0, lon - 360.0, numpy.where(lon < -180.0, lon + 360.0, lon))
+
+        epoch_seconds = numpy.array([bucket['ref_time']        for bucket in buckets]) + _field_mean('time')
+        matlab_time   = numpy.array([bucket['ref_matlab_time'] for bucket in buckets]) + _field_mean('matlab_time')
+        radiances     = None
+        selected_rads = None
+        if product.radiances is not None :
+            radiances     = _field_mean('radiances').astype(product.radiances.dtype)
+        else :
+            selected_rads = _field_mean('selected_radiances').astype(product.selected_radiances.dtype)
+
+        return FovProduct(product.base_time, lon, _field_mean('lat'), epoch_seconds - product.base_time,
+                          matlab_time, _field_mean('fov_angle'), radiances,
+                          product.wavenumbers, product.selected_indexes, selected_radiances=selected_rads,
+                          fov_count=numpy.array([bucket['count'] for bucket in buckets], dtype=numpy.int32))
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Convert SHIS epoch times into the time formats Mirto and the Virtual Radiosonde want.
+
+This file is part of the shis2mirto software package. SHIS times are stored as a base
+time plus an offset, both in seconds since 1970-01-01 00:00:00. The fov.nc file also
+needs them as matlab datenums and the Virtual Radiosonde needs them as datetimes.
+
+"""
+__docformat__ = "restructuredtext en"
+
+import time
+import logging
+import calendar
+from datetime import datetime, timedelta
+
+import numpy
+
+from shis2mirto.guidebook import *
+
+log = logging.getLogger(__name__)
+
+def _local_utc_offset_seconds (epoch_seconds) :
+    """find the offset in seconds from UTC to the local time zone at each of the epoch times
+
+    The offsets are only looked up once per distinct minute, since time zone changes
+    happen on minute boundaries.
+    """
+
+    epoch_seconds    = numpy.asarray(epoch_seconds, dtype=numpy.float64)
+    minutes, inverse = numpy.unique(numpy.floor(epoch_seconds.ravel() / 60.0), return_inverse=True)
+    offsets          = numpy.array([calendar.timegm(time.localtime(minute * 60.0)) - (minute * 60.0) for minute in minutes])
+
+    return numpy.reshape(offsets[inverse], epoch_seconds.shape)
+
+def epoch_seconds_to_matlab_datenum (epoch_seconds, time_zone=DEFAULT_TIME_ZONE_POLICY) :
+    """convert an array of seconds since 1970-01-01 00:00:00 into matlab datenums
+
+    This is done entirely with array arithmetic, datenum = epoch seconds / 86400 + 719529
+
+    >>> epoch_seconds_to_matlab_datenum(numpy.array([0.0, 43200.0, 1410000000.0])).tolist()
+    [719529.0, 719529.5, 735848.4444444445]
+
+    :param epoch_seconds: an array of times in seconds since the epoch
+    :param time_zone:     TIME_ZONE_UTC to treat the times as UTC or TIME_ZONE_LOCAL to shift them to the local time zone
+    :return: an array of float64 matlab datenums, the same shape as epoch_seconds
+    """
+
+    epoch_seconds = numpy.asarray(numpy.ma.getdata(epoch_seconds), dtype=numpy.float64)
+
+    if time_zone == TIME_ZONE_LOCAL :
+        epoch_seconds = epoch_seconds + _local_utc_offset_seconds(epoch_seconds)
+    elif time_zone != TIME_ZONE_UTC :
+        raise ValueError("Unknown time zone policy: " + str(time_zone))
+
+    return (epoch_seconds / SECONDS_PER_DAY) + MATLAB_DATENUM_AT_UNIX_EPOCH
+
+def epoch_seconds_to_datetimes (epoch_seconds, time_zone=DEFAULT_TIME_ZONE_POLICY) :
+    """convert an array of seconds since 1970-01-01 00:00:00 into a list of naive datetimes
+
+    >>> epoch_seconds_to_datetimes(numpy.array([0.0, 1410000000.5]))
+    [datetime.datetime(1970, 1, 1, 0, 0), datetime.datetime(2014, 9, 6, 10, 40, 0, 500000)]
+
+    :param epoch_seconds: an array of times in seconds since the epoch
+    :param time_zone:     TIME_ZONE_UTC to treat the times as UTC or TIME_ZONE_LOCAL to shift them to the local time zone
+    :return: a list of datetime objects
+    """
+
+    epoch_seconds = numpy.asarray(numpy.ma.getdata(epoch_seconds), dtype=numpy.float64).ravel()
+
+    if time_zone == TIME_ZONE_LOCAL :
+        epoch_seconds = epoch_seconds + _local_utc_offset_seconds(epoch_seconds)
+    elif time_zone != TIME_ZONE_UTC :
+        raise ValueError("Unknown time zone policy: " + str(time_zone))
+
+    epoch_start = datetime(1970, 1, 1, 0, 0, 0)
+
+    return [epoch_start + timedelta(seconds=float(seconds)) for seconds in epoch_seconds]
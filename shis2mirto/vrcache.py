@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Manage a persistent cache directory for the Virtual Radiosonde GFS data.
+
+This file is part of the shis2mirto software package. The Virtual Radiosonde code keeps the
+GFS fields it downloads and decodes in whatever cache directory it's given. This module hands
+it a stable directory under a persistent cache root for each GFS forecast file, keyed on the
+cycle and forecast hour valid at one GFS output time:
+
+    <cache root>/<YYYYMMDD>/t<HH>z/f<FFF>/
+
+By default a run uses one narrator, which keeps everything it fetches in the entry of the
+first GFS output its observations need (see vr_cache_run_dir), so running the same flight
+again, appending to it or converting another granule that starts in the same forecast step
+reuses the data that was already fetched. When the narrator queries are split by GFS output
+time (see CachedForecastNarrator in firstguess), a span of observations covers every output
+time from the one at or before its start to the one at or after its end, and each of those
+entries is shared by every run that needs it. Each entry records when it was last used,
+which lets the cache be pruned in least recently used order down to a size or age limit.
+
+"""
+__docformat__ = "restructuredtext en"
+
+import os
+import time
+import shutil
+import logging
+from datetime import datetime, timedelta
+
+import numpy
+
+from shis2mirto.guidebook import *
+
+log = logging.getLogger(__name__)
+
+_EPOCH_START = datetime(1970, 1, 1, 0, 0, 0)
+
+def gfs_forecast_key (valid_time) :
+    """build the cache key for the GFS forecast file valid at one GFS output time
+
+    The key is made of the most recent GFS cycle at or before the valid time and the
+    forecast hour from that cycle to the valid time.
+
+    >>> gfs_forecast_key(datetime(2014, 9, 6, 9, 0))
+    '20140906/t06z/f003'
+    >>> gfs_forecast_key(datetime(2014, 9, 6, 12, 0))
+    '20140906/t12z/f000'
+
+    :param valid_time: the datetime of the GFS output
+    :return: a relative path string
+    """
+
+    cycle_time    = datetime(valid_time.year, valid_time.month, valid_time.day,
+                             valid_time.hour - (valid_time.hour % GFS_CYCLE_HOURS))
+    forecast_hour = int((valid_time - cycle_time).total_seconds() // 3600.0)
+
+    return os.path.join(cycle_time.strftime("%Y%m%d"), cycle_time.strftime("t%Hz"), "f%03d" % forecast_hour)
+
+def gfs_output_times (start_time, end_time, time_step_hours=GFS_FORECAST_STEP_HOURS) :
+    """list the GFS output times needed to interpolate in time over a span of observations
+
+    >>> [valid_time.hour for valid_time in gfs_output_times(datetime(2014, 9, 6, 10, 40), datetime(2014, 9, 6, 14, 5))]
+    [9, 12, 15]
+    >>> gfs_output_times(datetime(2014, 9, 6, 12, 0), datetime(2014, 9, 6, 12, 0))
+    [datetime.datetime(2014, 9, 6, 12, 0)]
+
+    :param start_time:      the datetime of the earliest observation
+    :param end_time:        the datetime of the latest observation
+    :param time_step_hours: the number of hours between GFS outputs
+    :return: a list of datetimes, from the output at or before the start to the one at or after the end
+    """
+
+    time_step_seconds = time_step_hours * 3600.0
+    first_step        = int(numpy.floor((start_time - _EPOCH_START).total_seconds() / time_step_seconds))
+    last_step         = int(numpy.ceil((end_time - _EPOCH_START).total_seconds() / time_step_seconds))
+
+    return [_EPOCH_START + timedelta(seconds=step * time_step_seconds) for step in range(first_step, last_step + 1)]
+
+def gfs_forecast_keys (start_time, end_time, time_step_hours=GFS_FORECAST_STEP_HOURS) :
+    """list the keys of the GFS forecast files the profiles for a span of observations come from
+
+    >>> gfs_forecast_keys(datetime(2014, 9, 6, 10, 40), datetime(2014, 9, 6, 10, 43))
+    ['20140906/t06z/f003', '20140906/t12z/f000']
+
+    :param start_time:      the datetime of the earliest observation
+    :param end_time:        the datetime of the latest observation
+    :param time_step_hours: the number of hours between GFS outputs
+    :return: a list of relative path strings (see gfs_forecast_key), in time order
+    """
+
+    return [gfs_forecast_key(valid_time)
+            for valid_time in gfs_output_times(start_time, end_time, time_step_hours=time_step_hours)]
+
+def _mark_used (entry_path) :
+    """record that a cache entry was just used"""
+
+    marker_path = os.path.join(entry_path, VR_CACHE_LAST_USED_FILE_NAME)
+    with open(marker_path, 'a') :
+        os.utime(marker_path, None)
+
+def vr_cache_entry_dir (cache_root, valid_time) :
+    """get the cache directory to use for the GFS forecast file valid at one GFS output time
+
+    The directory is created if it doesn't exist yet, and it's marked as just used.
+
+    :param cache_root: the root directory of the persistent cache
+    :param valid_time: the datetime of the GFS output
+    :return: the path to the cache entry directory
+    """
+
+    entry_path = os.path.join(cache_root, gfs_forecast_key(valid_time))
+    if not os.path.isdir(entry_path) :
+        log.debug("creating new virtual radiosonde cache entry: " + entry_path)
+        try :
+            os.makedirs(entry_path)
+        except OSError :
+            if not os.path.isdir(entry_path) :
+                raise # it wasn't just another process making the same entry
+    else :
+        log.debug("reusing virtual radiosonde cache entry: " + entry_path)
+    _mark_used(entry_path)
+
+    return entry_path
+
+def vr_cache_run_dir (cache_root, start_time, time_step_hours=GFS_FORECAST_STEP_HOURS) :
+    """get the cache directory for a run that asks one narrator for all of its observations
+
+    This is the entry of the GFS output at or before the earliest observation.
+
+    :param cache_root:      the root directory of the persistent cache
+    :param start_time:      the datetime of the earliest observation
+    :param time_step_hours: the number of hours between GFS outputs
+    :return: the path to the cache entry directory
+    """
+
+    return vr_cache_entry_dir(cache_root, gfs_output_times(start_time, start_time, time_step_hours=time_step_hours)[0])
+
+def vr_cache_entry_dirs (cache_root, start_time, end_time, time_step_hours=GFS_FORECAST_STEP_HOURS) :
+    """get the cache directories of every GFS forecast file needed for a span of observations
+
+    :param cache_root:      the root directory of the persistent cache
+    :param start_time:      the datetime of the earliest observation
+    :param end_time:        the datetime of the latest observation
+    :param time_step_hours: the number of hours between GFS outputs
+    :return: a list of paths to the cache entry directories, in time order
+    """
+
+    return [vr_cache_entry_dir(cache_root, valid_time)
+            for valid_time in gfs_output_times(start_time, end_time, time_step_hours=time_step_hours)]
+
+def _directory_size (dir_path) :
+    """add up the size in bytes of all the files under a directory"""
+
+    total_bytes = 0
+    for parent_path, dir_names, file_names in os.walk(dir_path) :
+        for file_name in file_names :
+            try :
+                total_bytes += os.path.getsize(os.path.join(parent_path, file_name))
+            except OSError :
+                pass # the file was removed while we were looking
+
+    return total_bytes
+
+def list_vr_cache_entries (cache_root) :
+    """find all the entries in the cache
+
+    :param cache_root: the root directory of the persistent cache
+    :return: a list of (key, path, size in bytes, last used epoch seconds) tuples, least recently used first
+    """
+
+    entries = [ ]
+    if not os.path.isdir(cache_root) :
+        return entries
+
+    # entries are always three directories deep, <day>/<cycle>/<forecast hour>
+    for day_name in sorted(os.listdir(cache_root)) :
+        day_path = os.path.join(cache_root, day_name)
+        if not os.path.isdir(day_path) :
+            continue
+        for cycle_name in sorted(os.listdir(day_path)) :
+            cycle_path = os.path.join(day_path, cycle_name)
+            if not os.path.isdir(cycle_path) :
+                continue
+            for hour_name in sorted(os.listdir(cycle_path)) :
+                entry_path = os.path.join(cycle_path, hour_name)
+                if not os.path.isdir(entry_path) :
+                    continue
+                marker_path = os.path.join(entry_path, VR_CACHE_LAST_USED_FILE_NAME)
+                last_used   = os.path.getmtime(marker_path if os.path.exists(marker_path) else entry_path)
+                entries.append((os.path.join(day_name, cycle_name, hour_name), entry_path,
+                                _directory_size(entry_path), last_used))
+
+    entries.sort(key=lambda entry : entry[3])
+
+    return entries
+
+def vr_cache_stats (cache_root) :
+    """summarize the contents of the cache
+
+    :param cache_root: the root directory of the persistent cache
+    :return: a dictionary with the number of entries, total size in bytes, and the oldest and newest use times
+    """
+
+    entries = list_vr_cache_entries(cache_root)
+
+    return {
+            'root':        cache_root,
+            'num_entries': len(entries),
+            'total_bytes': sum(entry[2] for entry in entries),
+            'oldest_use':  entries[0][3]  if entries else None,
+            'newest_use':  entries[-1][3] if entries else None,
+           }
+
+def prune_vr_cache (cache_root, max_bytes=None, max_age_days=None, keep_paths=()) :
+    """remove least recently used cache entries until the cache fits within the limits
+
+    :param cache_root:   the root directory of the persistent cache
+    :param max_bytes:    the largest total size the cache may have, None for no size limit
+    :param max_age_days: remove any entries not used in this many days, None for no age limit
+    :param keep_paths:   entry paths that must not be removed (ie. the ones in use right now)
+    :return: a list of the removed (key, path, size in bytes, last used epoch seconds) tuples
+    """
+
+    entries     = list_vr_cache_entries(cache_root)
+    total_bytes = sum(entry[2] for entry in entries)
+    keep_paths  = set(os.path.abspath(path) for path in keep_paths)
+    oldest_ok   = (time.time() - max_age_days * 24.0 * 60.0 * 60.0) if max_age_days is not None else None
+
+    removed = [ ]
+    for entry in entries :
+        key, entry_path, entry_bytes, last_used = entry
+        if os.path.abspath(entry_path) in keep_paths :
+            continue
+        too_big = (max_bytes is not None) and (total_bytes > max_bytes)
+        too_old = (oldest_ok is not None) and (last_used < oldest_ok)
+        if not (too_big or too_old) :
+            continue
+
+        log.info("Removing virtual radiosonde cache entry " + key)
+        shutil.rmtree(entry_path, ignore_errors=True)
+        total_bytes -= entry_bytes
+        removed.append(entry)
+
+        # clean up the cycle and day directories if they're empty now
+        for parent_path in (os.path.dirname(entry_path), os.path.dirname(os.path.dirname(entry_path))) :
+            try :
+                os.rmdir(parent_path)
+            except OSError :
+                break # it's not empty
+
+    return removed
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Remap Virtual Radiosonde profiles from the GFS pressure levels to the requested levels.
+
+This file is part of the shis2mirto software package. When the narrator is asked for the
+requested pressure levels it searches for the GFS levels around each one separately for
+every profile. The target levels are the same for every profile in every run, so instead
+the narrator can be asked for the GFS levels themselves and the profiles remapped here.
+A VerticalRemap works out the bracketing source levels and the log-pressure weights of
+each target level once, and they are kept for the rest of the run for each pair of grids:
+
+    levels   = native_source_levels(GFS_PRESSURE_LEVELS_HPA, plevels)
+    remap    = vertical_remap(levels, plevels)
+    profiles = remap.apply(narrator_profiles, surface_pressure=surface_pressures)
+
+Applying the weights is two column gathers and a weighted sum over all the profiles at
+once. The GFS levels don't reach the top (or the bottom) of most target grids, so
+native_source_levels adds the target levels outside them to the levels the narrator is
+asked for; those are copied through as the narrator gave them rather than remapped. A
+VerticalRemap given target levels outside its source levels still works, but it warns
+that they take the value of the nearest source level. Target levels below the ground (at
+a higher pressure than the surface) take the value the profile has at the surface pressure.
+
+"""
+__docformat__ = "restructuredtext en"
+
+import logging
+
+import numpy
+
+from shis2mirto.guidebook import *
+from shis2mirto.physics   import stack_vr_results
+
+log = logging.getLogger(__name__)
+
+# the remaps we've already built during this run, keyed on the source and target levels
+_remap_memory_cache = { }
+
+# the entries of the narrator results that are profiles on the pressure levels
+VR_PROFILE_KEYS = [VR_TEMPERATURE_KEY, VR_RELATIVE_HUMIDITY_KEY, VR_OZONE_MR_KEY]
+
+def native_source_levels (native_levels, target_levels) :
+    """get the levels to ask the narrator for so that remapping to the target levels never goes past them
+
+    These are the native levels, plus any target levels at a higher or lower pressure than all of them.
+
+    >>> native_source_levels([1000.0, 500.0, 10.0], [1100.0, 700.0, 10.0, 5.0, 0.005]).tolist()
+    [1100.0, 1000.0, 500.0, 10.0, 5.0, 0.005]
+
+    :param native_levels: the pressure levels the narrator's data is on
+    :param target_levels: the pressure levels the profiles will be remapped to
+    :return: an array of pressure levels, highest pressure first
+    """
+
+    native_levels = numpy.asarray(native_levels, dtype=numpy.float64)
+    target_levels = numpy.asarray(target_levels, dtype=numpy.float64)
+    outside       = (target_levels < numpy.min(native_levels)) | (target_levels > numpy.max(native_levels))
+
+    return numpy.unique(numpy.concatenate([native_levels, target_levels[outside]]))[::-1]
+
+def _brackets (log_source, log_pressures) :
+    """find the sorted source levels on either side of each pressure and the weight of the upper one"""
+
+    clamped = numpy.clip(log_pressures, log_source[0], log_source[-1])
+    upper   = numpy.clip(numpy.searchsorted(log_source, clamped, side='right'), 1, log_source.size - 1)
+    lower   = upper - 1
+    weight  = (clamped - log_source[lower]) / (log_source[upper] - log_source[lower])
+
+    return lower, upper, weight
+
+class VerticalRemap (object) :
+    """the bracketing levels and log-pressure weights that take profiles from one pressure grid to another
+
+    This gives the same numbers as interpolating each profile in log pressure:
+
+    >>> remap    = VerticalRemap([1000.0, 500.0, 100.0], [1000.0, 700.0, 300.0, 100.0])
+    >>> profiles = numpy.array([[20.0, -10.0, -60.0], [25.0, -5.0, -55.0]])
+    >>> expected = [numpy.interp(numpy.log([1000.0, 700.0, 300.0, 100.0]), numpy.log([100.0, 500.0, 1000.0]),
+    ...                          profile[::-1]) for profile in profiles]
+    >>> numpy.allclose(remap.apply(profiles), expected)
+    True
+    >>> remap.apply(profiles, surface_pressure=numpy.array([1100.0, 600.0]))[:, 0:2].round(3).tolist()
+    [[20.0, 4.563], [2.891, 2.891]]
+
+    Target levels outside the source levels take the value of the nearest one, and a
+    warning is logged when the remap is made (see native_source_levels to avoid them).
+    """
+
+    def __init__ (self, source_levels, target_levels) :
+        """
+        :param source_levels: the pressures of the profiles that will be remapped, in any order
+        :param target_levels: the pressures to remap them to, in the same units
+        :raises ValueError: if there aren't at least two distinct positive source levels
+        """
+
+        source_levels = numpy.asarray(source_levels, dtype=numpy.float64)
+        target_levels = numpy.asarray(target_levels, dtype=numpy.float64)
+        if numpy.unique(source_levels).size < 2 or numpy.any(source_levels <= 0.0) :
+            raise ValueError("Remapping profiles needs at least two distinct positive source pressure levels")
+
+        self.source_levels = source_levels
+        self.target_levels = target_levels
+        self._source_order = numpy.argsort(source_levels, kind='mergesort')
+        self._log_source   = numpy.log(source_levels[self._source_order])
+
+        outside = (target_levels < numpy.min(source_levels)) | (target_levels > numpy.max(source_levels))
+        if numpy.any(outside) :
+            log.warn(str(numpy.count_nonzero(outside)) + " of the " + str(target_levels.size) + " target pressure " +
+                     "levels are outside the source levels and will take the value of the nearest source level")
+
+        lower, upper, weight = _brackets(self._log_source, numpy.log(target_levels))
+        self.lower_index  = self._source_order[lower]
+        self.upper_index  = self._source_order[upper]
+        self.upper_weight = weight
+
+    def interpolate_at (self, profiles, pressures) :
+        """interpolate each profile to its own pressure
+
+        :param profiles:  a (num_profiles, num_source_levels) array
+        :param pressures: a (num_profiles,) array of pressures, one for each profile
+        :return: a (num_profiles,) array
+        """
+
+        lower, upper, weight = _brackets(self._log_source, numpy.log(numpy.asarray(pressures, dtype=numpy.float64)))
+        rows = numpy.arange(profiles.shape[0])
+
+        return (profiles[rows, self._source_order[lower]] * (1.0 - weight) +
+                profiles[rows, self._source_order[upper]] * weight)
+
+    def below_ground_mask (self, surface_pressure) :
+        """find the target levels below the ground for each profile
+
+        :param surface_pressure: a (num_profiles,) array of surface pressures
+        :return: a (num_profiles, num_target_levels) boolean array
+        """
+
+        return self.target_levels[numpy.newaxis, :] > numpy.reshape(surface_pressure, (-1, 1))
+
+    def apply (self, profiles, surface_pressure=None) :
+        """remap profiles to the target levels
+
+        :param profiles:         a (num_profiles, num_source_levels) array
+        :param surface_pressure: an optional (num_profiles,) array of surface pressures; target levels below
+                                 the surface get the profile's value at the surface
+        :return: a (num_profiles, num_target_levels) float64 array
+        """
+
+        profiles = numpy.asarray(profiles, dtype=numpy.float64)
+        remapped = profiles[:, self.lower_index] * (1.0 - self.upper_weight)
+        remapped += profiles[:, self.upper_index] * self.upper_weight
+
+        if surface_pressure is not None :
+            below_ground = self.below_ground_mask(surface_pressure)
+            if numpy.any(below_ground) :
+                surface_values = self.interpolate_at(profiles, surface_pressure)
+                remapped = numpy.where(below_ground, surface_values[:, numpy.newaxis], remapped)
+
+        return remapped
+
+def vertical_remap (source_levels, target_levels) :
+    """get the VerticalRemap between two pressure grids, reusing one we've already built for them
+
+    :param source_levels: the pressures of the profiles that will be remapped
+    :param target_levels: the pressures to remap them to
+    :return: a VerticalRemap
+    """
+
+    key = (tuple(numpy.asarray(source_levels, dtype=numpy.float64).tolist()),
+           tuple(numpy.asarray(target_levels, dtype=numpy.float64).tolist()))
+    if key not in _remap_memory_cache :
+        _remap_memory_cache[key] = VerticalRemap(source_levels, target_levels)
+
+    return _remap_memory_cache[key]
+
+def remap_vr_results (results, remap) :
+    """remap the profiles in a list of narrator results to the target levels of a VerticalRemap
+
+    The levels below the ground are found with the surface pressure the narrator gives
+    (VR_SURFACE_PRESSURE_KEY). If it doesn't give one, no levels are treated as below the
+    ground and a warning is logged; the pressure reduced to mean sea level is never used
+    for this, since over raised terrain it's well below the ground.
+
+    :param results: a list of result dictionaries from the narrator, made on the remap's source levels
+    :param remap:   the VerticalRemap to use
+    :return: a new list of result dictionaries with the profiles on the remap's target levels
+    """
+
+    if not results :
+        return [ ]
+
+    surface_pressure = None
+    if VR_SURFACE_PRESSURE_KEY in results[0] :
+        surface_pressure = stack_vr_results(results, VR_SURFACE_PRESSURE_KEY) / PASCALS_PER_HECTOPASCAL
+    else :
+        log.warn("The narrator didn't give a surface pressure, so no remapped levels are treated as below the ground")
+
+    new_results = [dict(result) for result in results]
+    for key in VR_PROFILE_KEYS :
+        if key not in results[0] :
+            continue
+        remapped = remap.apply(stack_vr_results(results, key), surface_pressure=surface_pressure)
+        for new_result, profile in zip(new_results, remapped) :
+            new_result[key] = profile
+    for new_result in new_results :
+        new_result[VR_PRESSURE_KEY] = remap.target_levels.copy()
+
+    return new_results
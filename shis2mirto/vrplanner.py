@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Plan Virtual Radiosonde queries so that each GFS grid profile is only extracted once.
+
+This file is part of the shis2mirto software package. The Virtual Radiosonde interpolates
+bilinearly in space between the four GFS grid points around each requested point and
+linearly in time between the two bracketing GFS times. Neighboring SHIS observations
+almost always share the same grid cell and time bracket, so instead of asking the
+narrator for every observation, the planner asks it only for the distinct grid corners
+(which it returns without any interpolation, since they fall exactly on the grid) and
+then does the spatial and temporal interpolation for all the observations at once.
+
+The grid spacing and time step given to the planner must match the GFS data the narrator
+uses, otherwise the results will differ from querying the narrator directly. The grid
+wraps around in longitude, so points on either side of the 180th meridian share corners,
+and corners past the poles are held at +/-90 degrees. Corners with no weight for any point
+(ie. when a point falls exactly on a grid line) aren't asked for at all.
+
+The temporal interpolation can also be done here on its own, asking a separate narrator
+for each GFS output time (see query_narrators_by_time), which lets each narrator keep only
+the one GFS forecast file it needs.
+
+"""
+__docformat__ = "restructuredtext en"
+
+import logging
+from datetime import datetime, timedelta
+
+import numpy
+
+from shis2mirto.guidebook import *
+
+log = logging.getLogger(__name__)
+
+# the (latitude, longitude, time) offsets of the 8 corners around each point
+_CORNER_OFFSETS = numpy.array([[d_lat, d_lon, d_time] for d_time in (0, 1) for d_lat in (0, 1) for d_lon in (0, 1)],
+                              dtype=numpy.int64)
+
+_EPOCH_START = datetime(1970, 1, 1, 0, 0, 0)
+
+def _wrap_corners (corners, grid_spacing) :
+    """wrap the longitude steps of the corners into [-180, 180) and hold the latitude steps inside [-90, 90]"""
+
+    lon_cells     = int(round(360.0 / grid_spacing))
+    max_lat_step  = int(numpy.floor(90.0 / grid_spacing + 1.0e-9))
+    corners       = numpy.array(corners)
+    corners[..., 0] = numpy.clip(corners[..., 0], -max_lat_step, max_lat_step)
+    corners[..., 1] = numpy.mod(corners[..., 1] + lon_cells // 2, lon_cells) - lon_cells // 2
+
+    return corners
+
+def plan_corner_queries (lats, lons, epoch_seconds, grid_spacing, time_step_seconds) :
+    """figure out which distinct grid corners are needed for a set of points and how to weight them
+
+    The grid spacing needs to divide evenly into 360 degrees so that the grid wraps around.
+
+    >>> corners, corner_index, weights = plan_corner_queries(numpy.array([0.25, 0.3]), numpy.array([0.1, 0.2]),
+    ...                                                      numpy.array([0.0, 1800.0]), 0.5, 3600.0)
+    >>> corners.shape, corner_index.shape
+    ((8, 3), (2, 8))
+    >>> numpy.allclose(numpy.sum(weights, axis=1), 1.0)
+    True
+
+    Points on either side of the 180th meridian share the corners on it, and the corners
+    past the poles are never asked for:
+
+    >>> corners, corner_index, weights = plan_corner_queries(numpy.array([10.25, 10.25, 90.0]),
+    ...                                                      numpy.array([179.75, -179.75, 0.25]),
+    ...                                                      numpy.array([0.0, 0.0, 0.0]), 0.5, 3600.0)
+    >>> sorted(set((corner[0] * 0.5, corner[1] * 0.5) for corner in corners.tolist()))
+    [(10.0, -180.0), (10.0, -179.5), (10.0, 179.5), (10.5, -180.0), (10.5, -179.5), (10.5, 179.5), (90.0, 0.0), (90.0, 0.5)]
+
+    :param lats:              an array of latitudes for the points
+    :param lons:              an array of longitudes for the points
+    :param epoch_seconds:     an array of times for the points in seconds since the epoch
+    :param grid_spacing:      the spacing of the GFS grid in degrees
+    :param time_step_seconds: the time between GFS outputs in seconds
+    :return: a tuple of (unique corners as an (n, 3) array of integer lat / lon / time steps,
+             an (num_points, 8) array of indexes into the unique corners,
+             an (num_points, 8) array of interpolation weights; a corner with no weight
+             points at the point's heaviest corner so it doesn't need to be asked for)
+    """
+
+    # find the cell position of each point in grid units
+    lat_position  = numpy.clip(numpy.asarray(lats, dtype=numpy.float64), -90.0, 90.0) / grid_spacing
+    lon_position  = numpy.asarray(lons,          dtype=numpy.float64) / grid_spacing
+    time_position = numpy.asarray(epoch_seconds, dtype=numpy.float64) / time_step_seconds
+    positions     = numpy.column_stack((lat_position, lon_position, time_position))
+    base_cell     = numpy.floor(positions)
+
+    # the weights are the usual bilinear weights times the linear time weights
+    fractions = positions - base_cell
+    weights   = numpy.ones((positions.shape[0], _CORNER_OFFSETS.shape[0]), dtype=numpy.float64)
+    for axis in range(3) :
+        axis_fraction = fractions[:, axis:axis + 1]
+        weights      *= numpy.where(_CORNER_OFFSETS[numpy.newaxis, :, axis] == 1, axis_fraction, 1.0 - axis_fraction)
+
+    # list every corner with some weight and find the distinct ones; points without a usable
+    # position or time (which have no weights at all) don't need any corners
+    needed      = weights > 0.0
+    base_cell   = numpy.where(numpy.isfinite(base_cell), base_cell, 0.0).astype(numpy.int64)
+    all_corners = _wrap_corners(base_cell[:, numpy.newaxis, :] + _CORNER_OFFSETS[numpy.newaxis, :, :], grid_spacing)
+    corners, needed_index = numpy.unique(all_corners[needed], axis=0, return_inverse=True)
+
+    # the corners with no weight are pointed at the heaviest corner of the same point
+    corner_index         = numpy.zeros(weights.shape, dtype=numpy.int64)
+    corner_index[needed] = numpy.ravel(needed_index)
+    heaviest             = numpy.argmax(numpy.where(needed, weights, -1.0), axis=1)
+    heaviest             = corner_index[numpy.arange(weights.shape[0]), heaviest]
+    corner_index         = numpy.where(needed, corner_index, heaviest[:, numpy.newaxis])
+
+    return corners, corner_index, weights
+
+def interpolate_corner_results (corner_results, corner_index, weights) :
+    """combine the narrator results at the grid corners into results for each point
+
+    Only the corners with some weight are used, so a missing value at a corner that
+    doesn't count doesn't make the point missing too. Entries that aren't numeric (and
+    so can't be interpolated) are passed through from each point's heaviest corner.
+    Points with no weights at all (ie. with no usable position) get NaNs.
+
+    >>> corner_results = [{'t': 1.0, 'name': 'a'}, {'t': 3.0, 'name': 'b'}, {'t': numpy.nan, 'name': 'c'}]
+    >>> results = interpolate_corner_results(corner_results, numpy.array([[0, 1, 2], [1, 2, 0]]),
+    ...                                      numpy.array([[0.75, 0.25, 0.0], [1.0, 0.0, 0.0]]))
+    >>> [(float(result['t']), result['name']) for result in results]
+    [(1.5, 'a'), (3.0, 'b')]
+
+    :param corner_results: a list of result dictionaries from the narrator, one per unique corner
+    :param corner_index:   an (num_points, 8) array of indexes into the corner results
+    :param weights:        an (num_points, 8) array of interpolation weights
+    :return: a list of result dictionaries, one per point, like the narrator would have returned
+    """
+
+    num_points = corner_index.shape[0]
+    results    = [{ } for index in range(num_points)]
+    if not corner_results :
+        return results
+
+    used          = weights > 0.0
+    no_weights    = ~numpy.any(used, axis=1)
+    point_indexes = numpy.arange(num_points)
+    nearest       = corner_index[point_indexes, numpy.argmax(numpy.where(used, weights, -1.0), axis=1)]
+    for key in corner_results[0].keys() :
+        try :
+            stacked = numpy.array([result[key] for result in corner_results], dtype=numpy.float64)
+        except (TypeError, ValueError) :
+            # this isn't numeric data, so there's nothing to interpolate
+            log.debug("Passing " + str(key) + " through from the nearest grid corner without interpolating it")
+            for index in point_indexes :
+                results[index][key] = corner_results[nearest[index]][key]
+            continue
+
+        temp_weights = numpy.reshape(weights, weights.shape + (1,) * (stacked.ndim - 1))
+        temp_used    = numpy.reshape(used,    used.shape    + (1,) * (stacked.ndim - 1))
+        interpolated = numpy.sum(numpy.where(temp_used, stacked[corner_index] * temp_weights, 0.0), axis=1)
+        interpolated[no_weights] = numpy.nan
+        for index in point_indexes :
+            results[index][key] = interpolated[index]
+
+    return results
+
+def _point_epoch_seconds (desired_points) :
+    """get the times of a list of narrator points in seconds since the epoch"""
+
+    return numpy.array([(point[VR_INPUT_DATETIME_KEY] - _EPOCH_START).total_seconds() for point in desired_points],
+                       dtype=numpy.float64)
+
+def plan_time_queries (epoch_seconds, time_step_seconds) :
+    """figure out which GFS output times are needed for a set of points and how to weight them
+
+    >>> steps, weights = plan_time_queries(numpy.array([0.0, 900.0]), 3600.0)
+    >>> steps.tolist(), weights.tolist()
+    ([[0, 1], [0, 1]], [[1.0, 0.0], [0.75, 0.25]])
+
+    :param epoch_seconds:     an array of times for the points in seconds since the epoch
+    :param time_step_seconds: the time between GFS outputs in seconds
+    :return: a tuple of (an (num_points, 2) array of the GFS output steps before and after each point,
+             an (num_points, 2) array of linear interpolation weights)
+    """
+
+    time_position = numpy.asarray(epoch_seconds, dtype=numpy.float64) / time_step_seconds
+    lower_step    = numpy.floor(time_position)
+    fraction      = time_position - lower_step
+    steps         = numpy.column_stack((lower_step, lower_step + 1.0)).astype(numpy.int64)
+    weights       = numpy.column_stack((1.0 - fraction, fraction))
+
+    return steps, weights
+
+def query_narrators_by_time (narrator_for_time, desired_points, time_step_hours=GFS_FORECAST_STEP_HOURS) :
+    """get Virtual Radiosonde results for a list of points, asking a separate narrator for each GFS output time
+
+    Each point is asked for at the GFS output times before and after it (or only at the one
+    it falls on) and the two results are interpolated linearly in time, the same way the
+    narrator would have done it.
+
+    :param narrator_for_time: a function that takes the datetime of a GFS output and gives the narrator to use for it
+    :param desired_points:    a list of dictionaries with datetime, latitude and longitude entries
+    :param time_step_hours:   the number of hours between GFS outputs
+    :return: a list of result dictionaries, one per desired point
+    """
+
+    if not desired_points :
+        return [ ]
+
+    time_step_seconds = time_step_hours * 3600.0
+    steps, weights    = plan_time_queries(_point_epoch_seconds(desired_points), time_step_seconds)
+    needed            = weights > 0.0
+
+    # ask each output time's narrator for all the points that need it
+    query_index = numpy.zeros(steps.shape, dtype=numpy.int64)
+    results     = [ ]
+    for step in numpy.unique(steps[needed]) :
+        point_indexes, sides = numpy.nonzero(needed & (steps == step))
+        output_time          = _EPOCH_START + timedelta(seconds=float(step * time_step_seconds))
+        query_points         = [dict(desired_points[index]) for index in point_indexes]
+        for query_point in query_points :
+            query_point[VR_INPUT_DATETIME_KEY] = output_time
+        query_index[point_indexes, sides] = numpy.arange(len(results), len(results) + point_indexes.size)
+        results.extend(narrator_for_time(output_time)(query_points))
+
+    # a point that falls on an output time only has the one result
+    query_index[:, 1] = numpy.where(needed[:, 1], query_index[:, 1], query_index[:, 0])
+
+    return interpolate_corner_results(results, query_index, weights)
+
+def query_narrator_by_corners (narrator, desired_points,
+                               grid_spacing=GFS_GRID_SPACING_DEGREES, time_step_hours=GFS_FORECAST_STEP_HOURS) :
+    """get Virtual Radiosonde results for a list of points, extracting each grid corner profile only once
+
+    :param narrator:        a VirtualRadiosondeNarrator (or anything that can be called the same way)
+    :param desired_points:  a list of dictionaries with datetime, latitude and longitude entries
+    :param grid_spacing:    the spacing of the GFS grid in degrees
+    :param time_step_hours: the number of hours between GFS outputs
+    :return: a list of result dictionaries, one per desired point
+    """
+
+    if not desired_points :
+        return [ ]
+
+    time_step_seconds = time_step_hours * 3600.0
+    lats          = numpy.array([point[VR_INPUT_LAT_KEY] for point in desired_points], dtype=numpy.float64)
+    lons          = numpy.array([point[VR_INPUT_LON_KEY] for point in desired_points], dtype=numpy.float64)
+    epoch_seconds = _point_epoch_seconds(desired_points)
+
+    corners, corner_index, weights = plan_corner_queries(lats, lons, epoch_seconds, grid_spacing, time_step_seconds)
+    log.info("Querying " + str(corners.shape[0]) + " grid corners for " + str(len(desired_points)) + " points")
+
+    corner_points = [{
+                      VR_INPUT_DATETIME_KEY: _EPOCH_START + timedelta(seconds=float(corner[2] * time_step_seconds)),
+                      VR_INPUT_LAT_KEY:      corner[0] * grid_spacing,
+                      VR_INPUT_LON_KEY:      corner[1] * grid_spacing,
+                     } for corner in corners]
+    corner_results = list(narrator(corner_points))
+
+    return interpolate_corner_results(corner_results, corner_index, weights)
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Run the conversion commands end to end on a small SHIS granule.
+
+This file is part of the shis2mirto software package. The files in tests/data are a 26
+record synthetic granule made with the shis2mirto.benchmark builders (32 channels, every
+4th one selected, 21 pressure levels), and the baseline_fov.nc and baseline_fg.nc files
+that the original per record / per fov version of create_fov_file and
+create_first_guess_file made from it, with the CannedNarrator standing in for the
+Virtual Radiosonde.
+
+"""
+__docformat__ = "restructuredtext en"
+
+import os
+import io
+import time
+import shutil
+import tempfile
+import unittest
+import contextlib
+from datetime import datetime
+
+import numpy
+import netCDF4 as nc
+
+from shis2mirto.guidebook  import *
+from shis2mirto.conversion import main as conversion_main
+from shis2mirto.vrcache    import vr_cache_entry_dir, list_vr_cache_entries
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+# the original code stored the matlab datenums as float32 before writing them as f8,
+# which only keeps them to within 1/16th of a day
+BASELINE_DATENUM_TOLERANCE = 1.0 / 16.0
+
+def data_path (file_name) :
+    return os.path.join(DATA_DIR, file_name)
+
+def write_leading_records (in_path, out_path, num_records) :
+    """copy the first num_records records of a SHIS file into a new file"""
+
+    in_file  = nc.Dataset(in_path)
+    out_file = nc.Dataset(out_path, 'w', format=in_file.data_model)
+    for dim_name, dim in in_file.dimensions.items() :
+        out_file.createDimension(dim_name, None if dim.isunlimited() else len(dim))
+    for var_name, in_var in in_file.variables.items() :
+        out_var = out_file.createVariable(var_name, in_var.dtype, in_var.dimensions)
+        if in_var.dimensions and in_var.dimensions[0] == 'record' :
+            out_var[:] = in_var[:num_records]
+        else :
+            out_var[:] = in_var[:]
+    out_file.close()
+    in_file.close()
+
+class ConversionTestCase (unittest.TestCase) :
+    """run the commands in a scratch directory that's cleaned up afterwards"""
+
+    def setUp (self) :
+        self.work_dir  = tempfile.mkdtemp(prefix="shis2mirto_test_")
+        self.out_dir   = os.path.join(self.work_dir, 'out')
+        self.cache_dir = os.path.join(self.work_dir, 'vr')
+        os.makedirs(self.out_dir)
+
+    def tearDown (self) :
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def run_command (self, *argv) :
+        rc = conversion_main(['-q', '-o', self.out_dir, '--vr_cache_dir', self.cache_dir] + list(argv))
+        self.assertEqual(rc, 0, "command failed: " + " ".join(argv))
+
+    def make_fov (self, shis_path, *extra_argv) :
+        self.run_command(*(list(extra_argv) + ['-s', shis_path, '-a', data_path('wavenumbers.nc'), '-r', '90.0',
+                                               'create_fov_file']))
+
+    def make_fg (self, *extra_argv) :
+        self.run_command(*(list(extra_argv) + ['-f', os.path.join(self.out_dir, OUT_FOV_FILE_NAME),
+                                               '-p', data_path('plevels.nc'),
+                                               '--vr_narrator', 'shis2mirto.benchmark:CannedNarrator',
+                                               'create_first_guess_file']))
+
+    def assert_same_as_baseline (self, out_name, baseline_name) :
+        expected = nc.Dataset(data_path(baseline_name))
+        found    = nc.Dataset(os.path.join(self.out_dir, out_name))
+        try :
+            self.assertEqual(sorted(expected.variables), sorted(found.variables))
+            for var_name in expected.variables :
+                expected_data = numpy.ma.filled(expected.variables[var_name][:], numpy.nan)
+                found_data    = numpy.ma.filled(found.variables[var_name][:],    numpy.nan)
+                self.assertEqual(expected_data.shape, found_data.shape, var_name)
+                if var_name == OUT_FOV_MATLAB_DATENUM_TIME_VAR_NAME :
+                    self.assertTrue(numpy.allclose(expected_data, found_data, rtol=0.0, atol=BASELINE_DATENUM_TOLERANCE),
+                                    var_name)
+                else :
+                    self.assertTrue(numpy.array_equal(expected_data, found_data, equal_nan=True), var_name)
+        finally :
+            expected.close()
+            found.close()
+
+class RoundTripTests (ConversionTestCase) :
+    """the fov and fg files are the same as the ones the original code made"""
+
+    def test_fov_and_first_guess (self) :
+        self.make_fov(data_path('shis.nc'))
+        self.make_fg()
+        self.assert_same_as_baseline(OUT_FOV_FILE_NAME, 'baseline_fov.nc')
+        self.assert_same_as_baseline(OUT_FG_FILE_NAME,  'baseline_fg.nc')
+
+    def test_streamed_records (self) :
+        self.make_fov(data_path('shis.nc'), '-k', '5')
+        self.assert_same_as_baseline(OUT_FOV_FILE_NAME, 'baseline_fov.nc')
+
+    def test_netcdf4_output (self) :
+        self.make_fov(data_path('shis.nc'), '--format', 'netcdf4')
+        self.make_fg('--format', 'netcdf4')
+        self.assert_same_as_baseline(OUT_FOV_FILE_NAME, 'baseline_fov.nc')
+        self.assert_same_as_baseline(OUT_FG_FILE_NAME,  'baseline_fg.nc')
+
+class AppendTests (ConversionTestCase) :
+    """growing the files one granule piece at a time ends up with the same data"""
+
+    def test_append_in_two_pieces (self) :
+        part_path = os.path.join(self.work_dir, 'shis_part.nc')
+        write_leading_records(data_path('shis.nc'), part_path, 13)
+
+        self.make_fov(part_path, '--append')
+        self.make_fg('--append')
+        self.make_fov(data_path('shis.nc'), '--append')
+        self.make_fg('--append')
+
+        self.assert_same_as_baseline(OUT_FOV_FILE_NAME, 'baseline_fov.nc')
+        self.assert_same_as_baseline(OUT_FG_FILE_NAME,  'baseline_fg.nc')
+
+    def test_append_nothing_new (self) :
+        self.make_fov(data_path('shis.nc'), '--append')
+        self.make_fg('--append')
+        self.make_fov(data_path('shis.nc'), '--append', '--force')
+        self.make_fg('--append', '--force')
+
+        self.assert_same_as_baseline(OUT_FOV_FILE_NAME, 'baseline_fov.nc')
+        self.assert_same_as_baseline(OUT_FG_FILE_NAME,  'baseline_fg.nc')
+
+    def test_classic_header_stays_put (self) :
+        # the provenance attributes are a fixed width, so appending never moves the data
+        part_path = os.path.join(self.work_dir, 'shis_part.nc')
+        write_leading_records(data_path('shis.nc'), part_path, 13)
+        fov_path = os.path.join(self.out_dir, OUT_FOV_FILE_NAME)
+
+        self.make_fov(part_path, '--append')
+        with open(fov_path, 'rb') as fov_file :
+            first_header = fov_file.read(256)
+        self.make_fov(data_path('shis.nc'), '--append')
+        with open(fov_path, 'rb') as fov_file :
+            second_header = fov_file.read(256)
+
+        # the header starts with the magic number and record count, then the dimensions
+        self.assertEqual(first_header[8:], second_header[8:])
+
+class CacheCommandTests (ConversionTestCase) :
+    """cache_stats and cache_prune report on and trim the virtual radiosonde cache"""
+
+    def make_entry (self, valid_time, num_bytes, days_ago) :
+        entry_path = vr_cache_entry_dir(self.cache_dir, valid_time)
+        with open(os.path.join(entry_path, 'gfs.grib2'), 'wb') as data_file :
+            data_file.write(b'\0' * num_bytes)
+        used_time = time.time() - days_ago * 24.0 * 60.0 * 60.0
+        os.utime(os.path.join(entry_path, VR_CACHE_LAST_USED_FILE_NAME), (used_time, used_time))
+
+        return entry_path
+
+    def run_cache_command (self, *argv) :
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output) :
+            self.run_command(*argv)
+
+        return output.getvalue()
+
+    def test_stats (self) :
+        self.make_entry(datetime(2014, 9, 6,  9), 1024 * 1024, 3.0)
+        self.make_entry(datetime(2014, 9, 6, 12), 1024 * 1024, 1.0)
+
+        output = self.run_cache_command('cache_stats')
+
+        self.assertIn("entries:     2", output)
+        self.assertIn("total size:  2.0 MB", output)
+
+    def test_stats_empty (self) :
+        output = self.run_cache_command('cache_stats')
+
+        self.assertIn("entries:     0", output)
+
+    def test_first_guess_fills_cache (self) :
+        self.make_fov(data_path('shis.nc'))
+        self.make_fg()
+
+        # the granule is from 10:40 to 10:43 UTC, so the run's entry is the 09 UTC GFS output before it
+        keys = [entry[0] for entry in list_vr_cache_entries(self.cache_dir)]
+        self.assertEqual(keys, [os.path.join('20140906', 't06z', 'f003')])
+
+    def test_split_times_fills_cache (self) :
+        self.make_fov(data_path('shis.nc'))
+        self.make_fg('--vr_split_times')
+
+        # split by output time, the granule needs both the 09 and 12 UTC GFS outputs
+        keys = [entry[0] for entry in list_vr_cache_entries(self.cache_dir)]
+        self.assertEqual(sorted(keys), [os.path.join('20140906', 't06z', 'f003'), os.path.join('20140906', 't12z', 'f000')])
+
+    def test_new_gfs_data_remakes_first_guess (self) :
+        self.make_fov(data_path('shis.nc'))
+        self.make_fg()
+        fg_path = os.path.join(self.out_dir, OUT_FG_FILE_NAME)
+
+        # nothing has changed, so the first guess is left alone
+        os.utime(fg_path, (0, 0))
+        self.make_fg()
+        self.assertEqual(os.stat(fg_path).st_mtime, 0)
+
+        # a GFS forecast file the granule needs has turned up in the cache since
+        self.make_entry(datetime(2014, 9, 6, 12), 1024, 0.0)
+        self.make_fg()
+        self.assertNotEqual(os.stat(fg_path).st_mtime, 0)
+
+    def test_prune_by_size (self) :
+        oldest = self.make_entry(datetime(2014, 9, 6,  6), 1024 * 1024, 5.0)
+        middle = self.make_entry(datetime(2014, 9, 6,  9), 1024 * 1024, 3.0)
+        newest = self.make_entry(datetime(2014, 9, 6, 12), 1024 * 1024, 1.0)
+
+        output = self.run_cache_command('--vr_cache_max_mb', '2.5', 'cache_prune')
+
+        self.assertIn("removed 1 entries", output)
+        self.assertFalse(os.path.exists(oldest))
+        self.assertTrue(os.path.exists(middle))
+        self.assertTrue(os.path.exists(newest))
+
+    def test_prune_by_age (self) :
+        oldest = self.make_entry(datetime(2014, 9, 5, 18), 1024, 40.0)
+        newest = self.make_entry(datetime(2014, 9, 6, 12), 1024, 1.0)
+
+        self.run_cache_command('--vr_cache_max_age', '30', 'cache_prune')
+
+        self.assertFalse(os.path.exists(oldest))
+        self.assertFalse(os.path.exists(os.path.join(self.cache_dir, '20140905')))
+        self.assertTrue(os.path.exists(newest))
+
+    def test_prune_needs_a_limit (self) :
+        self.make_entry(datetime(2014, 9, 6, 12), 1024, 1.0)
+
+        rc = conversion_main(['-q', '--vr_cache_dir', self.cache_dir, 'cache_prune'])
+
+        self.assertEqual(rc, 1)
+        self.assertEqual(len(list_vr_cache_entries(self.cache_dir)), 1)
+
+if __name__ == '__main__' :
+    unittest.main()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Check that the first guess gets the narrator's own answer at each observation's time.
+
+This file is part of the shis2mirto software package. The DriftingNarrator below gives
+profiles that change with time along a curve, so anything that asks for the observations
+at other times and interpolates between them gives a different first guess.
+
+"""
+__docformat__ = "restructuredtext en"
+
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+
+import numpy
+import netCDF4 as nc
+
+from shis2mirto.guidebook  import *
+from shis2mirto.fov        import read_fov_file
+from shis2mirto.firstguess import make_run_narrator, build_first_guess, build_first_guess_parallel
+from shis2mirto.vremap     import native_source_levels
+from shis2mirto.conversion import main as conversion_main
+
+DATA_DIR    = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+EPOCH_START = datetime(1970, 1, 1, 0, 0, 0)
+GROUND_HPA  = 850.0 # the DriftingNarrator's ground is raised well above sea level
+
+def data_path (file_name) :
+    return os.path.join(DATA_DIR, file_name)
+
+class DriftingNarrator (object) :
+    """a stand-in for the VirtualRadiosondeNarrator whose profiles drift with the time asked for
+
+    The profiles are linear in pressure, so the values on any level can be worked out from
+    the levels alone.
+    """
+
+    def __init__ (self, on_dread=True, levels=None, cache=None, channels=None, **kwargs) :
+        self.levels      = numpy.asarray(levels, dtype=numpy.float64)
+        self.level_ratio = self.levels / numpy.max(self.levels)
+
+    def __call__ (self, points) :
+        for point in points :
+            seconds = (point[VR_INPUT_DATETIME_KEY] - EPOCH_START).total_seconds()
+            drift   = 4.0 * numpy.sin(seconds / 45.0) + 0.01 * float(point[VR_INPUT_LAT_KEY])
+            yield {
+                   VR_TEMPERATURE_KEY:          -60.0 + 75.0 * self.level_ratio + drift,
+                   VR_PRESSURE_KEY:             self.levels.copy(),
+                   VR_RELATIVE_HUMIDITY_KEY:    10.0 + 70.0 * self.level_ratio + drift,
+                   VR_OZONE_MR_KEY:             1.0e-5 * (1.0 - self.level_ratio) + 1.0e-8 * (5.0 + drift),
+                   VR_SURFACE_TEMPERATURE_KEY:  290.0 + drift,
+                   VR_SEA_SURFACE_PRESSURE_KEY: 101325.0 + drift,
+                   VR_SURFACE_PRESSURE_KEY:     GROUND_HPA * PASCALS_PER_HECTOPASCAL,
+                  }
+
+class NarratorTimeTests (unittest.TestCase) :
+    """the default first guess path is the same as asking the narrator directly"""
+
+    def setUp (self) :
+        self.work_dir    = tempfile.mkdtemp(prefix="shis2mirto_test_")
+        self.cache_dir   = os.path.join(self.work_dir, 'vr')
+        self.fov_product = read_fov_file(data_path('baseline_fov.nc'), include_radiances=False)
+        self.plevels     = numpy.linspace(1000.0, 50.0, 21)
+        self.start_time  = min(self.fov_product.datetimes())
+        self.expected    = build_first_guess(self.fov_product, self.plevels, DriftingNarrator(levels=self.plevels))
+
+    def tearDown (self) :
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def assert_same_first_guess (self, found) :
+        self.assertTrue(numpy.array_equal(self.expected.state_vector,  found.state_vector,  equal_nan=True))
+        self.assertTrue(numpy.array_equal(self.expected.pressure_grid, found.pressure_grid, equal_nan=True))
+
+    def test_run_narrator (self) :
+        narrator = make_run_narrator(self.plevels, self.cache_dir, self.start_time, narrator_class=DriftingNarrator)
+
+        self.assert_same_first_guess(build_first_guess(self.fov_product, self.plevels, narrator))
+
+    def test_parallel (self) :
+        self.assert_same_first_guess(build_first_guess_parallel(self.fov_product, self.plevels, self.cache_dir, 2,
+                                                                narrator_class=DriftingNarrator))
+
+    def test_split_times_interpolates (self) :
+        # splitting the queries by GFS output time interpolates linearly between them, which
+        # doesn't follow a narrator that curves in time
+        narrator = make_run_narrator(self.plevels, self.cache_dir, self.start_time, narrator_class=DriftingNarrator,
+                                     split_times=True)
+        found    = build_first_guess(self.fov_product, self.plevels, narrator)
+
+        self.assertFalse(numpy.array_equal(self.expected.state_vector, found.state_vector, equal_nan=True))
+
+    def test_command_line (self) :
+        out_dir = os.path.join(self.work_dir, 'out')
+        os.makedirs(out_dir)
+        rc      = conversion_main(['-q', '-o', out_dir, '--vr_cache_dir', self.cache_dir,
+                                   '-f', data_path('baseline_fov.nc'), '-p', data_path('plevels.nc'),
+                                   '--vr_narrator', 'tests.test_firstguess:DriftingNarrator',
+                                   'create_first_guess_file'])
+        self.assertEqual(rc, 0)
+
+        plvls_file = nc.Dataset(data_path('plevels.nc'))
+        plevels    = numpy.sort(plvls_file.variables[INPUT_PRESSURE_LEVELS_VAR_NAME][:])[::-1]
+        plvls_file.close()
+        expected   = build_first_guess(self.fov_product, plevels, DriftingNarrator(levels=plevels))
+        fg_file    = nc.Dataset(os.path.join(out_dir, OUT_FG_FILE_NAME))
+        found      = numpy.ma.filled(fg_file.variables[OUT_FG_FIRST_GUESS_STATE_VEC_VAR_NAME][:], numpy.nan)
+        fg_file.close()
+
+        self.assertTrue(numpy.array_equal(expected.state_vector, found, equal_nan=True))
+
+class NativeLevelsTests (unittest.TestCase) :
+    """remapping from the GFS levels leaves the levels past them to the narrator and masks the ground"""
+
+    def setUp (self) :
+        self.fov_product = read_fov_file(data_path('baseline_fov.nc'), include_radiances=False)
+        self.plevels     = numpy.concatenate([[1100.0], numpy.logspace(3.0, -2.0, 40)])
+
+    def temperatures (self, native_levels=None) :
+        narrator = DriftingNarrator(levels=self.plevels if native_levels is None else native_levels)
+        product  = build_first_guess(self.fov_product, self.plevels, narrator, native_levels=native_levels)
+
+        return product.layout.segment(product.state_vector, STATE_TEMPERATURE_SEGMENT)
+
+    def test_levels_past_the_gfs_levels (self) :
+        native_levels = native_source_levels(GFS_PRESSURE_LEVELS_HPA, self.plevels)
+        expected      = self.temperatures()
+        found         = self.temperatures(native_levels=native_levels)
+
+        # above the top GFS level the narrator was asked for the levels themselves
+        above = self.plevels < numpy.min(GFS_PRESSURE_LEVELS_HPA)
+        self.assertTrue(numpy.any(above))
+        self.assertTrue(numpy.array_equal(expected[:, above], found[:, above]))
+
+        # below the ground every level has the value at the surface pressure, which is a GFS level
+        below  = self.plevels > GROUND_HPA
+        ground = expected[:, 0] - 75.0 * (1.0 - GROUND_HPA / numpy.max(self.plevels))
+        self.assertTrue(numpy.any(below))
+        self.assertTrue(numpy.allclose(found[:, below], ground[:, numpy.newaxis]))
+
+if __name__ == '__main__' :
+    unittest.main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Check that the memory mapped classic reader masks values the same way netCDF4 does.
+
+This file is part of the shis2mirto software package.
+
+"""
+__docformat__ = "restructuredtext en"
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+import netCDF4 as nc
+
+from shis2mirto.ncclassic import ClassicDataset
+
+DEFAULT_F4_FILL = 9.9692099683868690e+36
+
+# the variables to write: (name, type, _FillValue, missing_value, values)
+MASKING_VARIABLES = [
+                     ('default_fill',  'f4', None,      None,                 [1.0, DEFAULT_F4_FILL, numpy.nan, 4.0]),
+                     ('fill',          'f4', -999.0,    None,                 [1.0, -999.0, DEFAULT_F4_FILL, 4.0]),
+                     ('nan_fill',      'f4', numpy.nan, None,                 [1.0, numpy.nan, DEFAULT_F4_FILL, 4.0]),
+                     ('missing',       'f4', None,      -1.0,                 [1.0, -1.0, DEFAULT_F4_FILL, 4.0]),
+                     ('missing_list',  'f8', None,      [-1.0, -2.0],         [-2.0, -1.0, DEFAULT_F4_FILL, 4.0]),
+                     ('nan_missing',   'f8', None,      numpy.nan,            [numpy.nan, -1.0, DEFAULT_F4_FILL, 4.0]),
+                     ('fill_and_miss', 'f4', -999.0,    -1.0,                 [-999.0, -1.0, DEFAULT_F4_FILL, 4.0]),
+                     ('short_fill',    'i2', None,      None,                 [1, -32767, 3, 4]),
+                     ('short_miss',    'i2', -9999,     0,                    [0, -9999, -32767, 4]),
+                     ('unsafe_miss',   'i2', None,      1.0e6,                [0, 16960, -32767, 4]),
+                     ('byte_default',  'i1', None,      None,                 [1, -127, 3, 4]),
+                     ('byte_fill',     'i1', 3,         None,                 [1, -127, 3, 4]),
+                    ]
+
+class MaskingTests (unittest.TestCase) :
+    """both readers give the same values and masks for every kind of missing data attribute"""
+
+    def setUp (self) :
+        self.work_dir = tempfile.mkdtemp(prefix="shis2mirto_test_")
+
+    def tearDown (self) :
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def write_file (self, file_format, variables) :
+        file_path = os.path.join(self.work_dir, file_format + ".nc")
+        out_file  = nc.Dataset(file_path, 'w', format=file_format)
+        out_file.createDimension('record', None)
+        for var_name, var_type, fill_value, missing_value, values in variables :
+            out_var = out_file.createVariable(var_name, var_type, ('record',), fill_value=fill_value)
+            if missing_value is not None :
+                out_var.missing_value = numpy.array(missing_value, dtype=numpy.float64)
+            out_var.set_auto_mask(False)
+            out_var[:] = numpy.array(values).astype(var_type)
+        out_file.close()
+
+        return file_path
+
+    def assert_same_masking (self, file_path, var_names) :
+        expected_file = nc.Dataset(file_path)
+        found_file    = ClassicDataset(file_path)
+        for var_name in var_names :
+            expected = expected_file.variables[var_name][:]
+            found    = found_file.variables[var_name][:]
+            self.assertEqual(numpy.ma.getmaskarray(expected).tolist(), numpy.ma.getmaskarray(found).tolist(), var_name)
+            self.assertTrue(numpy.array_equal(numpy.ma.getdata(expected), numpy.ma.getdata(found), equal_nan=True),
+                            var_name)
+            # the slices are masked the same way as the whole variable
+            self.assertEqual(numpy.ma.getmaskarray(expected[1:3]).tolist(), numpy.ma.getmaskarray(found[1:3]).tolist(),
+                             var_name)
+        expected_file.close()
+
+    def test_classic (self) :
+        file_path = self.write_file("NETCDF3_CLASSIC", MASKING_VARIABLES)
+        self.assert_same_masking(file_path, [variable[0] for variable in MASKING_VARIABLES])
+
+    def test_unsigned_types (self) :
+        # the unsigned types are only in the 64 bit data format
+        variables = MASKING_VARIABLES + [
+                                         ('ubyte_default', 'u1', None, None, [1, 255, 3, 4]),
+                                         ('ubyte_fill',    'u1', 7,    None, [1, 255, 7, 4]),
+                                         ('ushort_miss',   'u2', None, 9,    [9, 65535, 3, 4]),
+                                        ]
+        file_path = self.write_file("NETCDF3_64BIT_DATA", variables)
+        self.assert_same_masking(file_path, [variable[0] for variable in variables])
+
+if __name__ == '__main__' :
+    unittest.main()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Check the vectorized Virtual Radiosonde conversion against the original per fov loop.
+
+This file is part of the shis2mirto software package. The loop below is the one that
+create_first_guess_file used before the conversion worked on all the observations at
+once; the state vector and pressure grid it builds are the reference.
+
+"""
+__docformat__ = "restructuredtext en"
+
+import unittest
+
+import numpy
+
+from shis2mirto.guidebook   import *
+from shis2mirto.physics     import fill_state_from_vr_results
+from shis2mirto.statevector import StateVectorLayout
+
+def _loop_relative_humidity_to_specific_humidity (relative_humidity_ratio_profile, temperature_profile) :
+    """the original conversion, one profile at a time"""
+
+    temp_rh = relative_humidity_ratio_profile * 2.541e6
+    temp_t  = numpy.exp(numpy.ones(temperature_profile.shape) * -5415.0 / temperature_profile)
+
+    return temp_rh * temp_t * (18.0 / 29.0)
+
+def loop_fill (results, num_plvls) :
+    """build the state vector and pressure grid the way the original per fov loop did
+
+    :return: a tuple of (state vector, pressure grid), each (num_obs, state vector size)
+    """
+
+    num_obs          = len(results)
+    num_emiss_consts = SURFACE_EMISSIVITY_COEFFICIENTS.size
+
+    temperature  = numpy.ones((num_obs, num_plvls), dtype=numpy.float32) * numpy.nan
+    pressure     = numpy.ones((num_obs, num_plvls), dtype=numpy.float32) * numpy.nan
+    water_vapor  = numpy.ones((num_obs, num_plvls), dtype=numpy.float32) * numpy.nan
+    c02_value    = numpy.ones((num_obs, num_plvls), dtype=numpy.float32) * C02_CONST_STARTING_PT_IN_PPMV
+    ozone        = numpy.ones((num_obs, num_plvls), dtype=numpy.float32) * numpy.nan
+    surface_temp = numpy.ones((num_obs, 1),         dtype=numpy.float32) * numpy.nan
+    surface_pres = numpy.ones((num_obs, 1),         dtype=numpy.float32) * numpy.nan
+
+    for index in range(0, len(results)) :
+        current_pt = results[index]
+        temperature[index]  = current_pt[VR_TEMPERATURE_KEY] + CELSIUS_TO_KELVIN_ADD_CONST
+        pressure   [index]  = current_pt[VR_PRESSURE_KEY]
+        water_vapor_temp    = _loop_relative_humidity_to_specific_humidity(current_pt[VR_RELATIVE_HUMIDITY_KEY] / 100.0,
+                                                                           temperature[index])
+        water_vapor_temp[water_vapor_temp < WATER_VAPOR_MINIMUM] = WATER_VAPOR_MINIMUM
+        water_vapor[index]  = numpy.log(water_vapor_temp)
+        temp_ozone_mr       = current_pt[VR_OZONE_MR_KEY]
+        ozone[index]        = numpy.log(temp_ozone_mr / (temp_ozone_mr + 1))
+        surface_temp[index] = current_pt[VR_SURFACE_TEMPERATURE_KEY]
+        surface_pres[index] = current_pt[VR_SEA_SURFACE_PRESSURE_KEY]
+
+    temp_coeffs       = numpy.reshape(numpy.tile(SURFACE_EMISSIVITY_COEFFICIENTS, num_obs), (num_obs, num_emiss_consts))
+    state_vector_data = numpy.concatenate([temperature, water_vapor, c02_value, ozone, surface_temp, temp_coeffs], axis=1)
+    press_vector_data = numpy.concatenate([pressure] * 4 + [surface_pres] * (1 + num_emiss_consts), axis=1)
+
+    return state_vector_data, press_vector_data
+
+def vectorized_fill (results, num_plvls) :
+    """build the state vector and pressure grid the way build_first_guess does now"""
+
+    layout            = StateVectorLayout(num_plvls)
+    state_vector_data = layout.allocate(len(results))
+    press_vector_data = layout.allocate(len(results))
+    layout.segment(state_vector_data, STATE_CO2_SEGMENT)[:]                = C02_CONST_STARTING_PT_IN_PPMV
+    layout.segment(state_vector_data, STATE_SURFACE_EMISSIVITY_SEGMENT)[:] = SURFACE_EMISSIVITY_COEFFICIENTS
+    fill_state_from_vr_results(results, layout, state_vector_data, press_vector_data)
+
+    return state_vector_data, press_vector_data
+
+def make_results (num_obs, num_plvls, seed=0) :
+    """make up narrator results with realistic ranges for each entry"""
+
+    rng     = numpy.random.RandomState(seed)
+    plevels = numpy.linspace(1100.0, 0.005, num_plvls)
+    results = [ ]
+    for index in range(num_obs) :
+        results.append({
+                        VR_TEMPERATURE_KEY:          rng.uniform(-80.0, 35.0, num_plvls),
+                        VR_PRESSURE_KEY:             plevels.copy(),
+                        VR_RELATIVE_HUMIDITY_KEY:    rng.uniform(0.0, 100.0, num_plvls),
+                        VR_OZONE_MR_KEY:             rng.uniform(1.0e-9, 1.0e-5, num_plvls),
+                        VR_SURFACE_TEMPERATURE_KEY:  rng.uniform(240.0, 315.0),
+                        VR_SEA_SURFACE_PRESSURE_KEY: rng.uniform(98000.0, 104000.0),
+                       })
+
+    return results
+
+class FillStateTests (unittest.TestCase) :
+    """the vectorized fill gives exactly what the original loop gave"""
+
+    num_plvls = 101
+
+    def assert_same_fill (self, results) :
+        loop_state,  loop_press  = loop_fill(results, self.num_plvls)
+        array_state, array_press = vectorized_fill(results, self.num_plvls)
+
+        self.assertEqual(loop_state.shape, array_state.shape)
+        self.assertTrue(numpy.array_equal(loop_state,  array_state, equal_nan=True))
+        self.assertTrue(numpy.array_equal(loop_press, array_press, equal_nan=True))
+
+    def test_many_fovs (self) :
+        self.assert_same_fill(make_results(250, self.num_plvls))
+
+    def test_one_fov (self) :
+        self.assert_same_fill(make_results(1, self.num_plvls, seed=1))
+
+    def test_dry_and_missing_values (self) :
+        # completely dry levels hit the water vapor minimum, and NaNs go through as NaNs
+        results = make_results(40, self.num_plvls, seed=2)
+        results[3][VR_RELATIVE_HUMIDITY_KEY][:10] = 0.0
+        results[5][VR_TEMPERATURE_KEY][20:25]     = numpy.nan
+        results[7][VR_OZONE_MR_KEY][-3:]          = numpy.nan
+        results[9][VR_SURFACE_TEMPERATURE_KEY]    = numpy.nan
+        self.assert_same_fill(results)
+
+    def test_masked_profiles (self) :
+        # the narrator can hand back masked arrays, ie. for levels below the ground; the
+        # loop kept whatever data was under the mask, now those levels are NaN
+        results = make_results(60, self.num_plvls, seed=3)
+        missing = make_results(60, self.num_plvls, seed=3)
+        for index in range(0, 60, 4) :
+            below_ground = numpy.zeros(self.num_plvls, dtype=bool)
+            below_ground[:index % 17 + 1] = True
+            for key in (VR_TEMPERATURE_KEY, VR_RELATIVE_HUMIDITY_KEY, VR_OZONE_MR_KEY) :
+                results[index][key] = numpy.ma.array(results[index][key], mask=below_ground)
+                missing[index][key][below_ground] = numpy.nan
+        results[8][VR_SURFACE_TEMPERATURE_KEY] = numpy.ma.masked
+        missing[8][VR_SURFACE_TEMPERATURE_KEY] = numpy.nan
+
+        loop_state,  loop_press  = loop_fill(missing, self.num_plvls)
+        array_state, array_press = vectorized_fill(results, self.num_plvls)
+
+        self.assertTrue(numpy.array_equal(loop_state,  array_state, equal_nan=True))
+        self.assertTrue(numpy.array_equal(loop_press, array_press, equal_nan=True))
+        self.assertTrue(numpy.all(numpy.isnan(array_state[4, :5])))
+        self.assertFalse(numpy.any(numpy.isnan(array_state[1, :4 * self.num_plvls + 1])))
+
+if __name__ == '__main__' :
+    unittest.main()
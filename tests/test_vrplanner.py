@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Check that planning the Virtual Radiosonde queries by grid corner gives the narrator's answers.
+
+This file is part of the shis2mirto software package. The GridNarrator below interpolates
+made up values on the GFS grid the same way the Virtual Radiosonde does, so asking it for
+each point directly is the reference for the planner.
+
+"""
+__docformat__ = "restructuredtext en"
+
+import unittest
+from datetime import datetime, timedelta
+
+import numpy
+
+from shis2mirto.guidebook import *
+from shis2mirto.vrplanner import query_narrator_by_corners, plan_corner_queries
+
+GRID_SPACING    = 0.5
+TIME_STEP_HOURS = 3.0
+EPOCH_START     = datetime(1970, 1, 1, 0, 0, 0)
+
+def grid_value (lat_step, lon_step, time_step) :
+    """a value for each grid node, which is continuous across the 180th meridian"""
+
+    lon_radians = numpy.radians(lon_step * GRID_SPACING)
+
+    return (numpy.sin(numpy.radians(lat_step * GRID_SPACING)) * 40.0 + numpy.cos(lon_radians) * 7.0 +
+            numpy.sin(lon_radians) * 3.0 + time_step * 0.25)
+
+class GridNarrator (object) :
+    """interpolate the grid_value nodes trilinearly, remembering every point it was asked for"""
+
+    def __init__ (self, missing_nodes=()) :
+        self.queries       = [ ]
+        self.missing_nodes = set(missing_nodes)
+
+    def _node (self, lat_step, lon_step, time_step) :
+        lat_step = min(max(lat_step, -180), 180)
+        lon_step = (lon_step + 360) % 720 - 360
+        if (lat_step, lon_step, time_step) in self.missing_nodes :
+            return numpy.nan
+
+        return grid_value(lat_step, lon_step, time_step)
+
+    def __call__ (self, points) :
+        for point in points :
+            self.queries.append(point)
+            seconds    = (point[VR_INPUT_DATETIME_KEY] - EPOCH_START).total_seconds()
+            position   = numpy.array([point[VR_INPUT_LAT_KEY] / GRID_SPACING, point[VR_INPUT_LON_KEY] / GRID_SPACING,
+                                      seconds / (TIME_STEP_HOURS * 3600.0)])
+            base       = numpy.floor(position)
+            fraction   = position - base
+            value      = 0.0
+            for offsets in numpy.ndindex(2, 2, 2) :
+                weight = numpy.prod(numpy.where(numpy.array(offsets) == 1, fraction, 1.0 - fraction))
+                if weight > 0.0 :
+                    value += weight * self._node(*[int(step) for step in base + offsets])
+            yield {'value': value, 'source': 'grid narrator'}
+
+def make_points (lats, lons, start=datetime(2014, 9, 6, 10, 40)) :
+    return [{VR_INPUT_DATETIME_KEY: start + timedelta(minutes=7 * index),
+             VR_INPUT_LAT_KEY:      lat,
+             VR_INPUT_LON_KEY:      lon} for index, (lat, lon) in enumerate(zip(lats, lons))]
+
+class CornerPlannerTests (unittest.TestCase) :
+
+    def assert_same_as_narrator (self, points, missing_nodes=()) :
+        expected = [result['value'] for result in GridNarrator(missing_nodes)(points)]
+        narrator = GridNarrator(missing_nodes)
+        results  = query_narrator_by_corners(narrator, points, grid_spacing=GRID_SPACING, time_step_hours=TIME_STEP_HOURS)
+
+        self.assertTrue(numpy.allclose([result['value'] for result in results], expected, rtol=0.0, atol=1.0e-9))
+
+        return narrator, results
+
+    def test_ordinary_points (self) :
+        self.assert_same_as_narrator(make_points([43.07, 43.08, 43.21], [-89.40, -89.38, -89.11]))
+
+    def test_across_the_date_line (self) :
+        narrator, results = self.assert_same_as_narrator(make_points([10.1, 10.1, 10.2], [179.9, -179.9, 180.1]))
+
+        # nothing is asked for outside of [-180, 180), and the points share the corners on the 180th meridian
+        query_lons = set(query[VR_INPUT_LON_KEY] for query in narrator.queries)
+        self.assertTrue(all(-180.0 <= lon < 180.0 for lon in query_lons))
+        self.assertIn(-180.0, query_lons)
+        self.assertNotIn(180.0, query_lons)
+
+    def test_at_the_poles (self) :
+        narrator, results = self.assert_same_as_narrator(make_points([90.0, 89.8, -90.0], [12.3, -45.1, 100.2]))
+
+        self.assertTrue(all(-90.0 <= query[VR_INPUT_LAT_KEY] <= 90.0 for query in narrator.queries))
+
+    def test_points_on_grid_lines (self) :
+        # a point exactly on a grid corner and output time only needs that one corner
+        points   = make_points([40.5], [-90.0], start=datetime(2014, 9, 6, 12))
+        narrator = GridNarrator()
+        query_narrator_by_corners(narrator, points, grid_spacing=GRID_SPACING, time_step_hours=TIME_STEP_HOURS)
+
+        self.assertEqual(len(narrator.queries), 1)
+
+    def test_missing_corner_without_weight (self) :
+        # the corners past the point's grid line have no weight, so their missing values don't matter
+        points       = make_points([40.5], [-89.8], start=datetime(2014, 9, 6, 12))
+        seconds      = (points[0][VR_INPUT_DATETIME_KEY] - EPOCH_START).total_seconds()
+        time_step    = int(seconds // (TIME_STEP_HOURS * 3600.0))
+        corners, corner_index, weights = plan_corner_queries(numpy.array([40.5]), numpy.array([-89.8]),
+                                                             numpy.array([seconds]), GRID_SPACING,
+                                                             TIME_STEP_HOURS * 3600.0)
+        self.assertEqual(corners.shape[0], 2)
+
+        narrator, results = self.assert_same_as_narrator(points, missing_nodes=[(82, -180, time_step + 1)])
+        self.assertTrue(numpy.isfinite(results[0]['value']))
+
+    def test_text_entries_pass_through (self) :
+        narrator, results = self.assert_same_as_narrator(make_points([43.07, -10.3], [-89.40, 120.7]))
+
+        self.assertEqual([result['source'] for result in results], ['grid narrator', 'grid narrator'])
+
+if __name__ == '__main__' :
+    unittest.main()